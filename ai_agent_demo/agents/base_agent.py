@@ -6,7 +6,6 @@
 """
 import os
 import sys
-import json
 from typing import List, Dict, Any, Optional
 
 # 添加项目根目录到Python路径
@@ -18,144 +17,215 @@ dotenv_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env')
 load_dotenv(dotenv_path)
 
 # 导入必要的模块
-from langchain.agents import Tool, initialize_agent, AgentType
+# LangChain Agent、LLM客户端、嵌入模型和图像模型等较重的依赖均在首次使用时才导入，
+# 导入本模块不会触发模型加载或索引构建
+import threading
 from langchain_core.prompts import PromptTemplate
-from langchain_openai import ChatOpenAI
-
-from memory.memory import memory
-from tools.search_tool import search_web
-from tools.doc_reader import load_pdf_content
-from tools.vectorstore import build_vectorstore_from_pdf, build_vectorstore_from_document, get_embeddings
-from multimodal.image_captioning import caption_image
 
 # 配置常量
 SIMILARITY_THRESHOLD = 1.5  # 相似度阈值，可根据实际情况调整
 
-# 构建文档向量检索器 - 使用项目中实际存在的PDF文件路径
+# 文档向量检索器 - 使用项目中实际存在的PDF文件路径，首次检索时才构建
 agent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 pdf_path = os.path.join(agent_dir, "../docs/GB+38031-2025.pdf")
-vectorstore = build_vectorstore_from_pdf(pdf_path)
-retriever = vectorstore.as_retriever()
+_retriever = None
+_retriever_lock = threading.Lock()
+_pdf_lexical_index = None
+
+
+def get_retriever():
+    """
+    获取预设PDF文档的检索器，首次调用时构建（优先从磁盘加载持久化索引）
+    
+    返回值: 向量检索器
+    """
+    global _retriever
+    if _retriever is None:
+        with _retriever_lock:
+            if _retriever is None:
+                from tools.vectorstore import build_vectorstore_from_pdf
+                _retriever = build_vectorstore_from_pdf(pdf_path).as_retriever()
+    return _retriever
+
+
+def get_pdf_lexical_index():
+    """
+    获取预设PDF文档分片的关键词倒排索引，首次调用时由检索器中的分片构建
+
+    返回值: DocumentLexicalIndex实例
+    """
+    global _pdf_lexical_index
+    if _pdf_lexical_index is None:
+        retriever = get_retriever()
+        with _retriever_lock:
+            if _pdf_lexical_index is None:
+                from tools.lexical_index import DocumentLexicalIndex
+                vectorstore = retriever.vectorstore
+                documents = [vectorstore.docstore.search(vectorstore.index_to_docstore_id[i])
+                             for i in range(vectorstore.index.ntotal)]
+                _pdf_lexical_index = DocumentLexicalIndex(documents)
+    return _pdf_lexical_index
 
 # 知识库路径
 kb_dir = os.path.join(agent_dir, "knowledge_base")
-kb_metadata_file = os.path.join(kb_dir, "metadata.json")
 
-# 从app.main导入全局向量存储缓存
-# from app.main import vectorstore_cache
-# 从缓存模块导入全局向量存储缓存
-from cache.vector_cache import vectorstore_cache
+from tools.kb_index import get_kb_index
+from tools.kb_catalog import get_kb_catalog
+
+# 知识库中参与检索的文件类型
+SUPPORTED_KB_FILE_TYPES = [".pdf", ".txt", ".docx", ".jpg", ".jpeg", ".png", ".gif"]
+
+def sync_kb_index():
+    """使知识库统一索引与知识库目录保持一致"""
+    catalog = get_kb_catalog()
+    get_kb_index().sync(catalog.all_files, SUPPORTED_KB_FILE_TYPES, version=catalog.version())
+
 
 # 从知识库中检索相关文档
-def retrieve_knowledge(query: str, k: int = 3) -> str:
+def retrieve_knowledge_with_sources(query: str, k: int = 3, file_ids: Optional[List[str]] = None,
+                                    file_types: Optional[List[str]] = None):
     """
-    从知识库中检索与查询相关的文档
-    
+    从知识库中检索与查询相关的文档，并返回内容来源的文件ID
+
+    所有知识库文件的分片位于同一个统一索引中，查询只嵌入一次、检索一次
+
     参数 query: 查询文本
     参数 k: 返回的相关文档数量
-    返回值: 检索到的文档内容，用换行符分隔，包含文档来源信息
+    参数 file_ids: 只在这些文件中检索，可选
+    参数 file_types: 只在这些类型的文件中检索，可选
+    返回值: (检索到的文档内容, 来源文件ID列表)，内容用换行符分隔并包含文档来源信息
     """
     try:
-        # 加载知识库元数据
-        if not os.path.exists(kb_metadata_file):
-            return ""
+        # 统一索引与知识库目录对齐：新文件优先从持久化索引加载后并入，已删除的文件移除；
+        # 目录版本号未变化时跳过，不需要每次请求都遍历文件列表
+        sync_kb_index()
+        kb_index = get_kb_index()
         
-        with open(kb_metadata_file, "r", encoding="utf-8") as f:
-            metadata = json.load(f)
-        
-        all_relevant_docs = []
-        
-        # 遍历所有支持的文档文件进行检索
-        supported_file_types = [".pdf", ".txt", ".docx", ".jpg", ".jpeg", ".png", ".gif"]
-        for file in metadata.get("files", []):
-            file_type = file["type"]
-            if file_type not in supported_file_types:
-                continue
-                
-            file_id = file["id"]
-            file_path = file["path"]
-            file_name = file["name"]
-            
-            # 获取或创建向量存储 - 确保只构建一次
-            if file_id not in vectorstore_cache:
-                try:
-                    # 根据文件类型选择合适的向量存储构建方法
-                    print(f"为文件 {file_name} 构建向量存储...")
-                    if file_type == ".pdf":
-                        vectorstore_cache[file_id] = build_vectorstore_from_pdf(file_path)
-                    elif file_type in [".jpg", ".jpeg", ".png", ".gif"]:
-                        # 对于图片文件，使用image_captioning生成描述并构建向量存储
-                        from multimodal.image_captioning import caption_image
-                        from langchain.schema import Document
-                        from langchain.vectorstores import FAISS
-                        from langchain.embeddings import HuggingFaceEmbeddings
-                        
-                        try:
-                            # 生成图片描述
-                            image_description = caption_image(file_path)
-                            
-                            # 创建文档对象
-                            doc = Document(
-                                page_content=f"这是一张图片。图片内容描述：{image_description}\n\n图片保存路径：{file_path}",
-                                metadata={
-                                    "source": file_path,
-                                    "file_name": file_name,
-                                    "file_type": file_type
-                                }
-                            )
-                            
-                            # 获取嵌入模型（使用缓存）
-                            embeddings = get_embeddings()
-                            
-                            # 构建向量存储
-                            vectorstore = FAISS.from_documents([doc], embeddings)
-                            vectorstore_cache[file_id] = vectorstore
-                            print(f"成功构建图片文件的向量存储")
-                        except Exception as image_err:
-                            print(f"处理图片文件失败: {str(image_err)}")
-                            continue
-                    else:
-                        vectorstore_cache[file_id] = build_vectorstore_from_document(file_path)
-                    print(f"文件 {file_name} 向量存储已缓存，后续查询将直接使用缓存")
-                except Exception as e:
-                    print(f"构建向量存储失败 ({file_name}): {str(e)}")
-                    continue
-            else:
-                # 记录缓存使用情况，以便调试
-                print(f"使用缓存的向量存储处理文件: {file_name}")
-                
-            # 执行相似度检索
-            vs = vectorstore_cache[file_id]
-            results = vs.similarity_search_with_score(query, k=k)
-            
-            # 将结果添加到相关文档列表
-            for doc, score in results:
-                # 只添加相似度足够高的文档
-                if score < SIMILARITY_THRESHOLD:
-                    # 添加文档来源信息，方便用户了解信息出处
-                    source_info = f"【来自文件: {file_name}】\n"
-                    all_relevant_docs.append((source_info + doc.page_content, score))
+        # 执行相似度检索
+        results = kb_index.search(query, k=k, file_ids=file_ids, file_types=file_types)
         
-        # 按相似度排序并取前k个结果
-        all_relevant_docs.sort(key=lambda x: x[1])
-        top_docs = [doc for doc, _ in all_relevant_docs[:k]]
+        top_docs = []
+        source_file_ids = []
+        for doc, score in results:
+            # 只添加相似度足够高的文档；关键词直接命中的文档没有向量距离（None），视为相关
+            if score is None or score < SIMILARITY_THRESHOLD:
+                # 添加文档来源信息，方便用户了解信息出处
+                source_info = f"【来自文件: {doc.metadata.get('file_name', '未知')}】\n"
+                top_docs.append(source_info + doc.page_content)
+                if doc.metadata.get("file_id") not in source_file_ids:
+                    source_file_ids.append(doc.metadata.get("file_id"))
         
         # 合并文档内容，如果没有找到相关文档，返回提示信息
         if top_docs:
-            return "\n\n".join(top_docs)
+            return "\n\n".join(top_docs), source_file_ids
         else:
-            return "知识库中未找到与查询相关的内容。"
+            return "知识库中未找到与查询相关的内容。", []
     except Exception as e:
         print(f"检索知识库失败: {str(e)}")
-        return "知识库检索过程中发生错误。"
+        return "知识库检索过程中发生错误。", []
+
+
+def retrieve_knowledge(query: str, k: int = 3, file_ids: Optional[List[str]] = None,
+                       file_types: Optional[List[str]] = None) -> str:
+    """
+    从知识库中检索与查询相关的文档
+    
+    参数 query: 查询文本
+    参数 k: 返回的相关文档数量
+    参数 file_ids: 只在这些文件中检索，可选
+    参数 file_types: 只在这些类型的文件中检索，可选
+    返回值: 检索到的文档内容，用换行符分隔，包含文档来源信息
+    """
+    return retrieve_knowledge_with_sources(query, k, file_ids, file_types)[0]
+
+
+def knowledge_affected(query: str, embedding, file_ids: List[str]) -> bool:
+    """
+    判断新加入的文件是否会出现在该问题的知识库检索结果中，用于回答缓存失效
+
+    参数 query: 问题
+    参数 embedding: 问题向量
+    参数 file_ids: 新加入的文件ID列表
+    返回值: 新文件中有与问题足够相关的分片时返回True
+    """
+    from tools.lexical_index import is_keyword_query, keyword_match_query
+    kb_index = get_kb_index()
+    if is_keyword_query(query) and kb_index.search_lexical(keyword_match_query(query), 1, file_ids=file_ids):
+        return True
+    results = kb_index.search_by_vector(embedding, 1, file_ids=file_ids)
+    return bool(results) and results[0][1] < SIMILARITY_THRESHOLD
+
+
+def sync_response_cache():
+    """
+    使对话回答缓存与知识库统一索引对齐，索引版本未变化时跳过
+
+    需要对每条缓存回答做一次知识库检索，由索引任务在发布新段后调用，或由 response_cache_synced 放到后台线程执行
+    """
+    from cache.response_cache import response_cache
+    if not response_cache.enabled:
+        return
+    kb_index = get_kb_index()
+    try:
+        response_cache.sync_files(kb_index.file_versions, knowledge_affected, revision=kb_index.revision())
+    except Exception as e:
+        print(f"回答缓存与知识库对齐失败: {str(e)}")
+
+
+# 回答缓存后台对齐线程，其他worker发布了新段时在这里对齐，不占用请求线程
+_response_cache_sync_executor = None
+_response_cache_sync_future = None
+_response_cache_sync_lock = threading.Lock()
+
+
+def response_cache_synced() -> bool:
+    """
+    检查对话回答缓存是否已与知识库统一索引对齐，未对齐时提交后台对齐任务后立即返回
+
+    返回值: 已对齐时返回True；未对齐时返回False，本次请求不应查询缓存
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from cache.response_cache import response_cache
+    global _response_cache_sync_executor, _response_cache_sync_future
+    if response_cache.is_synced(get_kb_index().revision()):
+        return True
+    with _response_cache_sync_lock:
+        if _response_cache_sync_future is None or _response_cache_sync_future.done():
+            if _response_cache_sync_executor is None:
+                _response_cache_sync_executor = ThreadPoolExecutor(max_workers=1,
+                                                                   thread_name_prefix="response-cache-sync")
+            _response_cache_sync_future = _response_cache_sync_executor.submit(sync_response_cache)
+    return False
 
 
 def retrieve_doc(query: str) -> str:
     """
-    从向量存储中检索相关文档
+    从预设PDF文档中检索相关文档
+
+    条款号等标识符为主的查询先用关键词检索，命中时不计算查询向量；
+    其他查询把向量检索和BM25检索的结果按倒数排名融合
     """
     try:
-        docs = retriever.get_relevant_documents(query)
+        from tools.lexical_index import (KB_LEXICAL_SEARCH, LEXICAL_CANDIDATE_FACTOR, is_keyword_query,
+                                         keyword_match_query, reciprocal_rank_fusion, text_match_query)
+        retriever = get_retriever()
+        k = retriever.search_kwargs.get("k", 4)
+        docs = []
+        if KB_LEXICAL_SEARCH:
+            lexical_index = get_pdf_lexical_index()
+            if is_keyword_query(query):
+                docs = [doc for doc, _ in lexical_index.search(keyword_match_query(query), k)]
+            if not docs:
+                dense = [doc for doc, _ in retriever.vectorstore.similarity_search_with_score(
+                    query, k=k * LEXICAL_CANDIDATE_FACTOR)]
+                lexical = [doc for doc, _ in lexical_index.search(text_match_query(query),
+                                                                   k * LEXICAL_CANDIDATE_FACTOR)]
+                by_text = {doc.page_content: doc for doc in dense + lexical}
+                ranked = reciprocal_rank_fusion([[doc.page_content for doc in dense],
+                                                 [doc.page_content for doc in lexical]])
+                docs = [by_text[text] for text in ranked[:k]]
+        else:
+            docs = retriever.get_relevant_documents(query)
         result = "\n\n".join([doc.page_content for doc in docs])
         return result
     except Exception as e:
@@ -170,6 +240,11 @@ def build_agent():
     
     返回: 初始化完成的智能体实例
     """
+    from langchain.agents import Tool, initialize_agent, AgentType
+    from agents.llm_clients import get_chat_model
+    from memory.memory import memory
+    from tools.search_tool import search_web, asearch_web
+    
     max_retries = 3
     retry_delay = 2  # 秒
     
@@ -185,16 +260,19 @@ def build_agent():
                 Tool(
                     name="Web Search",
                     func=search_web,
+                    coroutine=asearch_web,
                     description="当用户需要最新的、实时的信息或文档中没有的信息时使用此工具。输入应该是一个搜索查询。",
                 ),
             ]
 
-            # 初始化LLM模型
-            llm = ChatOpenAI(
+            # 获取共享的LLM客户端，重试和重建agent时复用同一个模型实例和HTTP连接池
+            llm = get_chat_model(
                 model='gemini-2.5-flash',
-                openai_api_key=os.getenv('GOOGLE_API_KEY'),
-                openai_api_base='https://generativelanguage.googleapis.com/v1beta/openai/',
+                api_key_env='GOOGLE_API_KEY',
+                base_url='https://generativelanguage.googleapis.com/v1beta/openai/',
                 temperature=0,
+                # 流式生成，/chat/stream 可以逐token转发；invoke 仍返回完整结果
+                streaming=True,
             )
 
             # 定义系统提示
@@ -242,6 +320,9 @@ def build_agent():
                 print("所有重试均失败，创建回退Agent")
                 # 创建一个简单的回退agent以确保服务能够启动
                 class SimpleAgent:
+                    # 回退agent不调用模型，就绪检查据此判断服务未就绪
+                    is_fallback = True
+
                     def invoke(self, query: str, history: Optional[List[Dict[str, str]]] = None) -> str:
                         if isinstance(query, dict) and "input" in query:
                             user_query = query["input"]
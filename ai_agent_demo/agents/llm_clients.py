@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+@File    : llm_clients.py
+@Time    : 2025/10/19 10:30
+@Desc    : 共享的LLM客户端，同一配置的ChatOpenAI只创建一次，所有模型共用带连接池的HTTP客户端
+"""
+import os
+import threading
+
+# 每个HTTP客户端保持的最大连接数和空闲连接数
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "20"))
+LLM_MAX_KEEPALIVE = int(os.getenv("LLM_MAX_KEEPALIVE", "10"))
+# LLM请求超时时间（秒）
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+
+_http_client = None
+_http_async_client = None
+_chat_models = {}
+_lock = threading.Lock()
+
+
+def _http_limits():
+    import httpx
+    return httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_KEEPALIVE)
+
+
+def get_http_clients():
+    """
+    获取共享的同步和异步HTTP客户端，首次调用时创建
+
+    返回值: (httpx.Client, httpx.AsyncClient)
+    """
+    global _http_client, _http_async_client
+    if _http_client is None:
+        import httpx
+        with _lock:
+            if _http_client is None:
+                _http_async_client = httpx.AsyncClient(limits=_http_limits(), timeout=LLM_TIMEOUT)
+                _http_client = httpx.Client(limits=_http_limits(), timeout=LLM_TIMEOUT)
+    return _http_client, _http_async_client
+
+
+def get_chat_model(model, api_key_env, base_url, temperature=0, streaming=False, callbacks=None):
+    """
+    获取共享的ChatOpenAI客户端，相同配置只创建一次
+
+    参数 model: 模型名称
+    参数 api_key_env: 保存API密钥的环境变量名
+    参数 base_url: OpenAI兼容接口地址
+    参数 temperature: 生成温度
+    参数 streaming: 是否流式生成
+    参数 callbacks: 回调列表（如LangSmith追踪），参与缓存键，按对象区分
+    返回值: ChatOpenAI实例
+    """
+    key = (model, api_key_env, base_url, temperature, streaming, tuple(id(cb) for cb in callbacks or ()))
+    chat_model = _chat_models.get(key)
+    if chat_model is None:
+        from langchain_openai import ChatOpenAI
+        http_client, http_async_client = get_http_clients()
+        with _lock:
+            chat_model = _chat_models.get(key)
+            if chat_model is None:
+                chat_model = ChatOpenAI(
+                    model=model,
+                    openai_api_key=os.getenv(api_key_env),
+                    openai_api_base=base_url,
+                    temperature=temperature,
+                    streaming=streaming,
+                    callbacks=callbacks,
+                    timeout=LLM_TIMEOUT,
+                    http_client=http_client,
+                    http_async_client=http_async_client,
+                )
+                _chat_models[key] = chat_model
+    return chat_model
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+@File    : concurrency.py
+@Time    : 2025/10/17 16:50
+@Desc    : 对话请求并发控制，检索和agent调用放到有界线程池中执行，不阻塞事件循环
+"""
+import os
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# 同时执行的对话请求数量上限（检索 + agent调用）
+CHAT_MAX_CONCURRENCY = int(os.getenv("CHAT_MAX_CONCURRENCY", "8"))
+# 等待执行槽位的最长时间（秒），超时返回忙碌，0表示一直等待
+CHAT_QUEUE_TIMEOUT = float(os.getenv("CHAT_QUEUE_TIMEOUT", "60"))
+
+
+class ChatBusyError(Exception):
+    """等待执行槽位超时"""
+
+
+class BlockingTaskRunner:
+    """
+    有界阻塞任务执行器
+
+    同步的嵌入计算和LLM网络调用在专用线程池中执行，事件循环只负责等待结果；
+    信号量限制同时执行的任务数，超出上限的请求在事件循环中排队，不占用线程
+    """
+
+    def __init__(self, max_concurrency=CHAT_MAX_CONCURRENCY, queue_timeout=CHAT_QUEUE_TIMEOUT):
+        """
+        参数 max_concurrency: 同时执行的任务数量上限
+        参数 queue_timeout: 等待执行槽位的最长时间（秒），0表示一直等待
+        """
+        self.max_concurrency = max(1, max_concurrency)
+        self.queue_timeout = queue_timeout
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="chat-worker")
+        # 信号量与事件循环绑定，首次在事件循环中使用时创建
+        self._semaphore = None
+        self._lock = threading.Lock()
+        self._running = 0
+        self._waiting = 0
+
+    def _get_semaphore(self):
+        """获取当前事件循环中的信号量"""
+        with self._lock:
+            if self._semaphore is None:
+                self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            return self._semaphore
+
+    async def run(self, func, *args, **kwargs):
+        """
+        在线程池中执行同步函数
+
+        参数 func: 同步函数
+        返回值: 函数返回值
+        异常: 等待槽位超时时抛出ChatBusyError
+        """
+        semaphore = self._get_semaphore()
+        self._waiting += 1
+        try:
+            if self.queue_timeout > 0:
+                await asyncio.wait_for(semaphore.acquire(), timeout=self.queue_timeout)
+            else:
+                await semaphore.acquire()
+        except asyncio.TimeoutError:
+            raise ChatBusyError(f"当前对话请求过多，等待超过 {self.queue_timeout} 秒")
+        finally:
+            self._waiting -= 1
+
+        self._running += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, lambda: func(*args, **kwargs))
+        finally:
+            self._running -= 1
+            semaphore.release()
+
+    def stats(self):
+        """
+        返回执行器状态
+
+        返回值: 包含并发上限、执行中和排队中任务数的字典
+        """
+        return {
+            "max_concurrency": self.max_concurrency,
+            "running": self._running,
+            "waiting": self._waiting,
+        }
+
+    def shutdown(self):
+        """关闭线程池"""
+        self._executor.shutdown(wait=False)
+
+
+# 全局对话任务执行器
+chat_runner = BlockingTaskRunner()
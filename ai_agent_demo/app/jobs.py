@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+@File    : jobs.py
+@Time    : 2025/10/17 14:30
+@Desc    : 知识库索引任务队列，上传接口只负责保存文件并提交任务，向量化在后台工作线程中完成
+"""
+import os
+import sys
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+# 添加项目根目录到Python路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 后台索引工作线程数量
+INGEST_NUM_WORKERS = int(os.getenv("INGEST_NUM_WORKERS", "2"))
+# 最多保留的任务记录数，超出后丢弃最早已结束的任务
+MAX_JOB_HISTORY = int(os.getenv("INGEST_MAX_JOB_HISTORY", "1000"))
+
+# 任务状态
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+
+
+class IngestJobQueue:
+    """
+    知识库索引任务队列
+
+    每个任务负责一个文件：构建（或从磁盘加载）向量存储并并入知识库统一索引。
+    任务完成后文件立即可被检索，任务状态可通过 get 查询
+    """
+
+    def __init__(self, num_workers=INGEST_NUM_WORKERS):
+        """
+        参数 num_workers: 后台工作线程数量
+        """
+        self._executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="kb-ingest")
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, file_id, file_path, file_type, file_name, update=False):
+        """
+        提交索引任务
+
+        参数 file_id: 知识库文件ID
+        参数 file_path: 文件路径
+        参数 file_type: 文件扩展名
+        参数 file_name: 原始文件名
+        参数 update: True表示文件内容已更新，只重新嵌入变化的页面
+        返回值: 任务ID
+        """
+        from tools.kb_index import get_kb_index
+
+        job_id = str(uuid.uuid4())
+        job = {
+            "job_id": job_id,
+            "file_id": file_id,
+            "file_name": file_name,
+            "update": update,
+            "status": JOB_QUEUED,
+            "stage": "等待处理",
+            "chunks_embedded": 0,
+            "chunks_indexed": 0,
+            "chunks_kept": 0,
+            "chunks_removed": 0,
+            "error": None,
+            "created_at": datetime.now().isoformat(),
+            "started_at": None,
+            "finished_at": None,
+        }
+        with self._lock:
+            self._jobs[job_id] = job
+            self._trim_history()
+        # 标记为处理中，检索时不会在请求内重复构建该文件
+        get_kb_index().mark_pending(file_id)
+        self._executor.submit(self._run, job_id, file_id, file_path, file_type, file_name, update)
+        return job_id
+
+    def get(self, job_id):
+        """
+        查询任务状态
+
+        参数 job_id: 任务ID
+        返回值: 任务信息字典的副本，不存在时返回None
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def is_active(self, file_id):
+        """
+        判断文件是否有排队中或执行中的索引任务
+
+        参数 file_id: 知识库文件ID
+        返回值: 存在未结束的任务时返回True
+        """
+        with self._lock:
+            return any(job["file_id"] == file_id and job["status"] in (JOB_QUEUED, JOB_RUNNING)
+                       for job in self._jobs.values())
+
+    def _update(self, job_id, **fields):
+        """更新任务字段"""
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id].update(fields)
+
+    def _trim_history(self):
+        """丢弃最早已结束的任务记录，调用方需持有锁"""
+        if len(self._jobs) <= MAX_JOB_HISTORY:
+            return
+        for job_id in list(self._jobs):
+            if len(self._jobs) <= MAX_JOB_HISTORY:
+                break
+            if self._jobs[job_id]["status"] in (JOB_SUCCEEDED, JOB_FAILED):
+                del self._jobs[job_id]
+
+    def _run(self, job_id, file_id, file_path, file_type, file_name, update=False):
+        """在工作线程中执行索引任务"""
+        from tools.kb_index import get_kb_index
+        from tools.kb_catalog import get_kb_catalog
+        from cache.vector_cache import vectorstore_cache
+        from agents.base_agent import sync_response_cache
+
+        kb_index = get_kb_index()
+        self._update(job_id, status=JOB_RUNNING, stage="解析与嵌入", started_at=datetime.now().isoformat())
+        progress_callback = lambda count: self._update(job_id, chunks_embedded=count)
+        try:
+            if update:
+                kept, chunks, removed = kb_index.update_file(file_id, file_path, file_type, file_name,
+                                                             progress_callback=progress_callback)
+                self._update(job_id, chunks_kept=kept, chunks_removed=removed)
+            else:
+                chunks = kb_index.index_file(file_id, file_path, file_type, file_name,
+                                             progress_callback=progress_callback)
+            # 索引期间文件可能已被删除（删除时该文件的分片尚未写入），此时移除刚写入的分片
+            if get_kb_catalog().get(file_id) is None:
+                vectorstore_cache.pop(file_id)
+                kb_index.delete_file(file_id)
+                raise RuntimeError("文件已在索引期间被删除")
+            # 在任务线程中使相关的缓存回答失效，请求线程无需逐条检查缓存
+            self._update(job_id, stage="更新回答缓存")
+            sync_response_cache()
+            self._update(job_id, status=JOB_SUCCEEDED, stage="完成", chunks_indexed=chunks,
+                         finished_at=datetime.now().isoformat())
+            print(f"索引任务完成: {file_name} ({chunks} 个分片)")
+        except Exception as e:
+            self._update(job_id, status=JOB_FAILED, stage="失败", error=str(e),
+                         finished_at=datetime.now().isoformat())
+            print(f"索引任务失败 ({file_name}): {str(e)}")
+        finally:
+            kb_index.mark_pending(file_id, False)
+
+
+# 全局任务队列实例
+_ingest_queue = None
+_ingest_queue_lock = threading.Lock()
+
+
+def get_ingest_queue():
+    """
+    获取全局知识库索引任务队列
+
+    返回值: IngestJobQueue实例
+    """
+    global _ingest_queue
+    with _ingest_queue_lock:
+        if _ingest_queue is None:
+            _ingest_queue = IngestJobQueue()
+        return _ingest_queue
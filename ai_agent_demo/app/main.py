@@ -1,36 +1,51 @@
 import sys
 import os
+import time
 import uuid
 import json
+import asyncio
+import threading
 from datetime import datetime
 
+# 记录模块导入开始时间，用于启动耗时报告
+_import_start_time = time.time()
+
 # 设置Python搜索路径
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 # 导入必要的模块
 import uvicorn
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from typing import List, Dict, Any, Optional
 
 # 导入必要的模块
-from agents.base_agent import build_agent
-from tools.vectorstore import build_vectorstore_from_pdf, build_vectorstore_from_document
+from agents.base_agent import build_agent, sync_kb_index, SUPPORTED_KB_FILE_TYPES
 # 导入全局向量存储缓存
 from cache.vector_cache import vectorstore_cache
+from cache.response_cache import response_cache
+from app.jobs import get_ingest_queue
+from app.uploads import save_upload_file, remove_file_quietly, cleanup_temp_dir
+from app.startup import startup_tracker, start_warmup, STARTUP_WARMUP, PHASE_FAILED
+from app.concurrency import chat_runner, ChatBusyError
+from app.streaming import AgentStreamHandler, sse_event
+from tools.kb_index import get_kb_index
+from tools.kb_catalog import get_kb_catalog, MAX_PAGE_SIZE
+
+startup_tracker.record("imports", time.time() - _import_start_time)
 
 # 创建知识库相关目录
 agent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 kb_dir = os.path.join(agent_dir, "knowledge_base")
-kb_metadata_file = os.path.join(kb_dir, "metadata.json")
+temp_dir = os.path.join(agent_dir, "temp")
 os.makedirs(kb_dir, exist_ok=True)
 
-# 初始化知识库元数据
-if not os.path.exists(kb_metadata_file):
-    with open(kb_metadata_file, "w", encoding="utf-8") as f:
-        json.dump({"files": []}, f, ensure_ascii=False, indent=2)
+# 上传文件生成回复时读取的内容摘要字符数，以及PDF最多读取的页数（避免扫描版PDF为凑满字符数解析全部页面）
+UPLOAD_PREVIEW_CHARS = int(os.getenv("UPLOAD_PREVIEW_CHARS", "1000"))
+UPLOAD_PREVIEW_MAX_PAGES = int(os.getenv("UPLOAD_PREVIEW_MAX_PAGES", "20"))
 
 # 全局向量存储缓存（使用进程内缓存）
 # vectorstore_cache = {}
@@ -55,92 +70,314 @@ static_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
 os.makedirs(static_dir, exist_ok=True)
 app.mount("/static", StaticFiles(directory=static_dir), name="static")
 
-# 初始化agent
-try:
-    agent = build_agent()
-except Exception as e:
-    # 创建一个简单的回退agent以确保服务能够启动
-    class SimpleAgent:
-        def invoke(self, query: str, history: Optional[List[Dict[str, str]]] = None) -> str:
-            if history and len(history) > 0:
-                return f"Agent服务正在初始化中，您的查询 '{query}' 已收到，且我们检测到您有{len(history)}条历史消息。"
-            return f"Agent服务正在初始化中，您的查询 '{query}' 已收到"
-    agent = SimpleAgent()
+# agent在后台预热或首次请求时初始化，导入本模块不会加载模型
+agent = None
+_agent_lock = threading.Lock()
+
+
+def get_agent():
+    """
+    获取全局agent实例，首次调用时构建
+    
+    返回值: agent实例，构建失败时返回回退agent以确保服务能够响应
+    """
+    global agent
+    if agent is None:
+        with _agent_lock:
+            if agent is None:
+                try:
+                    agent = build_agent()
+                except Exception as e:
+                    print(f"构建agent失败，使用回退agent: {str(e)}")
+                    # 创建一个简单的回退agent以确保服务能够启动
+                    class SimpleAgent:
+                        # 回退agent不调用模型，就绪检查据此判断服务未就绪
+                        is_fallback = True
+
+                        def invoke(self, query: str, history: Optional[List[Dict[str, str]]] = None) -> str:
+                            if history and len(history) > 0:
+                                return f"Agent服务正在初始化中，您的查询 '{query}' 已收到，且我们检测到您有{len(history)}条历史消息。"
+                            return f"Agent服务正在初始化中，您的查询 '{query}' 已收到"
+                    agent = SimpleAgent()
+    return agent
+
+
+def _warmup_knowledge_base():
+    """加载知识库统一索引并与知识库目录对齐"""
+    sync_kb_index()
+
+
+def _warmup_embeddings():
+    """加载嵌入模型"""
+    from tools.vectorstore import get_embeddings
+    get_embeddings()
+
+
+def _warmup_pdf_retriever():
+    """构建预设PDF文档检索器"""
+    from agents.base_agent import get_retriever
+    get_retriever()
+
+
+# 启动预热步骤，按顺序执行；agent就绪后服务即可接收请求
+WARMUP_STEPS = [
+    ("agent", get_agent),
+    ("embeddings", _warmup_embeddings),
+    ("knowledge_base", _warmup_knowledge_base),
+    ("pdf_retriever", _warmup_pdf_retriever),
+]
+
+@app.on_event("startup")
+async def warmup():
+    # 默认在后台线程中预热，服务启动不等待模型和索引加载
+    start_warmup(WARMUP_STEPS)
+
+@app.on_event("startup")
+async def cleanup_temp_files():
+    # 清理历史遗留的临时上传文件
+    cleanup_temp_dir(temp_dir)
 
 class Query(BaseModel):
     query: str
     history: Optional[List[Dict[str, str]]] = None
 
+KNOWLEDGE_PROMPT = "\n\n以下是与问题相关的知识库内容:\n{knowledge_content}\n\n请优先基于提供的知识库内容回答用户问题。如果知识库内容不足或不相关，可以结合你自己的知识进行回答，但要明确说明信息来源。"
+NO_KNOWLEDGE_PROMPT = "\n\n没有找到相关的知识库内容。"
+
+
+def _retrieve_chat_knowledge(user_message: str):
+    """从知识库中检索与问题相关的内容，返回 (内容, 来源文件ID列表)"""
+    from agents.base_agent import retrieve_knowledge_with_sources
+    knowledge_content, source_file_ids = retrieve_knowledge_with_sources(user_message)
+    print(f"知识库检索结果长度: {len(knowledge_content) if knowledge_content else 0} 字符")
+    return knowledge_content, source_file_ids
+
+
+def _lookup_cached_answer(user_message: str):
+    """
+    计算问题向量并查找相似问题的缓存回答
+
+    参数 user_message: 用户问题
+    返回值: (问题向量, 缓存记录)，未命中时缓存记录为None，向量计算失败时两者均为None
+    """
+    from tools.vectorstore import get_embeddings
+    from agents.base_agent import response_cache_synced
+    try:
+        # 查询向量有LRU缓存，随后的知识库检索不会重复计算
+        embedding = get_embeddings().embed_query(user_message)
+        # 知识库变化后缓存在后台对齐，对齐完成前不使用缓存，避免返回过期回答
+        if not response_cache_synced():
+            return embedding, None
+    except Exception as e:
+        print(f"回答缓存不可用: {str(e)}")
+        return None, None
+    return embedding, response_cache.lookup(embedding, user_message)
+
+
+def _build_chat_input(agent, user_message: str, history: Optional[List[Dict[str, str]]], knowledge_content: str) -> str:
+    """
+    将历史对话、当前问题和知识库内容合并为agent的单一输入字符串，/chat 和 /chat/stream 共用
+
+    参数 agent: agent实例
+    参数 user_message: 用户问题
+    参数 history: 历史对话
+    参数 knowledge_content: 知识库检索结果
+    返回值: agent输入
+    """
+    knowledge_available = len(knowledge_content) > 0 if knowledge_content else False
+    if hasattr(agent, 'invoke_with_history'):
+        # 构建一个单一的输入字符串，包含所有信息
+        if history and len(history) > 0:
+            formatted_input = "历史对话:\n"
+            for msg in history:
+                formatted_input += f"{msg['role']}: {msg['content']}\n"
+            formatted_input += f"\n当前问题: {user_message}\n"
+        else:
+            formatted_input = user_message
+    else:
+        # 对于不支持历史的agent，将所有信息合并到单一输入字符串
+        formatted_input = user_message
+        
+        # 添加历史信息
+        if history and len(history) > 0:
+            history_text = "历史对话:\n"
+            for msg in history:
+                history_text += f"{msg['role']}: {msg['content']}\n"
+            formatted_input = f"{history_text}\n当前问题: {user_message}"
+
+    # 添加知识库内容和说明
+    if knowledge_available:
+        formatted_input += KNOWLEDGE_PROMPT.format(knowledge_content=knowledge_content)
+    else:
+        formatted_input += NO_KNOWLEDGE_PROMPT
+    return formatted_input
+
+
+def _format_answer(response) -> str:
+    """提取agent响应中的回答文本，并添加Markdown支持"""
+    if isinstance(response, dict) and "output" in response:
+        answer = response["output"]
+    else:
+        answer = str(response)
+    
+    # 确保返回内容包含Markdown格式标记
+    # 如果没有标题，添加一个默认标题
+    if not (answer.startswith('#') or answer.startswith('##') or answer.startswith('###')):
+        answer = "# 回答\n\n" + answer
+    
+    # 确保段落之间有换行
+    answer = answer.replace('. ', '.\n\n').replace('? ', '?\n\n').replace('! ', '!\n\n')
+    return answer
+
+
+def _answer_chat(user_message: str, history: Optional[List[Dict[str, str]]] = None, callbacks=None):
+    """
+    检索知识库并调用agent生成回答，包含嵌入计算和LLM网络调用，在对话线程池中执行
+
+    参数 user_message: 用户问题
+    参数 history: 历史对话
+    参数 callbacks: LangChain回调列表，用于流式输出，可选
+    返回值: agent的原始响应
+    """
+    # 没有历史对话的问题与上下文无关，相似问题可以直接复用已生成的回答
+    embedding = None
+    if response_cache.enabled and not history:
+        embedding, cached = _lookup_cached_answer(user_message)
+        if cached is not None:
+            print(f"命中回答缓存 (相似度 {cached['similarity']:.3f}): {cached['query']}")
+            return {"output": cached["answer"], "cached": True}
+
+    knowledge_content, source_file_ids = _retrieve_chat_knowledge(user_message)
+
+    # 检查agent是否有支持历史的invoke方法
+    agent = get_agent()
+    formatted_input = _build_chat_input(agent, user_message, history, knowledge_content)
+    if hasattr(agent, 'invoke_with_history'):
+        response = agent.invoke_with_history(formatted_input, history or [])
+    # 只传递一个input键给agent.invoke
+    elif callbacks:
+        response = agent.invoke(formatted_input, config={"callbacks": callbacks})
+    else:
+        response = agent.invoke(formatted_input)
+
+    # 只缓存agent正常生成的回答，回退agent的提示信息不缓存
+    if embedding is not None and isinstance(response, dict) and "output" in response:
+        response_cache.store(user_message, embedding, response["output"], source_file_ids)
+    return response
+
+
 @app.post("/chat")
 async def chat(q: Query):
     try:
         user_message = q.query
         print(f"用户问题: {user_message}")
 
-        # 从知识库中检索相关文档
-        from agents.base_agent import retrieve_knowledge
-        knowledge_content = retrieve_knowledge(user_message)
-        knowledge_available = len(knowledge_content) > 0 if knowledge_content else False
-        print(f"知识库检索结果长度: {len(knowledge_content) if knowledge_content else 0} 字符")
-
-        # 检查agent是否有支持历史的invoke方法
-        if hasattr(agent, 'invoke_with_history'):
-            # 构建一个单一的输入字符串，包含所有信息
-            if q.history and len(q.history) > 0:
-                formatted_input = "历史对话:\n"
-                for msg in q.history:
-                    formatted_input += f"{msg['role']}: {msg['content']}\n"
-                formatted_input += f"\n当前问题: {user_message}\n"
-            else:
-                formatted_input = user_message
-            
-            # 添加知识库内容和说明
-            if knowledge_available:
-                formatted_input += f"\n\n以下是与问题相关的知识库内容:\n{knowledge_content}\n\n请优先基于提供的知识库内容回答用户问题。如果知识库内容不足或不相关，可以结合你自己的知识进行回答，但要明确说明信息来源。"
-            else:
-                formatted_input += "\n\n没有找到相关的知识库内容。"
-                
-            response = agent.invoke_with_history(formatted_input, q.history or [])
-        else:
-            # 对于不支持历史的agent，将所有信息合并到单一输入字符串
-            formatted_input = user_message
-            
-            # 添加历史信息
-            if q.history and len(q.history) > 0:
-                history_text = "历史对话:\n"
-                for msg in q.history:
-                    history_text += f"{msg['role']}: {msg['content']}\n"
-                formatted_input = f"{history_text}\n当前问题: {user_message}"
-            
-            # 添加知识库内容和说明
-            if knowledge_available:
-                formatted_input += f"\n\n以下是与问题相关的知识库内容:\n{knowledge_content}\n\n请优先基于提供的知识库内容回答用户问题。如果知识库内容不足或不相关，可以结合你自己的知识进行回答，但要明确说明信息来源。"
-            else:
-                formatted_input += "\n\n没有找到相关的知识库内容。"
-            
-            # 只传递一个input键给agent.invoke
-            response = agent.invoke(formatted_input)
+        # 检索和agent调用在有界线程池中执行，事件循环可以继续处理其他连接
+        response = await chat_runner.run(_answer_chat, user_message, q.history)
 
         # 格式化响应，并添加Markdown支持
-        if isinstance(response, dict) and "output" in response:
-            answer = response["output"]
-        else:
-            answer = str(response)
-        
-        # 确保返回内容包含Markdown格式标记
-        # 如果没有标题，添加一个默认标题
-        if not (answer.startswith('#') or answer.startswith('##') or answer.startswith('###')):
-            answer = "# 回答\n\n" + answer
-        
-        # 确保段落之间有换行
-        answer = answer.replace('. ', '.\n\n').replace('? ', '?\n\n').replace('! ', '!\n\n')
+        answer = _format_answer(response)
 
         print(f"助手回答: {answer}")
         return {"response": answer}
+    except ChatBusyError as e:
+        print(f"对话请求排队超时: {str(e)}")
+        return JSONResponse(status_code=503, content={"response": f"服务繁忙，请稍后重试: {str(e)}", "error": str(e)})
     except Exception as e:
         print(f"处理聊天请求时出错: {str(e)}")
         return {"response": f"处理请求时出错: {str(e)}", "error": str(e)}
 
+@app.post("/chat/stream")
+async def chat_stream(q: Query):
+    """
+    流式对话接口（Server-Sent Events）
+
+    事件类型:
+    - step: agent中间步骤，调用工具（type=action）或工具返回（type=observation）
+    - token: LLM新生成的token，answer 字段为其中属于最终答案的部分
+    - done: 运行结束，response 为与 /chat 相同格式的完整回答
+    - error: 出错或服务繁忙
+    """
+    user_message = q.query
+    print(f"用户问题(流式): {user_message}")
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    handler = AgentStreamHandler(loop, queue)
+    task = asyncio.ensure_future(chat_runner.run(_answer_chat, user_message, q.history, [handler]))
+    # 运行结束时放入结束标记
+    task.add_done_callback(lambda _: queue.put_nowait(None))
+
+    async def event_stream():
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                event, data = item
+                yield sse_event(event, data)
+            try:
+                answer = _format_answer(task.result())
+                print(f"助手回答(流式): {answer}")
+                yield sse_event("done", {"response": answer})
+            except ChatBusyError as e:
+                yield sse_event("error", {"error": f"服务繁忙，请稍后重试: {str(e)}"})
+            except Exception as e:
+                print(f"处理流式聊天请求时出错: {str(e)}")
+                yield sse_event("error", {"error": f"处理请求时出错: {str(e)}"})
+        finally:
+            # 客户端提前断开时通知回调中止agent
+            handler.cancelled = True
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def _process_upload(process_file_path: str, kb_file_path: str, file_ext: str, file_size: int,
+                    conversation_history: List[Dict[str, str]]):
+    """
+    解析上传文件并调用agent生成回复，包含图片描述模型推理和LLM网络调用，在对话线程池中执行
+
+    参数 process_file_path: 本次处理使用的文件路径
+    参数 kb_file_path: 知识库中的文件路径
+    参数 file_ext: 文件扩展名
+    参数 file_size: 文件大小（字节）
+    参数 conversation_history: 历史对话
+    返回值: agent的响应
+    """
+    # 对于图片文件，使用image_captioning生成描述
+    if file_ext in ['.jpg', '.jpeg', '.png', '.gif']:
+        from multimodal.image_captioning import caption_image
+        try:
+            image_description = caption_image(process_file_path)
+            file_content = f"这是一张图片。图片内容描述：{image_description}\n\n图片保存路径：{kb_file_path}"
+            prompt = f"用户上传了一张图片，请根据图片描述回答问题。图片描述：{image_description}\n\n用户可能的问题是什么？"
+        except Exception as e:
+            file_content = f"图片处理失败：{str(e)}\n\n图片保存路径：{kb_file_path}"
+            prompt = f"用户上传了一张图片，但处理失败：{str(e)}"
+    # 对于PDF/TXT/DOCX文件，使用doc_reader读取开头部分作为摘要，读够即停止，不解析整个文件
+    elif file_ext in ['.pdf', '.txt', '.docx']:
+        from tools.doc_reader import read_document_text
+        file_label = file_ext[1:].upper()
+        try:
+            preview = read_document_text(process_file_path, max_chars=UPLOAD_PREVIEW_CHARS,
+                                         max_pages=UPLOAD_PREVIEW_MAX_PAGES)
+            file_content = preview + "...（更多内容请查看完整文件）"
+            prompt = f"请阅读以下{file_label}文件内容摘要，并准备回答用户可能的问题：\n{file_content}"
+        except Exception as e:
+            file_content = f"{file_label}文件处理失败：{str(e)}\n\n文件保存路径：{kb_file_path}"
+            prompt = f"用户上传了一个{file_label}文件，但处理失败：{str(e)}"
+    else:
+        file_content = f"文件类型：{file_ext}\n文件大小：{file_size}字节\n文件保存路径：{kb_file_path}"
+        prompt = f"用户上传了一个{file_ext}文件，请准备回答用户可能的问题。"
+
+    # 调用agent处理文件
+    agent = get_agent()
+    if hasattr(agent, 'invoke_with_history'):
+        response = agent.invoke_with_history(prompt, conversation_history)
+    else:
+        response = agent.invoke(prompt)
+    return response
+
+
 @app.post("/upload")
 async def upload_file(file: UploadFile = File(...), history: Optional[str] = Form(None)):
     try:
@@ -152,89 +389,59 @@ async def upload_file(file: UploadFile = File(...), history: Optional[str] = For
             except:
                 pass
         
-        # 确保temp目录存在
-        temp_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "temp")
-        os.makedirs(temp_dir, exist_ok=True)
-        
-        # 确保knowledge_base目录存在
-        kb_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "knowledge_base")
-        os.makedirs(kb_dir, exist_ok=True)
-        
-        # 保存上传的文件到temp目录（用于临时处理）
-        temp_file_path = os.path.join(temp_dir, f"temp_{os.path.basename(file.filename)}")
-        content = await file.read()
-        with open(temp_file_path, "wb") as f:
-            f.write(content)
-        
-        # 同时保存文件到knowledge_base目录并添加到知识库
-        file_id = str(uuid.uuid4())
-        kb_file_path = os.path.join(kb_dir, f"{file_id}_{os.path.basename(file.filename)}")
-        with open(kb_file_path, "wb") as f:
-            f.write(content)
+        # 获取文件类型
+        file_ext = os.path.splitext(file.filename)[1].lower()
         
-        # 更新知识库元数据，确保文件可以被检索到
+        # 检查是否已存在同名文件，防止重复上传
+        existing_file = None
         try:
-            with open(kb_metadata_file, "r+", encoding="utf-8") as f:
-                metadata = json.load(f)
-                
-                # 检查是否已存在同名文件，防止重复上传
-                existing_file = next((f for f in metadata["files"] if f["name"] == file.filename), None)
-                if existing_file:
-                    print(f"文件已存在于知识库中: {file.filename}，跳过重复添加")
-                    # 复用已存在的file_id，避免创建新的向量存储
-                    file_id = existing_file["id"]
-                    kb_file_path = existing_file["path"]
-                else:
-                    # 获取文件类型
-                    file_ext = os.path.splitext(file.filename)[1].lower()
-                    # 添加新文件到元数据
-                    metadata["files"].append({
-                        "id": file_id,
-                        "name": file.filename,
-                        "path": kb_file_path,
-                        "size": len(content),
-                        "upload_time": datetime.now().isoformat(),
-                        "type": file_ext
-                    })
-                    f.seek(0)
-                    json.dump(metadata, f, ensure_ascii=False, indent=2)
-                    f.truncate()
-                    print(f"文件已添加到知识库: {file.filename}")
+            existing_file = get_kb_catalog().find_by_name(file.filename)
         except Exception as meta_err:
-            print(f"更新知识库元数据失败: {str(meta_err)}")
+            print(f"读取知识库目录失败: {str(meta_err)}")
         
-
-        
-        # 对于图片文件，使用image_captioning生成描述
-        if file_ext in ['.jpg', '.jpeg', '.png', '.gif']:
-            from multimodal.image_captioning import caption_image
-            try:
-                image_description = caption_image(temp_file_path)
-                file_content = f"这是一张图片。图片内容描述：{image_description}\n\n图片保存路径：{kb_file_path}"
-                prompt = f"用户上传了一张图片，请根据图片描述回答问题。图片描述：{image_description}\n\n用户可能的问题是什么？"
-            except Exception as e:
-                file_content = f"图片处理失败：{str(e)}\n\n图片保存路径：{kb_file_path}"
-                prompt = f"用户上传了一张图片，但处理失败：{str(e)}"
-        # 对于PDF文件，使用doc_reader读取内容
-        elif file_ext == '.pdf':
-            from tools.doc_reader import load_pdf_content
-            try:
-                pdf_content = load_pdf_content(temp_file_path)
-                # 取PDF前1000个字符作为摘要
-                file_content = pdf_content[:1000] + "...（更多内容请查看完整文件）"
-                prompt = f"请阅读以下PDF文件内容摘要，并准备回答用户可能的问题：\n{file_content}"
-            except Exception as e:
-                file_content = f"PDF文件处理失败：{str(e)}\n\n文件保存路径：{kb_file_path}"
-                prompt = f"用户上传了一个PDF文件，但处理失败：{str(e)}"
+        temp_file_path = None
+        if existing_file:
+            print(f"文件已存在于知识库中: {file.filename}，跳过重复添加")
+            # 复用已存在的file_id，避免创建新的向量存储
+            file_id = existing_file["id"]
+            kb_file_path = existing_file["path"]
+            # 本次上传的内容只用于生成回复，写入temp目录，处理完成后删除
+            os.makedirs(temp_dir, exist_ok=True)
+            temp_file_path = os.path.join(temp_dir, f"temp_{uuid.uuid4()}_{os.path.basename(file.filename)}")
+            file_size, file_hash = await save_upload_file(file, temp_file_path)
+            process_file_path = temp_file_path
         else:
-            file_content = f"文件类型：{file_ext}\n文件大小：{len(content)}字节\n文件保存路径：{kb_file_path}"
-            prompt = f"用户上传了一个{file_ext}文件，请准备回答用户可能的问题。"
+            # 流式保存文件到knowledge_base目录并添加到知识库，只写一次
+            file_id = str(uuid.uuid4())
+            kb_file_path = os.path.join(kb_dir, f"{file_id}_{os.path.basename(file.filename)}")
+            file_size, file_hash = await save_upload_file(file, kb_file_path)
+            process_file_path = kb_file_path
+            
+            # 写入知识库目录，确保文件可以被检索到
+            try:
+                get_kb_catalog().add_file({
+                    "id": file_id,
+                    "name": file.filename,
+                    "path": kb_file_path,
+                    "size": file_size,
+                    "content_hash": file_hash,
+                    "upload_time": datetime.now().isoformat(),
+                    "type": file_ext
+                })
+                print(f"文件已添加到知识库: {file.filename}")
+                # 后台建立索引，完成后即可在知识库中检索到
+                if file_ext in SUPPORTED_KB_FILE_TYPES:
+                    get_ingest_queue().submit(file_id, kb_file_path, file_ext, file.filename)
+            except Exception as meta_err:
+                print(f"更新知识库目录失败: {str(meta_err)}")
         
-        # 调用agent处理文件
-        if hasattr(agent, 'invoke_with_history'):
-            response = agent.invoke_with_history(prompt, conversation_history)
-        else:
-            response = agent.invoke(prompt)
+        try:
+            # 文件解析和agent调用在有界线程池中执行，不阻塞事件循环
+            response = await chat_runner.run(_process_upload, process_file_path, kb_file_path, file_ext,
+                                             file_size, conversation_history)
+        finally:
+            # 临时副本处理完即删除，不在temp目录中累积
+            remove_file_quietly(temp_file_path)
         
         # 返回包含文件路径的响应，以便前端可以预览
         return {
@@ -242,6 +449,8 @@ async def upload_file(file: UploadFile = File(...), history: Optional[str] = For
             "file_path": kb_file_path,
             "file_type": file_ext
         }
+    except ChatBusyError as e:
+        return JSONResponse(status_code=503, content={"response": f"服务繁忙，请稍后重试: {str(e)}", "error": str(e)})
     except Exception as e:
         return {"response": f"处理上传文件时出错: {str(e)}", "error": str(e)}
 
@@ -260,85 +469,50 @@ async def upload_knowledge_file(file: UploadFile = File(...)):
         file_name = f"{file_id}{file_ext}"
         file_path = os.path.join(kb_dir, file_name)
         
-        # 保存文件
-        content = await file.read()
-        with open(file_path, "wb") as f:
-            f.write(content)
+        # 分块流式保存文件，同时计算内容哈希
+        file_size, file_hash = await save_upload_file(file, file_path)
         
-        # 更新元数据
-        with open(kb_metadata_file, "r+", encoding="utf-8") as f:
-            metadata = json.load(f)
-            metadata["files"].append({
-                "id": file_id,
-                "name": file.filename,
-                "path": file_path,
-                "size": len(content),
-                "upload_time": datetime.now().isoformat(),
-                "type": file_ext
-            })
-            f.seek(0)
-            json.dump(metadata, f, ensure_ascii=False, indent=2)
-            f.truncate()
+        # 写入知识库目录（单个事务）
+        get_kb_catalog().add_file({
+            "id": file_id,
+            "name": file.filename,
+            "path": file_path,
+            "size": file_size,
+            "content_hash": file_hash,
+            "upload_time": datetime.now().isoformat(),
+            "type": file_ext
+        })
         
-        # 根据文件类型构建向量存储
-        try:
-            if file_ext == ".pdf":
-                vectorstore = build_vectorstore_from_pdf(file_path)
-                vectorstore_cache[file_id] = vectorstore
-                print(f"成功构建PDF文件的向量存储")
-            elif file_ext in [".jpg", ".jpeg", ".png", ".gif"]:
-                # 对于图片文件，使用image_captioning生成描述
-                from multimodal.image_captioning import caption_image
-                from langchain.schema import Document
-                from langchain.vectorstores import FAISS
-                from tools.vectorstore import get_embeddings
-                
-                try:
-                    # 生成图片描述
-                    image_description = caption_image(file_path)
-                    
-                    # 创建文档对象
-                    doc = Document(
-                        page_content=f"这是一张图片。图片内容描述：{image_description}\n\n图片保存路径：{file_path}",
-                        metadata={
-                            "source": file_path,
-                            "file_name": file.filename,
-                            "file_type": file_ext
-                        }
-                    )
-                    
-                    # 获取嵌入模型（使用缓存）
-                    embeddings = get_embeddings()
-                    
-                    # 构建向量存储
-                    vectorstore = FAISS.from_documents([doc], embeddings)
-                    vectorstore_cache[file_id] = vectorstore
-                    print(f"成功构建图片文件的向量存储")
-                except Exception as image_err:
-                    print(f"处理图片文件失败: {str(image_err)}")
-            elif file_ext in [".txt", ".doc", ".docx"]:
-                # 对于文档文件，使用常规的文档处理
-                vectorstore = build_vectorstore_from_document(file_path)
-                vectorstore_cache[file_id] = vectorstore
-                print(f"成功构建{file_ext}文件的向量存储")
-        except Exception as e:
-            print(f"构建向量存储失败: {str(e)}")
+        # 提交后台索引任务后立即返回，构建向量存储并并入统一索引的工作在任务队列中完成
+        job_id = None
+        if file_ext in SUPPORTED_KB_FILE_TYPES:
+            job_id = get_ingest_queue().submit(file_id, file_path, file_ext, file.filename)
+            print(f"已提交索引任务: {file.filename} (任务ID: {job_id})")
         
-        return JSONResponse(content={"success": True, "file_id": file_id})
+        return JSONResponse(content={"success": True, "file_id": file_id, "job_id": job_id})
     except HTTPException as e:
         raise e
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"文件上传失败: {str(e)}")
 
+@app.get("/kb/jobs/{job_id}")
+async def get_ingest_job(job_id: str):
+    job = get_ingest_queue().get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return JSONResponse(content={"success": True, "job": job})
+
 @app.get("/kb/files")
-async def get_knowledge_files():
+async def get_knowledge_files(page: int = 1, page_size: int = 50, sort: str = "upload_time_desc",
+                              q: Optional[str] = None, type: Optional[str] = None):
     try:
-        with open(kb_metadata_file, "r", encoding="utf-8") as f:
-            metadata = json.load(f)
+        # 分页、排序和过滤都在知识库目录数据库中完成，不随文件总数线性增长
+        catalog = get_kb_catalog()
+        files, total = catalog.list_files(page=page, page_size=page_size, sort=sort, search=q, file_type=type)
         
         # 格式化返回的文件列表
         files_list = []
-        for file in metadata.get("files", []):
+        for file in files:
             files_list.append({
                 "id": file["id"],
                 "name": file["name"],
@@ -347,40 +521,52 @@ async def get_knowledge_files():
                 "type": file["type"]
             })
         
-        return JSONResponse(content={"success": True, "files": files_list})
+        return JSONResponse(content={
+            "success": True,
+            "files": files_list,
+            "total": total,
+            "page": max(1, page),
+            "page_size": min(max(1, page_size), MAX_PAGE_SIZE),
+            "stats": catalog.stats()
+        })
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取文件列表失败: {str(e)}")
 
+def _delete_knowledge_file(file_id: str):
+    """
+    删除知识库文件，写统一索引需要重写整个段，在线程池中执行
+
+    先删除目录记录，索引期间的任务据此发现文件已删除；统一索引删除失败时恢复目录记录，
+    不会留下目录中已不存在、却仍能被检索到的分片。最后才删除磁盘上的文件
+
+    参数 file_id: 知识库文件ID
+    返回值: 被删除的文件记录，不存在时返回None
+    """
+    catalog = get_kb_catalog()
+    file_to_delete = catalog.delete_file(file_id)
+    if not file_to_delete:
+        return None
+    
+    # 从缓存和统一索引中删除向量存储
+    try:
+        vectorstore_cache.pop(file_id)
+        get_kb_index().delete_file(file_id)
+    except Exception:
+        catalog.add_file(file_to_delete)
+        raise
+    # 引用了该文件的缓存回答立即失效，其他worker发现知识库变化后在后台线程中对齐
+    response_cache.invalidate_files([file_id])
+    
+    # 删除文件
+    if os.path.exists(file_to_delete["path"]):
+        os.remove(file_to_delete["path"])
+    return file_to_delete
+
 @app.delete("/kb/delete/{file_id}")
 async def delete_knowledge_file(file_id: str):
     try:
-        with open(kb_metadata_file, "r+", encoding="utf-8") as f:
-            metadata = json.load(f)
-            files = metadata.get("files", [])
-            
-            # 查找文件
-            file_to_delete = None
-            for i, file in enumerate(files):
-                if file["id"] == file_id:
-                    file_to_delete = file
-                    del files[i]
-                    break
-            
-            if not file_to_delete:
-                raise HTTPException(status_code=404, detail="文件不存在")
-            
-            # 删除文件
-            if os.path.exists(file_to_delete["path"]):
-                os.remove(file_to_delete["path"])
-            
-            # 从缓存中删除向量存储
-            if file_id in vectorstore_cache:
-                del vectorstore_cache[file_id]
-            
-            # 更新元数据
-            f.seek(0)
-            json.dump(metadata, f, ensure_ascii=False, indent=2)
-            f.truncate()
+        if not await run_in_threadpool(_delete_knowledge_file, file_id):
+            raise HTTPException(status_code=404, detail="文件不存在")
         
         return JSONResponse(content={"success": True, "message": "文件删除成功"})
     except HTTPException as e:
@@ -388,6 +574,93 @@ async def delete_knowledge_file(file_id: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"文件删除失败: {str(e)}")
 
+# 正在保存新内容的文件ID，与未结束的索引任务一起用于拒绝同一文件的并发更新
+_updating_files = set()
+
+@app.put("/kb/files/{file_id}")
+async def update_knowledge_file(file_id: str, file: UploadFile = File(...)):
+    reserved = False
+    try:
+        record = get_kb_catalog().get(file_id)
+        if not record:
+            raise HTTPException(status_code=404, detail="文件不存在")
+        file_ext = os.path.splitext(file.filename)[1].lower()
+        if file_ext != record["type"]:
+            raise HTTPException(status_code=400, detail=f"文件类型不一致: {record['type']} -> {file_ext}")
+        # 索引任务执行期间覆盖文件会使任务读到新内容却按旧分片校验而失败，索引停留在旧内容
+        if file_id in _updating_files or get_ingest_queue().is_active(file_id):
+            raise HTTPException(status_code=409, detail="文件正在索引中，请在当前任务完成后重试")
+        _updating_files.add(file_id)
+        reserved = True
+        
+        # 新内容写入临时文件后原子替换原文件
+        file_size, file_hash = await save_upload_file(file, record["path"])
+        if file_hash == record.get("content_hash"):
+            return JSONResponse(content={"success": True, "file_id": file_id, "job_id": None, "changed": False})
+        
+        get_kb_catalog().add_file(dict(record, name=file.filename, size=file_size, content_hash=file_hash,
+                                       upload_time=datetime.now().isoformat()))
+        
+        # 后台增量索引：只删除和重新嵌入内容变化的页面
+        job_id = None
+        if file_ext in SUPPORTED_KB_FILE_TYPES:
+            job_id = get_ingest_queue().submit(file_id, record["path"], file_ext, file.filename, update=True)
+            print(f"已提交增量索引任务: {file.filename} (任务ID: {job_id})")
+        # 引用了旧内容的缓存回答立即失效
+        response_cache.invalidate_files([file_id])
+        
+        return JSONResponse(content={"success": True, "file_id": file_id, "job_id": job_id, "changed": True})
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"文件更新失败: {str(e)}")
+    finally:
+        if reserved:
+            _updating_files.discard(file_id)
+
+def _is_ready():
+    """
+    判断服务是否就绪
+
+    关闭预热时agent在首次请求时构建，服务启动即视为就绪；
+    否则需要agent预热阶段已完成。agent构建失败（预热阶段失败或使用了回退agent）时视为未就绪
+    """
+    if startup_tracker.status("agent") == PHASE_FAILED:
+        return False
+    if agent is not None:
+        return not getattr(agent, "is_fallback", False)
+    return STARTUP_WARMUP == "off"
+
+
+# 就绪检查：agent初始化完成后返回200，否则返回503
+@app.get("/ready")
+async def readiness():
+    ready = _is_ready()
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"ready": ready, "startup": startup_tracker.report(), "chat": chat_runner.stats()}
+    )
+
+# 启动耗时报告
+@app.get("/startup/report")
+async def get_startup_report():
+    return JSONResponse(content={"success": True, "startup": startup_tracker.report()})
+
+# 缓存统计
+@app.get("/cache/stats")
+async def get_cache_stats():
+    from tools.vectorstore import get_query_cache_stats, get_chunk_cache_stats
+    from tools.search_tool import get_search_client
+    return JSONResponse(content={
+        "success": True,
+        "query_embedding_cache": get_query_cache_stats(),
+        "chunk_embedding_cache": get_chunk_cache_stats(),
+        "kb_index": get_kb_index().stats(),
+        "vectorstore_cache": vectorstore_cache.stats(),
+        "response_cache": response_cache.stats(),
+        "search_cache": get_search_client().stats()
+    })
+
 # 提供首页HTML页面
 @app.get("/")
 async def read_root():
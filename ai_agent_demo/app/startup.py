@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+@File    : startup.py
+@Time    : 2025/10/17 16:10
+@Desc    : 启动过程管理，记录各启动阶段耗时，支持在后台线程中预热模型和索引
+"""
+import os
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# 预热方式: background 后台线程预热（默认），blocking 启动时同步预热，off 不预热（全部首次使用时加载）
+STARTUP_WARMUP = os.getenv("STARTUP_WARMUP", "background").lower()
+
+# 阶段状态
+PHASE_RUNNING = "running"
+PHASE_DONE = "done"
+PHASE_FAILED = "failed"
+
+
+class StartupTracker:
+    """
+    启动阶段计时器
+
+    每个阶段记录开始时间、耗时、状态和错误信息，用于就绪检查和启动耗时报告
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self._phases = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        """
+        记录一个启动阶段的耗时
+
+        参数 name: 阶段名称
+        """
+        start_time = time.time()
+        with self._lock:
+            self._phases[name] = {"status": PHASE_RUNNING, "offset_seconds": round(start_time - self.started_at, 3),
+                                  "duration_seconds": None, "error": None}
+        try:
+            yield
+        except Exception as e:
+            self._finish(name, start_time, PHASE_FAILED, str(e))
+            raise
+        self._finish(name, start_time, PHASE_DONE)
+
+    def record(self, name, duration, status=PHASE_DONE):
+        """
+        直接记录一个已完成阶段的耗时
+
+        参数 name: 阶段名称
+        参数 duration: 耗时（秒）
+        参数 status: 阶段状态
+        """
+        with self._lock:
+            self._phases[name] = {"status": status,
+                                  "offset_seconds": round(time.time() - duration - self.started_at, 3),
+                                  "duration_seconds": round(duration, 3), "error": None}
+
+    def _finish(self, name, start_time, status, error=None):
+        """更新阶段结束状态"""
+        with self._lock:
+            self._phases[name].update({"status": status, "duration_seconds": round(time.time() - start_time, 3),
+                                       "error": error})
+
+    def is_done(self, name):
+        """判断阶段是否已成功完成"""
+        with self._lock:
+            return self._phases.get(name, {}).get("status") == PHASE_DONE
+
+    def status(self, name):
+        """返回阶段状态，阶段未开始时返回None"""
+        with self._lock:
+            return self._phases.get(name, {}).get("status")
+
+    def report(self):
+        """
+        生成启动耗时报告
+
+        返回值: 包含各阶段状态和耗时的字典
+        """
+        with self._lock:
+            return {
+                "uptime_seconds": round(time.time() - self.started_at, 3),
+                "phases": {name: dict(info) for name, info in self._phases.items()},
+            }
+
+    def print_report(self):
+        """以表格形式打印启动耗时报告"""
+        report = self.report()
+        print("=== 启动耗时报告 ===")
+        for name, info in report["phases"].items():
+            duration = info["duration_seconds"]
+            duration_text = f"{duration:.3f}秒" if duration is not None else "进行中"
+            print(f"{name:<20} {info['status']:<8} {duration_text}")
+
+
+# 全局启动计时器，进程启动时即开始计时
+startup_tracker = StartupTracker()
+
+
+def run_warmup(steps, tracker=startup_tracker):
+    """
+    依次执行预热步骤，单个步骤失败不影响后续步骤
+
+    参数 steps: (阶段名称, 无参函数) 列表
+    参数 tracker: 启动计时器
+    """
+    for name, func in steps:
+        try:
+            with tracker.phase(name):
+                func()
+        except Exception as e:
+            print(f"预热阶段 {name} 失败: {str(e)}")
+
+
+def start_warmup(steps, mode=STARTUP_WARMUP, tracker=startup_tracker):
+    """
+    按配置的方式执行预热
+
+    参数 steps: (阶段名称, 无参函数) 列表
+    参数 mode: background / blocking / off
+    参数 tracker: 启动计时器
+    返回值: 后台预热线程，非后台模式时返回None
+    """
+    if mode == "off":
+        print("已关闭启动预热，模型和索引将在首次使用时加载")
+        return None
+    if mode == "blocking":
+        run_warmup(steps, tracker)
+        tracker.print_report()
+        return None
+
+    def _run():
+        run_warmup(steps, tracker)
+        tracker.print_report()
+
+    thread = threading.Thread(target=_run, name="startup-warmup", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+@File    : streaming.py
+@Time    : 2025/10/17 17:30
+@Desc    : 对话流式输出，通过回调把agent中间步骤和LLM token转发给SSE接口
+"""
+import re
+import json
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+# 结构化ReAct agent的最终答案格式: {"action": "Final Answer", "action_input": "..."}
+_FINAL_ANSWER_PATTERN = re.compile(r'"action"\s*:\s*"Final Answer"\s*,\s*"action_input"\s*:\s*"')
+# JSON字符串中的转义字符
+_JSON_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+# 工具返回内容在步骤事件中保留的最大长度
+MAX_OBSERVATION_LENGTH = 500
+
+
+class StreamCancelled(Exception):
+    """客户端断开连接，中止agent运行"""
+
+
+def sse_event(event, data):
+    """
+    格式化一条Server-Sent Events消息
+
+    参数 event: 事件名称
+    参数 data: 可JSON序列化的数据
+    返回值: SSE文本
+    """
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class FinalAnswerExtractor:
+    """
+    从LLM的流式输出中增量提取最终答案
+
+    agent每一步的输出是JSON动作块，只有 action 为 "Final Answer" 时 action_input 才是给用户的回答；
+    检测到最终答案开头后，逐字符解码JSON字符串，直到遇到结束引号
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """开始一次新的LLM调用"""
+        self._buffer = ""
+        self._started = False
+        self._finished = False
+        self._escape = None
+
+    def feed(self, token):
+        """
+        输入一个token
+
+        参数 token: LLM新生成的文本
+        返回值: 其中属于最终答案的文本，没有时返回空字符串
+        """
+        if self._finished:
+            return ""
+        if not self._started:
+            self._buffer += token
+            match = _FINAL_ANSWER_PATTERN.search(self._buffer)
+            if not match:
+                return ""
+            self._started = True
+            token = self._buffer[match.end():]
+            self._buffer = ""
+        return self._decode(token)
+
+    def _decode(self, text):
+        """解码JSON字符串片段，遇到未转义的引号时结束"""
+        output = []
+        for char in text:
+            if self._escape is not None:
+                self._escape += char
+                if self._escape[0] == "u":
+                    # \uXXXX 需要凑满4位十六进制
+                    if len(self._escape) == 5:
+                        try:
+                            output.append(chr(int(self._escape[1:], 16)))
+                        except ValueError:
+                            pass
+                        self._escape = None
+                    continue
+                output.append(_JSON_ESCAPES.get(char, char))
+                self._escape = None
+            elif char == "\\":
+                self._escape = ""
+            elif char == '"':
+                self._finished = True
+                break
+            else:
+                output.append(char)
+        return "".join(output)
+
+
+class AgentStreamHandler(BaseCallbackHandler):
+    """
+    agent流式回调
+
+    在agent所在的工作线程中被调用，把事件线程安全地放入事件循环中的asyncio.Queue；
+    客户端断开后再收到回调时抛出异常，尽早中止agent运行
+    """
+
+    # 回调中的异常需要向上抛出，才能在客户端断开时中止agent
+    raise_error = True
+
+    def __init__(self, loop, queue):
+        """
+        参数 loop: SSE接口所在的事件循环
+        参数 queue: 事件队列，元素为 (事件名称, 数据)
+        """
+        self.loop = loop
+        self.queue = queue
+        self.cancelled = False
+        self._extractor = FinalAnswerExtractor()
+
+    def emit(self, event, data):
+        """从工作线程向事件队列发送一个事件"""
+        if self.cancelled:
+            raise StreamCancelled("客户端已断开连接")
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (event, data))
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self._extractor.reset()
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        self._extractor.reset()
+
+    def on_llm_new_token(self, token, **kwargs):
+        text = self._extractor.feed(token)
+        self.emit("token", {"text": token, "answer": text})
+
+    def on_agent_action(self, action, **kwargs):
+        self.emit("step", {"type": "action", "tool": action.tool, "tool_input": action.tool_input})
+
+    def on_tool_end(self, output, **kwargs):
+        observation = str(output)
+        if len(observation) > MAX_OBSERVATION_LENGTH:
+            observation = observation[:MAX_OBSERVATION_LENGTH] + "..."
+        self.emit("step", {"type": "observation", "observation": observation})
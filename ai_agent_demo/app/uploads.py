@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+@File    : uploads.py
+@Time    : 2025/10/17 15:20
+@Desc    : 上传文件处理工具，分块流式写盘并同时计算内容哈希，单个上传的内存占用与文件大小无关
+"""
+import os
+import time
+import hashlib
+
+from starlette.concurrency import run_in_threadpool
+
+# 每次从上传流中读取的字节数
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+# temp目录中临时文件的保留时间（秒）
+TEMP_FILE_TTL = int(os.getenv("TEMP_FILE_TTL", "3600"))
+
+
+async def save_upload_file(upload, dest_path, chunk_size=UPLOAD_CHUNK_SIZE):
+    """
+    将上传文件分块写入磁盘，写入过程中计算sha256
+
+    先写入 .part 临时文件，全部写完后再重命名，避免其他请求读到写了一半的文件
+
+    参数 upload: FastAPI的UploadFile对象
+    参数 dest_path: 目标文件路径
+    参数 chunk_size: 每次读取的字节数
+    返回值: (文件大小, sha256十六进制字符串)
+    """
+    part_path = f"{dest_path}.part"
+    sha256 = hashlib.sha256()
+    size = 0
+    try:
+        with open(part_path, "wb") as f:
+            while True:
+                chunk = await upload.read(chunk_size)
+                if not chunk:
+                    break
+                sha256.update(chunk)
+                size += len(chunk)
+                # 写盘放到线程池，慢磁盘不会阻塞事件循环
+                await run_in_threadpool(f.write, chunk)
+        os.replace(part_path, dest_path)
+    except Exception:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    return size, sha256.hexdigest()
+
+
+def remove_file_quietly(file_path):
+    """
+    删除文件，文件不存在或删除失败时忽略
+
+    参数 file_path: 文件路径
+    """
+    try:
+        if file_path and os.path.exists(file_path):
+            os.remove(file_path)
+    except OSError as e:
+        print(f"删除临时文件失败 ({file_path}): {str(e)}")
+
+
+def cleanup_temp_dir(temp_dir, max_age=TEMP_FILE_TTL):
+    """
+    清理temp目录中超过保留时间的临时文件
+
+    参数 temp_dir: 临时目录
+    参数 max_age: 保留时间（秒）
+    返回值: 删除的文件数量
+    """
+    if not os.path.isdir(temp_dir):
+        return 0
+    removed = 0
+    now = time.time()
+    for name in os.listdir(temp_dir):
+        file_path = os.path.join(temp_dir, name)
+        try:
+            if os.path.isfile(file_path) and now - os.path.getmtime(file_path) > max_age:
+                os.remove(file_path)
+                removed += 1
+        except OSError as e:
+            print(f"清理临时文件失败 ({file_path}): {str(e)}")
+    if removed:
+        print(f"已清理 {removed} 个过期临时文件")
+    return removed
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+@File    : caption_cache.py
+@Time    : 2025/10/19 14:10
+@Desc    : 图片描述持久化缓存模块，以图片内容哈希和描述模型名称为键保存在SQLite中，内容相同的图片只生成一次描述
+"""
+import os
+import sys
+import sqlite3
+import hashlib
+import threading
+
+# 添加项目根目录到Python路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# SQLite单条语句的参数数量有上限，批量查询时按此大小分组
+_QUERY_BATCH_SIZE = 500
+
+
+def image_key(file_path, block_size=1024 * 1024):
+    """
+    计算图片内容哈希
+
+    参数 file_path: 图片文件路径
+    参数 block_size: 每次读取的字节数
+    返回值: sha256十六进制字符串
+    """
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+class CaptionStore:
+    """
+    基于SQLite的图片描述存储，使用WAL模式，多个进程可同时读取
+    """
+
+    def __init__(self, db_path):
+        """
+        参数 db_path: SQLite数据库文件路径
+        """
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS captions ("
+            "image_hash TEXT NOT NULL, model_name TEXT NOT NULL, caption TEXT NOT NULL, "
+            "PRIMARY KEY (image_hash, model_name))"
+        )
+        self._conn.commit()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, image_hashes, model_name):
+        """
+        批量读取图片描述
+
+        参数 image_hashes: 图片内容哈希列表
+        参数 model_name: 描述模型名称
+        返回值: {哈希: 描述} 字典，只包含命中的哈希
+        """
+        found = {}
+        unique_hashes = list(dict.fromkeys(image_hashes))
+        with self._lock:
+            for start in range(0, len(unique_hashes), _QUERY_BATCH_SIZE):
+                batch = unique_hashes[start:start + _QUERY_BATCH_SIZE]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT image_hash, caption FROM captions WHERE model_name = ? AND image_hash IN ({placeholders})",
+                    [model_name] + batch
+                ).fetchall()
+                found.update(rows)
+            self.hits += sum(1 for image_hash in unique_hashes if image_hash in found)
+            self.misses += sum(1 for image_hash in unique_hashes if image_hash not in found)
+        return found
+
+    def put_many(self, items, model_name):
+        """
+        批量写入图片描述
+
+        参数 items: (哈希, 描述) 列表
+        参数 model_name: 描述模型名称
+        """
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO captions (image_hash, model_name, caption) VALUES (?, ?, ?)",
+                [(image_hash, model_name, caption) for image_hash, caption in items]
+            )
+            self._conn.commit()
+
+    def stats(self):
+        """返回缓存命中统计"""
+        with self._lock:
+            count = self._conn.execute("SELECT COUNT(*) FROM captions").fetchone()[0]
+            total = self.hits + self.misses
+            return {
+                "db_path": self.db_path,
+                "size": count,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+# 全局图片描述缓存实例
+_caption_stores = {}
+_caption_stores_lock = threading.Lock()
+
+
+def get_caption_store(db_path):
+    """
+    获取指定路径的图片描述缓存实例，同一路径只打开一次
+
+    参数 db_path: SQLite数据库文件路径
+    返回值: CaptionStore实例
+    """
+    with _caption_stores_lock:
+        if db_path not in _caption_stores:
+            _caption_stores[db_path] = CaptionStore(db_path)
+        return _caption_stores[db_path]
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+@File    : embedding_cache.py
+@Time    : 2025/10/17 11:05
+@Desc    : 分片向量持久化缓存模块，以分片文本哈希和模型名称为键将向量保存在SQLite中，重复内容无需再次嵌入
+"""
+import os
+import sys
+import sqlite3
+import hashlib
+import threading
+
+import numpy as np
+
+# 添加项目根目录到Python路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# SQLite单条语句的参数数量有上限，批量查询时按此大小分组
+_QUERY_BATCH_SIZE = 500
+
+
+def chunk_key(text, model_name):
+    """
+    计算分片向量缓存键
+
+    参数 text: 分片文本
+    参数 model_name: 嵌入模型名称
+    返回值: sha256十六进制字符串
+    """
+    return hashlib.sha256(f"{model_name}\0{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingStore:
+    """
+    基于SQLite的分片向量存储
+
+    向量以float32字节保存，使用WAL模式，多个进程可同时读取
+    """
+
+    def __init__(self, db_path):
+        """
+        参数 db_path: SQLite数据库文件路径
+        """
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunk_embeddings ("
+            "key TEXT PRIMARY KEY, model_name TEXT NOT NULL, dim INTEGER NOT NULL, vector BLOB NOT NULL)"
+        )
+        self._conn.commit()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, keys, record_stats=True):
+        """
+        批量读取向量
+
+        参数 keys: 缓存键列表
+        参数 record_stats: 是否计入命中统计，检索重排序等非嵌入场景传False
+        返回值: {键: np.ndarray} 字典，只包含命中的键
+        """
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        with self._lock:
+            for start in range(0, len(unique_keys), _QUERY_BATCH_SIZE):
+                batch = unique_keys[start:start + _QUERY_BATCH_SIZE]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM chunk_embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+            if record_stats:
+                self.hits += sum(1 for key in keys if key in found)
+                self.misses += sum(1 for key in keys if key not in found)
+        return found
+
+    def put_many(self, items, model_name):
+        """
+        批量写入向量
+
+        参数 items: (键, 向量) 列表
+        参数 model_name: 嵌入模型名称
+        """
+        rows = []
+        for key, vector in items:
+            vector = np.asarray(vector, dtype=np.float32)
+            rows.append((key, model_name, int(vector.shape[0]), vector.tobytes()))
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO chunk_embeddings (key, model_name, dim, vector) VALUES (?, ?, ?, ?)", rows
+            )
+            self._conn.commit()
+
+    def stats(self):
+        """返回缓存命中统计"""
+        with self._lock:
+            count = self._conn.execute("SELECT COUNT(*) FROM chunk_embeddings").fetchone()[0]
+            total = self.hits + self.misses
+            return {
+                "db_path": self.db_path,
+                "size": count,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+# 全局分片向量缓存实例
+_embedding_stores = {}
+_embedding_stores_lock = threading.Lock()
+
+
+def get_embedding_store(db_path):
+    """
+    获取指定路径的分片向量缓存实例，同一路径只打开一次
+
+    参数 db_path: SQLite数据库文件路径
+    返回值: EmbeddingStore实例
+    """
+    with _embedding_stores_lock:
+        if db_path not in _embedding_stores:
+            _embedding_stores[db_path] = EmbeddingStore(db_path)
+        return _embedding_stores[db_path]
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+@File    : response_cache.py
+@Time    : 2025/10/18 16:40
+@Desc    : 对话回答语义缓存，以问题向量为键，相似问题直接返回已生成的回答；记录回答引用的知识库文件，文件变化时失效
+"""
+import os
+import sys
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# 添加项目根目录到Python路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools.lexical_index import identifier_tokens
+
+# 缓存的回答数量上限，0表示关闭回答缓存
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1000"))
+# 回答的有效期（秒），agent可能使用网络搜索，回答不宜长期复用
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+# 问题向量余弦相似度不低于该值时视为同一问题
+RESPONSE_CACHE_THRESHOLD = float(os.getenv("RESPONSE_CACHE_THRESHOLD", "0.95"))
+
+
+class ResponseCache:
+    """
+    对话回答语义缓存
+
+    每条缓存记录问题、归一化的问题向量、回答、引用的知识库文件ID和写入时间；
+    查询时与所有未过期记录计算余弦相似度，超过阈值时命中。
+    "8.2.3条" 与 "8.2.4条" 这类问题的向量几乎相同，因此还要求两个问题中的条款号、标准号等标识符完全一致。
+    没有引用知识库的回答在知识库新增任何文件时失效，引用了文件的回答在这些文件删除或更新时失效
+    """
+
+    def __init__(self, max_size=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL, threshold=RESPONSE_CACHE_THRESHOLD):
+        """
+        参数 max_size: 缓存容量，0表示关闭
+        参数 ttl: 有效期（秒）
+        参数 threshold: 命中所需的余弦相似度
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.threshold = threshold
+        self._entries = OrderedDict()
+        self._matrix = None
+        self._matrix_keys = []
+        self._matrix_identifiers = []
+        self._next_key = 0
+        # 上次对齐时知识库中每个文件的版本和知识库索引版本，用于发现新增、删除和更新的文件
+        self._file_versions = None
+        self._synced_revision = None
+        self._lock = threading.Lock()
+        # 串行执行对齐，对齐完成前版本号不更新，期间 is_synced 返回False
+        self._sync_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    @staticmethod
+    def _identifiers(query):
+        """问题中的标识符集合，条款号不同的问题不能共用回答"""
+        return frozenset(identifier_tokens(query or ""))
+
+    def lookup(self, embedding, query=None):
+        """
+        查找相似问题的回答
+
+        参数 embedding: 问题向量
+        参数 query: 问题文本，提供时只匹配标识符完全相同的记录
+        返回值: 缓存记录字典（query / answer / file_ids / similarity），未命中时返回None
+        """
+        with self._lock:
+            self._expire()
+            if not self._entries:
+                self.misses += 1
+                return None
+            if self._matrix is None:
+                self._matrix_keys = list(self._entries)
+                self._matrix = np.vstack([self._entries[key]["embedding"] for key in self._matrix_keys])
+                self._matrix_identifiers = [self._entries[key]["identifiers"] for key in self._matrix_keys]
+            similarities = self._matrix @ self._normalize(embedding)
+            if query is not None:
+                identifiers = self._identifiers(query)
+                similarities = np.where([ids == identifiers for ids in self._matrix_identifiers], similarities, -1.0)
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+            key = self._matrix_keys[best]
+            self._entries.move_to_end(key)
+            self.hits += 1
+            entry = self._entries[key]
+            return {"query": entry["query"], "answer": entry["answer"], "file_ids": sorted(entry["file_ids"]),
+                    "similarity": float(similarities[best])}
+
+    def store(self, query, embedding, answer, file_ids):
+        """
+        写入一条回答
+
+        参数 query: 问题
+        参数 embedding: 问题向量
+        参数 answer: 回答文本
+        参数 file_ids: 生成回答时引用的知识库文件ID，没有引用时为空
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[self._next_key] = {
+                "query": query,
+                "identifiers": self._identifiers(query),
+                "embedding": self._normalize(embedding),
+                "answer": answer,
+                "file_ids": set(file_ids or ()),
+                "created_at": time.time(),
+            }
+            self._next_key += 1
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+    def _expire(self):
+        """删除过期记录，调用方需持有锁"""
+        deadline = time.time() - self.ttl
+        expired = [key for key, entry in self._entries.items() if entry["created_at"] < deadline]
+        for key in expired:
+            del self._entries[key]
+        if expired:
+            self._matrix = None
+
+    def invalidate(self, predicate):
+        """
+        删除满足条件的记录
+
+        条件可能很耗时（如对每条记录做一次知识库检索），在锁外对记录快照逐条判断，
+        判断期间不阻塞并发的 lookup / store；记录键只增不复用，按键删除不会误删新记录
+
+        参数 predicate: 参数为缓存记录字典的函数，返回True的记录被删除
+        返回值: 删除的记录数
+        """
+        with self._lock:
+            entries = list(self._entries.items())
+        keys = [key for key, entry in entries if predicate(entry)]
+        with self._lock:
+            count = sum(1 for key in keys if self._entries.pop(key, None) is not None)
+            if count:
+                self._matrix = None
+                self.invalidations += count
+            return count
+
+    def invalidate_files(self, file_ids):
+        """
+        删除引用了指定文件的回答
+
+        参数 file_ids: 知识库文件ID列表
+        返回值: 删除的记录数
+        """
+        file_ids = set(file_ids)
+        return self.invalidate(lambda entry: bool(entry["file_ids"] & file_ids))
+
+    def is_synced(self, revision):
+        """
+        判断是否已与指定版本的知识库对齐
+
+        参数 revision: 知识库索引版本
+        返回值: 已对齐时返回True
+        """
+        return self._file_versions is not None and revision == self._synced_revision
+
+    def sync_files(self, file_versions, is_affected=None, revision=None):
+        """
+        与知识库中的文件对齐：删除或更新过的文件使引用它的回答失效，
+        新增（或更新）的文件使没有引用知识库的回答失效，并使 is_affected 判断为相关的回答失效
+
+        is_affected 对每条记录调用一次，耗时与缓存条数成正比，应在索引任务或后台线程中调用；
+        失效完成后才记录新版本，对齐期间 is_synced 返回False
+
+        参数 file_versions: {文件ID: 版本}，文件内容变化时版本随之变化；可以是返回该字典的无参函数，版本号未变化时不会调用
+        参数 is_affected: 函数 (问题, 问题向量, 新增文件ID列表) -> bool，可选
+        参数 revision: 知识库索引版本，与上次对齐相同时直接返回，可选
+        返回值: 删除的记录数
+        """
+        with self._sync_lock:
+            if revision is not None and self.is_synced(revision):
+                return 0
+            if callable(file_versions):
+                file_versions = file_versions()
+            previous = self._file_versions
+            count = 0
+            if previous is not None and previous != file_versions:
+                changed = {file_id for file_id, version in previous.items() if file_versions.get(file_id) != version}
+                added = [file_id for file_id, version in file_versions.items() if previous.get(file_id) != version]
+                count = self.invalidate_files(changed) if changed else 0
+                if added:
+                    count += self.invalidate(lambda entry: not entry["file_ids"] or (
+                        is_affected is not None and is_affected(entry["query"], entry["embedding"], added)))
+            with self._lock:
+                self._file_versions = dict(file_versions)
+                self._synced_revision = revision
+        if count:
+            print(f"知识库文件变化，已清除 {count} 条相关的缓存回答")
+        return count
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+
+    def stats(self):
+        """
+        返回缓存统计
+
+        返回值: 包含条目数、命中率和失效次数的字典
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "invalidations": self.invalidations,
+            }
+
+
+# 全局对话回答缓存
+response_cache = ResponseCache()
+
+
+if __name__ == '__main__':
+    # 自检：向量完全相同但条款号不同的问题不能互相命中
+    cache = ResponseCache(max_size=10)
+    vector = np.ones(8, dtype=np.float32)
+    cache.store("GB 38031-2025 8.2.3条的要求", vector, "8.2.3的回答", [])
+    assert cache.lookup(vector, "GB 38031-2025 8.2.4条的要求") is None
+    assert cache.lookup(vector, "GB 38031-2025 8.2.3条的要求")["answer"] == "8.2.3的回答"
+    assert cache.lookup(vector, "8.2.3条的要求") is None
+    print("回答缓存自检通过")
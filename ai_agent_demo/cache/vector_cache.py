@@ -2,13 +2,228 @@
 """
 @File    : vector_cache.py
 @Time    : 2025/9/25 15:00
-@Desc    : 向量存储缓存模块，用于缓存已构建的文档向量存储，避免重复构建
+@Desc    : 向量存储缓存模块，用于缓存已构建的文档向量存储，避免重复构建；按内存预算淘汰，被淘汰的条目按需从磁盘重新加载
 """
 import os
 import sys
+import threading
+from collections import OrderedDict
 
 # 添加项目根目录到Python路径
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+# 向量存储缓存的内存预算（字节），默认512MB，0表示不限制
+VECTORSTORE_CACHE_MAX_BYTES = int(os.getenv("VECTORSTORE_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+# 淘汰策略: lru 最近最少使用 / lfu 最不经常使用
+VECTORSTORE_CACHE_POLICY = os.getenv("VECTORSTORE_CACHE_POLICY", "lru").lower()
+
+# 每个分片的docstore条目、元数据和编号映射的额外开销估计（字节）
+_PER_DOC_OVERHEAD = 256
+
+
+def estimate_vectorstore_bytes(vectorstore):
+    """
+    估算向量存储占用的内存
+
+    索引部分按向量数量乘以每个向量的编码字节数计算（float32 / float16 / int8 各不相同），
+    文档部分按分片文本的UTF-8字节数加固定开销计算
+
+    参数 vectorstore: LangChain FAISS向量存储对象
+    返回值: 字节数
+    """
+    index = vectorstore.index
+    try:
+        code_size = index.sa_code_size()
+    except Exception:
+        code_size = index.d * 4
+    size = index.ntotal * code_size
+    docstore = getattr(vectorstore.docstore, "_dict", {})
+    for doc in docstore.values():
+        size += len(doc.page_content.encode("utf-8")) + _PER_DOC_OVERHEAD
+    return size
+
+
+class VectorStoreCache:
+    """
+    按内存预算淘汰的向量存储缓存
+
+    接口与dict兼容（in / [] / del / get / pop），写入时估算条目大小，
+    总大小超过预算时按LRU或LFU淘汰；被淘汰的文件下次访问时由 get_vectorstore 从磁盘持久化索引重新加载
+    """
+
+    def __init__(self, max_bytes=VECTORSTORE_CACHE_MAX_BYTES, policy=VECTORSTORE_CACHE_POLICY):
+        """
+        参数 max_bytes: 内存预算（字节），0表示不限制
+        参数 policy: 淘汰策略，lru / lfu
+        """
+        self.max_bytes = max_bytes
+        self.policy = policy if policy in ("lru", "lfu") else "lru"
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._uses = {}
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, file_id):
+        with self._lock:
+            return file_id in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def __getitem__(self, file_id):
+        vectorstore = self.get(file_id)
+        if vectorstore is None:
+            raise KeyError(file_id)
+        return vectorstore
+
+    def __setitem__(self, file_id, vectorstore):
+        self.put(file_id, vectorstore)
+
+    def __delitem__(self, file_id):
+        if self.pop(file_id) is None:
+            raise KeyError(file_id)
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries)
+
+    def get(self, file_id, default=None):
+        """
+        读取缓存条目并更新使用记录
+
+        参数 file_id: 知识库文件ID
+        参数 default: 未命中时的返回值
+        返回值: 向量存储对象
+        """
+        with self._lock:
+            vectorstore = self._entries.get(file_id)
+            if vectorstore is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(file_id)
+            self._uses[file_id] += 1
+            return vectorstore
+
+    def put(self, file_id, vectorstore):
+        """
+        写入缓存条目，超出预算时淘汰其他条目
+
+        参数 file_id: 知识库文件ID
+        参数 vectorstore: 向量存储对象
+        """
+        size = estimate_vectorstore_bytes(vectorstore)
+        with self._lock:
+            self._remove(file_id)
+            self._entries[file_id] = vectorstore
+            self._sizes[file_id] = size
+            self._uses[file_id] = 1
+            self._total_bytes += size
+            self._evict(keep=file_id)
+
+    def pop(self, file_id, default=None):
+        """
+        删除缓存条目
+
+        参数 file_id: 知识库文件ID
+        参数 default: 不存在时的返回值
+        返回值: 被删除的向量存储对象
+        """
+        with self._lock:
+            vectorstore = self._remove(file_id)
+            return default if vectorstore is None else vectorstore
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._uses.clear()
+            self._total_bytes = 0
+
+    def _remove(self, file_id):
+        """删除条目并更新占用，调用方需持有锁"""
+        vectorstore = self._entries.pop(file_id, None)
+        if vectorstore is not None:
+            self._total_bytes -= self._sizes.pop(file_id)
+            self._uses.pop(file_id, None)
+        return vectorstore
+
+    def _evict(self, keep=None):
+        """淘汰条目直到总占用不超过预算，刚写入的条目不淘汰，调用方需持有锁"""
+        if not self.max_bytes:
+            return
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            candidates = [file_id for file_id in self._entries if file_id != keep]
+            if self.policy == "lfu":
+                # 使用次数最少的条目，次数相同时淘汰最久未使用的
+                victim = min(candidates, key=lambda file_id: self._uses[file_id])
+            else:
+                victim = candidates[0]
+            self._remove(victim)
+            self.evictions += 1
+        if self._total_bytes > self.max_bytes:
+            print(f"单个向量存储大小超过缓存预算: {self._total_bytes} > {self.max_bytes} 字节")
+
+    def stats(self):
+        """
+        返回缓存统计
+
+        返回值: 包含条目数、占用、预算、命中率和淘汰次数的字典
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "policy": self.policy,
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "evictions": self.evictions,
+            }
+
+
 # 全局向量存储缓存
-vectorstore_cache = {}
\ No newline at end of file
+vectorstore_cache = VectorStoreCache()
+
+
+def get_vectorstore(file_id, file_path, file_type=None, file_name=None, progress_callback=None, raw=False):
+    """
+    获取知识库文件的向量存储
+
+    先查进程内缓存；未命中时按文件内容哈希从磁盘加载持久化索引，
+    磁盘上也没有时才解析并嵌入文件（构建结果会写回磁盘）
+
+    参数 file_id: 知识库文件ID
+    参数 file_path: 文件路径
+    参数 file_type: 文件扩展名，如 .pdf
+    参数 file_name: 原始文件名
+    参数 progress_callback: 嵌入进度回调，参数为已嵌入的分片数，可选
+    参数 raw: True时返回保存float32原始向量的向量存储（从磁盘加载，不经过进程内缓存），
+        用于并入或重建统一索引；进程内缓存中的副本可能已量化为float16/int8
+    返回值: FAISS向量存储对象
+    """
+    if not raw:
+        vectorstore = vectorstore_cache.get(file_id)
+        if vectorstore is not None:
+            return vectorstore
+
+    from langchain_community.vectorstores import FAISS
+    from tools.vectorstore import build_vectorstore_for_file
+    from tools.index_factory import quantize_flat_index
+    vectorstore = build_vectorstore_for_file(file_path, file_type, file_name, progress_callback)
+    # 磁盘上保留float32原始向量，进程内缓存按 KB_VECTOR_PRECISION 转为float16/int8存储以节省内存；
+    # 缓存的是量化后的副本，返回给调用方的原始向量存储不受影响
+    if raw and file_id in vectorstore_cache:
+        return vectorstore
+    cached = FAISS(vectorstore.embedding_function, quantize_flat_index(vectorstore.index),
+                   vectorstore.docstore, vectorstore.index_to_docstore_id)
+    vectorstore_cache[file_id] = cached
+    return vectorstore if raw else cached
@@ -5,8 +5,12 @@
 @Desc    : 项目主入口文件 
 """
 import os
+import time
+_import_start_time = time.time()
+
 from dotenv import load_dotenv
 from agents.base_agent import build_agent
+from app.startup import startup_tracker
 os.environ["GRPC_VERBOSITY"] = "ERROR"
 os.environ["GLOG_minloglevel"] = "2"
 
@@ -20,8 +24,14 @@ if not os.getenv('GOOGLE_API_KEY'):
     print("请在.env文件中配置您的API密钥，格式为: GOOGLE_API_KEY=your_api_key_here")
 
 
+startup_tracker.record("imports", time.time() - _import_start_time)
+
+
 def run():
-    agent = build_agent()
+    # 预设PDF检索器和知识库索引在首次检索时才加载，这里只初始化agent
+    with startup_tracker.phase("agent"):
+        agent = build_agent()
+    startup_tracker.print_report()
 
     print("🔧 智能体已启动... 输入 exit 退出")
 
@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+"""
+@File    : blip_onnx.py
+@Time    : 2025/10/19 16:30
+@Desc    : BLIP图像描述模型的ONNX Runtime推理后端，导出视觉编码器和带KV缓存的文本解码器，可选int8动态量化，导出结果缓存在本地
+
+用法:
+    python multimodal/blip_onnx.py --export
+    python multimodal/blip_onnx.py --benchmark data/Surfing_in_Hawaii.png knowledge_base/*.png
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import threading
+
+import numpy as np
+
+# 添加项目根目录到Python路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools.onnx_utils import (
+    ONNX_INTRA_OP_THREADS, ONNX_OPSET, artifact_dir, create_session, export_onnx, publish_dir, quantize_int8,
+    staging_dir,
+)
+
+# 是否使用int8动态量化的模型
+CAPTION_ONNX_QUANTIZE = os.getenv("CAPTION_ONNX_QUANTIZE", "1").lower() not in ("0", "false", "no", "off")
+
+VISION_ENCODER_FILE = "vision_encoder.onnx"
+TEXT_DECODER_FILE = "text_decoder.onnx"
+CONFIG_FILE = "blip_onnx.json"
+# 解码器导出格式，与已导出模型的配置不一致时重新导出
+DECODER_FORMAT = "kv-cache"
+
+
+def export_blip(model_name, output_dir, quantize=CAPTION_ONNX_QUANTIZE):
+    """
+    把BLIP模型导出为ONNX：
+
+    - 视觉编码器：图像 -> 文本解码器各层交叉注意力的K/V，每张图片只计算一次
+    - 文本解码器：每步输入一个新token和此前各层自注意力的K/V缓存，输出该token的logits和追加后的K/V缓存，
+      每步的计算量与已生成的长度无关，不再重复计算整个前缀
+
+    K/V按层堆叠为 [层数, batch, 头数, 长度, 每头维度] 的张量，输入输出名称与层数无关。
+    先导出到临时目录，完成后重命名为目标目录，其他进程不会读到导出一半的模型
+
+    参数 model_name: HuggingFace模型名称
+    参数 output_dir: 导出目录
+    参数 quantize: 是否对权重做int8动态量化
+    """
+    import math
+    import torch
+    from transformers import BlipProcessor, BlipForConditionalGeneration
+
+    def split_heads(states, attention):
+        """[batch, 长度, 隐层] -> [batch, 头数, 长度, 每头维度]"""
+        batch, length, _ = states.shape
+        return states.view(batch, length, attention.num_attention_heads, attention.attention_head_size).transpose(1, 2)
+
+    def attend(query, keys, values, attention):
+        """缩放点积注意力，与 BlipTextSelfAttention 的计算一致，返回 [batch, 长度, 隐层]"""
+        scores = torch.matmul(query, keys.transpose(-1, -2)) / math.sqrt(attention.attention_head_size)
+        context = torch.matmul(torch.softmax(scores, dim=-1), values)
+        return context.permute(0, 2, 1, 3).flatten(2)
+
+    class VisionEncoder(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.vision_model = model.vision_model
+            self.layers = model.text_decoder.bert.encoder.layer
+
+        def forward(self, pixel_values):
+            image_embeds = self.vision_model(pixel_values=pixel_values, return_dict=False)[0]
+            cross = [layer.crossattention.self for layer in self.layers]
+            keys = torch.stack([split_heads(attention.key(image_embeds), attention) for attention in cross])
+            values = torch.stack([split_heads(attention.value(image_embeds), attention) for attention in cross])
+            return keys, values
+
+    class TextDecoderStep(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.embeddings = model.text_decoder.bert.embeddings
+            self.layers = model.text_decoder.bert.encoder.layer
+            self.transform = model.text_decoder.cls.predictions.transform
+            self.decoder = model.text_decoder.cls.predictions.decoder
+
+        def forward(self, input_ids, past_keys, past_values, cross_keys, cross_values):
+            # 新token的位置编号等于已缓存的长度
+            position_ids = torch.arange(past_keys.shape[3], past_keys.shape[3] + input_ids.shape[1]).unsqueeze(0)
+            hidden = self.embeddings.LayerNorm(self.embeddings.word_embeddings(input_ids)
+                                               + self.embeddings.position_embeddings(position_ids))
+            present_keys, present_values = [], []
+            for i, layer in enumerate(self.layers):
+                attention = layer.attention.self
+                keys = torch.cat([past_keys[i], split_heads(attention.key(hidden), attention)], dim=2)
+                values = torch.cat([past_values[i], split_heads(attention.value(hidden), attention)], dim=2)
+                present_keys.append(keys)
+                present_values.append(values)
+                context = attend(split_heads(attention.query(hidden), attention), keys, values, attention)
+                attention_output = layer.attention.output(context, hidden)
+
+                cross = layer.crossattention.self
+                context = attend(split_heads(cross.query(attention_output), cross), cross_keys[i], cross_values[i], cross)
+                attention_output = layer.crossattention.output(context, attention_output)
+                hidden = layer.output(layer.intermediate(attention_output), attention_output)
+            # 输出层与词向量共享权重，按转置后的矩阵相乘，导出后是独立的常量，量化时不会改写词向量
+            logits = torch.matmul(self.transform(hidden[:, -1]), self.decoder.weight.t()) + self.decoder.bias
+            return logits, torch.stack(present_keys), torch.stack(present_values)
+
+    start_time = time.time()
+    print(f"导出ONNX图像描述模型: {model_name} -> {output_dir}")
+    processor = BlipProcessor.from_pretrained(model_name)
+    model = BlipForConditionalGeneration.from_pretrained(model_name).eval()
+    text_config = model.config.text_config
+
+    tmp_dir = staging_dir(output_dir)
+    fp32_dir = os.path.join(tmp_dir, "fp32") if quantize else tmp_dir
+    os.makedirs(fp32_dir, exist_ok=True)
+
+    size = processor.image_processor.size
+    pixel_values = torch.zeros(1, 3, size["height"], size["width"])
+    vision_encoder = VisionEncoder(model)
+    with torch.no_grad():
+        cross_keys, cross_values = vision_encoder(pixel_values)
+    # 示例输入使用非空的K/V缓存，导出的图不会把缓存长度固定为0
+    input_ids = torch.tensor([[text_config.sep_token_id]], dtype=torch.long)
+    past_keys = torch.zeros(cross_keys.shape[:3] + (1, cross_keys.shape[4]))
+
+    cache_axes = {1: "batch", 3: "past"}
+    export_onnx(
+        vision_encoder, (pixel_values,), os.path.join(fp32_dir, VISION_ENCODER_FILE),
+        input_names=["pixel_values"], output_names=["cross_keys", "cross_values"],
+        dynamic_axes={"pixel_values": {0: "batch"}, "cross_keys": {1: "batch"}, "cross_values": {1: "batch"}},
+        opset_version=ONNX_OPSET,
+    )
+    export_onnx(
+        TextDecoderStep(model), (input_ids, past_keys, past_keys.clone(), cross_keys, cross_values),
+        os.path.join(fp32_dir, TEXT_DECODER_FILE),
+        input_names=["input_ids", "past_keys", "past_values", "cross_keys", "cross_values"],
+        output_names=["logits", "present_keys", "present_values"],
+        dynamic_axes={
+            "input_ids": {0: "batch"},
+            "past_keys": cache_axes,
+            "past_values": cache_axes,
+            "cross_keys": {1: "batch"},
+            "cross_values": {1: "batch"},
+            "logits": {0: "batch"},
+            "present_keys": cache_axes,
+            "present_values": cache_axes,
+        },
+        opset_version=ONNX_OPSET,
+    )
+
+    if quantize:
+        for file_name in (VISION_ENCODER_FILE, TEXT_DECODER_FILE):
+            quantize_int8(os.path.join(fp32_dir, file_name), os.path.join(tmp_dir, file_name))
+        shutil.rmtree(fp32_dir)
+
+    processor.save_pretrained(tmp_dir)
+    with open(os.path.join(tmp_dir, CONFIG_FILE), "w", encoding="utf-8") as f:
+        json.dump({
+            "model_name": model_name,
+            "quantize": quantize,
+            "decoder": DECODER_FORMAT,
+            "bos_token_id": text_config.bos_token_id,
+            "eos_token_id": text_config.sep_token_id,
+            "pad_token_id": text_config.pad_token_id,
+        }, f, ensure_ascii=False, indent=2)
+
+    publish_dir(tmp_dir, output_dir)
+    print(f"ONNX图像描述模型导出完成，耗时: {time.time() - start_time:.2f}秒")
+
+
+def load_export_config(model_dir):
+    """
+    读取已导出模型的配置；格式过期的导出（解码器每步输入整个前缀、不支持K/V缓存）会被删除
+
+    参数 model_dir: 导出目录
+    返回值: 配置字典，未导出或格式过期时返回None
+    """
+    config_path = os.path.join(model_dir, CONFIG_FILE)
+    if not os.path.exists(config_path):
+        return None
+    with open(config_path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+    if config.get("decoder") != DECODER_FORMAT:
+        print(f"ONNX图像描述模型格式已过期，重新导出: {model_dir}")
+        shutil.rmtree(model_dir, ignore_errors=True)
+        return None
+    return config
+
+
+class BlipOnnxCaptioner:
+    """
+    基于ONNX Runtime的BLIP图像描述生成器
+
+    视觉编码器每张图片只运行一次并给出交叉注意力的K/V，文本解码器按贪心解码逐token生成，
+    每步只输入新token和自注意力的K/V缓存；推理只依赖onnxruntime和numpy，不需要导入PyTorch
+    """
+
+    def __init__(self, model_name, quantize=CAPTION_ONNX_QUANTIZE, model_dir=None, num_threads=ONNX_INTRA_OP_THREADS):
+        """
+        参数 model_name: HuggingFace模型名称
+        参数 quantize: 是否使用int8量化模型
+        参数 model_dir: 导出目录，默认 artifact_dir(model_name, quantize)
+        参数 num_threads: 算子内并行线程数，0表示由ONNX Runtime决定
+        """
+        from transformers import BlipProcessor
+
+        self.model_dir = model_dir or artifact_dir(model_name, quantize)
+        config = load_export_config(self.model_dir)
+        if config is None:
+            export_blip(model_name, self.model_dir, quantize)
+            config = load_export_config(self.model_dir)
+        self.bos_token_id = config["bos_token_id"]
+        self.eos_token_id = config["eos_token_id"]
+        self.pad_token_id = config["pad_token_id"]
+
+        self.vision_session = create_session(os.path.join(self.model_dir, VISION_ENCODER_FILE), num_threads)
+        self.decoder_session = create_session(os.path.join(self.model_dir, TEXT_DECODER_FILE), num_threads)
+        self.processor = BlipProcessor.from_pretrained(self.model_dir)
+
+    def caption(self, images, max_new_tokens=50):
+        """
+        为一批图片生成描述
+
+        参数 images: PIL图像列表
+        参数 max_new_tokens: 最多生成的token数
+        返回值: 与图片顺序一致的描述列表
+        """
+        pixel_values = self.processor(images=images, return_tensors="np")["pixel_values"].astype(np.float32)
+        cross_keys, cross_values = self.vision_session.run(None, {"pixel_values": pixel_values})
+
+        batch_size = len(images)
+        input_ids = np.full((batch_size, 1), self.bos_token_id, dtype=np.int64)
+        # 自注意力K/V缓存，初始长度为0，每步追加一个位置
+        past_keys = np.zeros(cross_keys.shape[:3] + (0, cross_keys.shape[4]), dtype=np.float32)
+        past_values = past_keys
+        finished = np.zeros(batch_size, dtype=bool)
+        for _ in range(max_new_tokens):
+            logits, past_keys, past_values = self.decoder_session.run(None, {
+                "input_ids": input_ids[:, -1:],
+                "past_keys": past_keys,
+                "past_values": past_values,
+                "cross_keys": cross_keys,
+                "cross_values": cross_values,
+            })
+            next_tokens = np.where(finished, self.pad_token_id, logits.argmax(axis=-1))
+            input_ids = np.concatenate([input_ids, next_tokens[:, None].astype(np.int64)], axis=1)
+            finished |= next_tokens == self.eos_token_id
+            if finished.all():
+                break
+        return [caption.strip() for caption in self.processor.batch_decode(input_ids, skip_special_tokens=True)]
+
+
+# 全局ONNX描述生成器，首次使用时加载（必要时先导出）
+_captioner = None
+_captioner_lock = threading.Lock()
+
+
+def get_onnx_captioner(model_name):
+    """
+    获取全局ONNX图像描述生成器
+
+    参数 model_name: HuggingFace模型名称
+    返回值: BlipOnnxCaptioner实例
+    """
+    global _captioner
+    if _captioner is None:
+        with _captioner_lock:
+            if _captioner is None:
+                start_time = time.time()
+                _captioner = BlipOnnxCaptioner(model_name)
+                print(f"ONNX图像描述模型加载完成，耗时: {time.time() - start_time:.2f}秒")
+    return _captioner
+
+
+def caption_agreement(reference, candidate):
+    """
+    两组描述的一致程度
+
+    参数 reference: 基准描述列表（PyTorch）
+    参数 candidate: 待比较的描述列表（ONNX）
+    返回值: (完全一致的比例, 平均词集合Jaccard相似度)
+    """
+    exact = sum(1 for a, b in zip(reference, candidate) if a == b) / len(reference)
+    jaccard = []
+    for a, b in zip(reference, candidate):
+        words_a, words_b = set(a.split()), set(b.split())
+        union = words_a | words_b
+        jaccard.append(len(words_a & words_b) / len(union) if union else 1.0)
+    return exact, float(np.mean(jaccard))
+
+
+def run_benchmark(image_paths, runs=3, quantize=CAPTION_ONNX_QUANTIZE, num_threads=ONNX_INTRA_OP_THREADS):
+    """
+    对比PyTorch和ONNX Runtime后端的单张图片描述延迟和描述一致性
+
+    参数 image_paths: 测试图片路径列表
+    参数 runs: 每张图片重复的次数
+    参数 quantize: ONNX后端是否使用int8量化模型
+    参数 num_threads: ONNX Runtime算子内并行线程数
+    """
+    from multimodal.image_captioning import MODEL_NAME, load_image, _generate_captions_torch
+
+    images = [load_image(path) for path in image_paths]
+    onnx_captioner = BlipOnnxCaptioner(MODEL_NAME, quantize=quantize, num_threads=num_threads)
+    backends = [
+        ("pytorch", _generate_captions_torch),
+        ("onnx-int8" if quantize else "onnx", onnx_captioner.caption),
+    ]
+
+    results = {}
+    for name, generate in backends:
+        # 预热，排除首次推理的初始化开销
+        generate(images[:1])
+        latencies = []
+        for _ in range(runs):
+            for image in images:
+                start = time.perf_counter()
+                generate([image])
+                latencies.append((time.perf_counter() - start) * 1000)
+        results[name] = {
+            "captions": [generate([image])[0] for image in images],
+            "p50": float(np.percentile(latencies, 50)),
+            "p99": float(np.percentile(latencies, 99)),
+        }
+
+    baseline = results["pytorch"]
+    print(f"{'后端':<12}{'p50(ms)':>10}{'p99(ms)':>10}{'加速比':>8}{'完全一致':>10}{'词重合度':>10}")
+    for name, result in results.items():
+        exact, jaccard = caption_agreement(baseline["captions"], result["captions"])
+        print(f"{name:<12}{result['p50']:>10.1f}{result['p99']:>10.1f}{baseline['p50'] / result['p50']:>8.2f}"
+              f"{exact:>10.2%}{jaccard:>10.2%}")
+    for i, path in enumerate(image_paths):
+        print(f"\n{path}")
+        for name, result in results.items():
+            print(f"  {name:<12}{result['captions'][i]}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="BLIP图像描述模型ONNX导出与基准测试")
+    parser.add_argument("images", nargs="*", help="基准测试使用的图片")
+    parser.add_argument("--export", action="store_true", help="只导出ONNX模型")
+    parser.add_argument("--benchmark", action="store_true", help="对比PyTorch和ONNX后端的延迟与描述一致性")
+    parser.add_argument("--quantize", action=argparse.BooleanOptionalAction, default=CAPTION_ONNX_QUANTIZE,
+                        help="使用int8量化模型，--no-quantize 使用未量化的float32模型")
+    parser.add_argument("--threads", type=int, default=ONNX_INTRA_OP_THREADS, help="ONNX Runtime算子内并行线程数")
+    parser.add_argument("--runs", type=int, default=3, help="每张图片重复的次数")
+    args = parser.parse_args()
+
+    from multimodal.image_captioning import MODEL_NAME
+
+    quantize = args.quantize
+    if args.export:
+        output_dir = artifact_dir(MODEL_NAME, quantize)
+        if load_export_config(output_dir) is not None:
+            print(f"ONNX模型已存在: {output_dir}")
+        else:
+            export_blip(MODEL_NAME, output_dir, quantize)
+    if args.benchmark:
+        if not args.images:
+            parser.error("--benchmark 需要指定测试图片")
+        run_benchmark(args.images, runs=args.runs, quantize=quantize, num_threads=args.threads)
@@ -2,20 +2,42 @@
 """
 @File    : image_captioning.py
 @Time    : 2025/9/25 15:20
-@Desc    : 图像描述生成模块，用于将图像内容转换为文本描述 
+@Desc    : 图像描述生成模块，用于将图像内容转换为文本描述，按图片内容哈希缓存描述，支持批量推理
 """
+import os
+import sys
 import time
-# 从transformers库导入BlipProcessor和BlipForConditionalGeneration类
-from transformers import BlipProcessor, BlipForConditionalGeneration
+import threading
 # 从Pillow库导入Image类，用于处理图像
 from PIL import Image
 
+# 添加项目根目录到Python路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cache.caption_cache import image_key, get_caption_store
+
 # 全局变量，用于缓存模型和处理器
 _processor = None
 _model = None
+# 模型推理不是线程安全的，同一时间只执行一个批次
+_model_lock = threading.Lock()
 
 # 模型名称常量
 MODEL_NAME = "Salesforce/blip-image-captioning-base"
+# 推理后端: torch 使用PyTorch / onnx 使用ONNX Runtime（首次使用时导出模型，见 multimodal/blip_onnx.py）
+CAPTION_BACKEND = os.getenv("CAPTION_BACKEND", "torch").lower()
+# 每个批次的图片数量
+CAPTION_BATCH_SIZE = int(os.getenv("CAPTION_BATCH_SIZE", "8"))
+# 预处理前将图片长边缩小到该像素数以内（BLIP输入为384x384），避免完整解码和缩放大图
+CAPTION_MAX_SIDE = int(os.getenv("CAPTION_MAX_SIDE", "768"))
+# 图片描述持久化缓存（SQLite）路径，设置为空字符串可关闭
+CAPTION_CACHE_DB = os.getenv("CAPTION_CACHE_DB", os.path.join(
+    os.getenv("FAISS_INDEX_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                              "faiss_index")),
+    "captions.sqlite"
+))
+# 生成描述的最大token数
+MAX_NEW_TOKENS = 50
 
 def _load_model_if_needed():
     """
@@ -23,30 +45,106 @@ def _load_model_if_needed():
     """
     global _processor, _model
     if _processor is None or _model is None:
+        # 从transformers库导入BlipProcessor和BlipForConditionalGeneration类
+        from transformers import BlipProcessor, BlipForConditionalGeneration
+
         start_time = time.time()
         print(f"加载图像描述生成模型: {MODEL_NAME}")
         # 从预训练模型加载BlipProcessor
         _processor = BlipProcessor.from_pretrained(MODEL_NAME)
-        # 从预训练模型加载BlipForConditionalGeneration
-        _model = BlipForConditionalGeneration.from_pretrained(MODEL_NAME)
+        # 从预训练模型加载BlipForConditionalGeneration，切换到推理模式
+        _model = BlipForConditionalGeneration.from_pretrained(MODEL_NAME).eval()
         print(f"图像描述生成模型加载完成，耗时: {time.time() - start_time:.2f}秒")
 
+def get_caption_cache():
+    """
+    获取图片描述缓存，CAPTION_CACHE_DB为空时返回None
+    """
+    return get_caption_store(CAPTION_CACHE_DB) if CAPTION_CACHE_DB else None
+
+def caption_model_id():
+    """
+    描述缓存使用的模型标识，不同推理后端生成的描述可能略有差异，分别缓存
+    """
+    if CAPTION_BACKEND == "onnx":
+        from multimodal.blip_onnx import CAPTION_ONNX_QUANTIZE
+        return f"{MODEL_NAME}|onnx{'-int8' if CAPTION_ONNX_QUANTIZE else ''}"
+    return MODEL_NAME
+
+# 打开图片并缩小到 CAPTION_MAX_SIDE 以内
+# 参数 image_path: 图像文件的路径
+# 返回值: RGB格式的PIL图像
+def load_image(image_path: str, max_side: int = CAPTION_MAX_SIDE) -> Image.Image:
+    image = Image.open(image_path)
+    if max_side:
+        # JPEG在解码时直接按比例缩小，不必解码完整分辨率
+        image.draft("RGB", (max_side, max_side))
+    image = image.convert("RGB")
+    if max_side and max(image.size) > max_side:
+        image.thumbnail((max_side, max_side), Image.BICUBIC)
+    return image
+
+# 使用PyTorch对一批图片执行BLIP推理
+# 参数 images: PIL图像列表
+# 返回值: 与图片顺序一致的描述列表
+def _generate_captions_torch(images):
+    import torch
+
+    _load_model_if_needed()
+    with _model_lock, torch.inference_mode():
+        # 使用processor对图像进行处理，转换为PyTorch张量
+        inputs = _processor(images=images, return_tensors="pt")
+        # 使用模型生成图像的字幕，最多生成50个新token
+        output = _model.generate(**inputs, max_new_tokens=MAX_NEW_TOKENS)
+    # 对模型输出进行解码，跳过特殊token，得到最终的字幕文本
+    return [caption.strip() for caption in _processor.batch_decode(output, skip_special_tokens=True)]
+
+# 按 CAPTION_BACKEND 选择推理后端，对一批图片生成描述
+# 参数 images: PIL图像列表
+# 返回值: 与图片顺序一致的描述列表
+def _generate_captions(images):
+    if CAPTION_BACKEND == "onnx":
+        from multimodal.blip_onnx import get_onnx_captioner
+        captioner = get_onnx_captioner(MODEL_NAME)
+        with _model_lock:
+            return captioner.caption(images, max_new_tokens=MAX_NEW_TOKENS)
+    return _generate_captions_torch(images)
+
+# 批量为图像生成字幕
+# 内容相同的图片只推理一次，已缓存的图片直接返回缓存的描述，其余按 batch_size 分批推理
+# 参数 image_paths: 图像文件路径列表
+# 参数 batch_size: 每批推理的图片数量
+# 返回值: 与输入顺序一致的字幕列表
+def caption_images(image_paths, batch_size: int = CAPTION_BATCH_SIZE):
+    image_paths = list(image_paths)
+    hashes = [image_key(path) for path in image_paths]
+    cache = get_caption_cache()
+    model_id = caption_model_id()
+    captions = cache.get_many(hashes, model_id) if cache is not None else {}
+
+    # 未缓存的图片按内容去重
+    pending = {}
+    for path, image_hash in zip(image_paths, hashes):
+        if image_hash not in captions:
+            pending.setdefault(image_hash, path)
+    pending = list(pending.items())
+    if pending:
+        start_time = time.time()
+        for start in range(0, len(pending), max(1, batch_size)):
+            batch = pending[start:start + max(1, batch_size)]
+            results = _generate_captions([load_image(path) for _, path in batch])
+            new_captions = [(image_hash, caption) for (image_hash, _), caption in zip(batch, results)]
+            captions.update(new_captions)
+            if cache is not None:
+                cache.put_many(new_captions, model_id)
+        print(f"生成 {len(pending)} 张图片的描述，耗时: {time.time() - start_time:.2f}秒")
+    return [captions[image_hash] for image_hash in hashes]
+
 # 定义一个函数，用于为指定路径的图像生成字幕
 # 参数 image_path: 图像文件的路径，类型为字符串
 # 返回值: 生成的图像字幕，类型为字符串
 def caption_image(image_path: str) -> str:
-    # 确保模型已加载
-    _load_model_if_needed()
-    
-    # 打开指定路径的图像文件，并将其转换为RGB格式
-    image = Image.open(image_path).convert("RGB")
-    # 使用processor对图像进行处理，转换为PyTorch张量
-    inputs = _processor(images=image, return_tensors="pt")
-    # 使用模型生成图像的字幕，最多生成50个新token
-    output = _model.generate(**inputs, max_new_tokens=50)
-    # 对模型输出进行解码，跳过特殊token，得到最终的字幕文本
-    caption = _processor.decode(output[0], skip_special_tokens=True)
-    return caption
+    return caption_images([image_path])[0]
 
 if __name__ == '__main__':
     # 调用caption_image函数，为指定路径的图像生成字幕
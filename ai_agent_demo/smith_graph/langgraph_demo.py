@@ -1,13 +1,17 @@
 import os
+import sys
 import sqlite3
 from typing import TypedDict, Literal, Optional
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.tracers import LangChainTracer
-from langchain_openai import ChatOpenAI
 from langchain_core.output_parsers import StrOutputParser
 from langgraph.checkpoint.sqlite import SqliteSaver
 from langgraph.graph import StateGraph, END
 
+# 添加项目根目录到Python路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from agents.llm_clients import get_chat_model
+
 # LangSmith配置
 os.environ["LANGCHAIN_TRACING_V2"] = "true"
 os.environ["LANGCHAIN_PROJECT"] = "default"
@@ -26,16 +30,42 @@ class AgentState(TypedDict):
     response: Optional[str]
 
 
-# 初始化大语言模型
-llm = ChatOpenAI(
+# 初始化大语言模型（共享客户端，复用HTTP连接池）
+llm = get_chat_model(
     model='deepseek-chat',
-    openai_api_key=os.getenv('DEEPSEEK_API_KEY'),  # 从环境变量获取API密钥
-    openai_api_base='https://api.deepseek.com/v1',  # DeepSeek API端点
+    api_key_env='DEEPSEEK_API_KEY',  # 从环境变量获取API密钥
+    base_url='https://api.deepseek.com/v1',  # DeepSeek API端点
     temperature=0,  # 控制生成结果的随机性
     callbacks=[tracing_handler]  # 集成 LangSmith
 )
 output_parser = StrOutputParser()  # 用于解析LLM输出的纯文本结果
 
+# 各节点的提示词模板，键为处理链名称
+PROMPT_TEMPLATES = {
+    "classify": "请判断用户问题类型，只返回普通问题/技术问题/投诉问题，不要包含任何格式符号或额外文字。问题内容：{input}",
+    "普通问题": "你是一个客服助手，请用纯文本回答以下普通问题，不要包含任何格式符号或标记。问题：{input}",
+    "技术问题": "你是一名技术支持工程师，请用纯文本回答以下技术问题，不要包含任何格式符号或标记。技术问题：{input}",
+    "投诉问题": "你是一名投诉处理专员，请用纯文本回答以下投诉，不要包含任何格式符号或标记。投诉内容：{input}",
+}
+
+
+def build_chains(model, templates=PROMPT_TEMPLATES):
+    """预先构建所有节点的处理链
+    Args:
+        model: 大语言模型
+        templates: {处理链名称: 提示词模板}
+    Returns:
+        {处理链名称: prompt | model | output_parser}
+    """
+    return {
+        name: ChatPromptTemplate.from_template(template) | model | output_parser
+        for name, template in templates.items()
+    }
+
+
+# 处理链注册表，在编译工作流时构建，节点执行时直接复用
+chains = {}
+
 
 def safe_set_intent(value: str) -> Optional[Literal["普通问题", "技术问题", "投诉问题"]]:
     """安全设置问题分类
@@ -54,11 +84,7 @@ def classify_intent(state: AgentState) -> AgentState:
     Returns:
         更新后的状态(包含分类结果)
     """
-    prompt = ChatPromptTemplate.from_template(
-        "请判断用户问题类型，只返回普通问题/技术问题/投诉问题，不要包含任何格式符号或额外文字。问题内容：{input}"
-    )
-    chain = prompt | llm | output_parser  # 构建处理链
-    intent = chain.invoke({"input": state["user_input"]}).strip()
+    intent = chains["classify"].invoke({"input": state["user_input"]}).strip()
     return {
         "user_input": state["user_input"],
         "intent": safe_set_intent(intent),  # 安全设置分类
@@ -66,13 +92,15 @@ def classify_intent(state: AgentState) -> AgentState:
     }
 
 
-def handle_general(state: AgentState) -> AgentState:
-    """普通问题处理节点"""
-    prompt = ChatPromptTemplate.from_template(
-        "你是一个客服助手，请用纯文本回答以下普通问题，不要包含任何格式符号或标记。问题：{input}"
-    )
-    chain = prompt | llm | output_parser
-    response = chain.invoke({"input": state["user_input"]})
+def respond(state: AgentState, chain_name: str) -> AgentState:
+    """使用指定处理链生成回复
+    Args:
+        state: 当前对话状态
+        chain_name: 处理链名称
+    Returns:
+        更新后的状态(包含响应内容)
+    """
+    response = chains[chain_name].invoke({"input": state["user_input"]})
     return {
         "user_input": state["user_input"],
         "intent": state.get("intent"),
@@ -80,32 +108,19 @@ def handle_general(state: AgentState) -> AgentState:
     }
 
 
+def handle_general(state: AgentState) -> AgentState:
+    """普通问题处理节点"""
+    return respond(state, "普通问题")
+
+
 def handle_tech(state: AgentState) -> AgentState:
     """技术问题处理节点"""
-    prompt = ChatPromptTemplate.from_template(
-        "你是一名技术支持工程师，请用纯文本回答以下技术问题，不要包含任何格式符号或标记。技术问题：{input}"
-    )
-    chain = prompt | llm | output_parser
-    response = chain.invoke({"input": state["user_input"]})
-    return {
-        "user_input": state["user_input"],
-        "intent": state.get("intent"),
-        "response": response
-    }
+    return respond(state, "技术问题")
 
 
 def handle_complaint(state: AgentState) -> AgentState:
     """投诉问题处理节点"""
-    prompt = ChatPromptTemplate.from_template(
-        "你是一名投诉处理专员，请用纯文本回答以下投诉，不要包含任何格式符号或标记。投诉内容：{input}"
-    )
-    chain = prompt | llm | output_parser
-    response = chain.invoke({"input": state["user_input"]})
-    return {
-        "user_input": state["user_input"],
-        "intent": state.get("intent"),
-        "response": response
-    }
+    return respond(state, "投诉问题")
 
 
 def decide_next_step(state: AgentState) -> str:
@@ -146,7 +161,8 @@ workflow.add_edge("投诉问题", END)
 # 设置入口点
 workflow.set_entry_point("classify")
 
-# 编译时启用检查点
+# 编译时构建处理链，并启用检查点
+chains.update(build_chains(llm))
 conn = sqlite3.connect("checkpoints.sqlite", check_same_thread=False)
 memory = SqliteSaver(conn)
 app = workflow.compile(checkpointer=memory)
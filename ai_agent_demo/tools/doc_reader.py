@@ -2,19 +2,119 @@
 """
 @File    : doc_reader.py
 @Time    : 2025/9/25 15:19
-@Desc    : 文档读取工具，支持PDF、TXT、DOCX等格式文档内容提取 
+@Desc    : 文档读取工具，支持PDF、TXT、DOCX等格式文档内容提取，可按字符数或页数限制只读取文件开头部分
 """
+import os
+import sys
+import zipfile
 from pathlib import Path
+from xml.etree import ElementTree
 
-from langchain_community.document_loaders import PyPDFLoader
+# 添加项目根目录到Python路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools.pdf_extract import iter_pdf_pages, iter_pdf_text
+
+# TXT文件每次读取的字符数
+TEXT_BLOCK_SIZE = 64 * 1024
+# DOCX正文XML的命名空间
+_WORD_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+
+def _iter_pdf_text(file_path, max_pages=None, bounded=False):
+    """
+    逐页产出PDF文本，页与页之间以换行分隔
+
+    bounded 为True时在当前进程内只解析前 max_pages 页，不读取文档元数据和页码标签；
+    否则由进程池并行解析全部页面
+    """
+    if bounded:
+        texts = iter_pdf_text(file_path, max_pages)
+    else:
+        texts = (doc.page_content for doc in iter_pdf_pages(file_path))
+    try:
+        for page_number, text in enumerate(texts):
+            yield text if page_number == 0 else "\n" + text
+    finally:
+        texts.close()
+
+
+def _iter_txt_text(file_path, block_size=TEXT_BLOCK_SIZE):
+    """按块读取UTF-8文本文件"""
+    with open(file_path, "r", encoding="utf-8", errors="replace") as f:
+        for block in iter(lambda: f.read(block_size), ""):
+            yield block
+
+
+def _iter_docx_text(file_path):
+    """
+    流式解析DOCX正文（word/document.xml），逐段落产出文本，
+    已处理的段落元素随即释放，不需要把整个XML树载入内存
+    """
+    with zipfile.ZipFile(file_path) as archive, archive.open("word/document.xml") as f:
+        parts = []
+        for _, elem in ElementTree.iterparse(f, events=("end",)):
+            if elem.tag == _WORD_NS + "t":
+                parts.append(elem.text or "")
+            elif elem.tag == _WORD_NS + "tab":
+                parts.append("\t")
+            elif elem.tag in (_WORD_NS + "br", _WORD_NS + "cr"):
+                parts.append("\n")
+            elif elem.tag == _WORD_NS + "p":
+                yield "".join(parts) + "\n"
+                parts = []
+                elem.clear()
+
+
+def iter_document_text(file_path, max_chars=None, max_pages=None):
+    """
+    流式读取文档文本，达到字符数或页数限制后立即停止读取，
+    预览和摘要的耗时与内存只取决于限制大小，与文件大小无关
+
+    参数 file_path: 文档文件路径，支持PDF/TXT/DOCX
+    参数 max_chars: 最多产出的字符数，None表示不限制
+    参数 max_pages: PDF最多读取的页数，None表示不限制；TXT/DOCX视为只有一页，不受此限制
+    返回值: 生成器，依次产出文本片段
+    """
+    file_ext = Path(file_path).suffix.lower()
+    if file_ext == '.pdf':
+        # 有读取上限时在当前进程内逐页解析，只解析需要的页面
+        pieces = _iter_pdf_text(file_path, max_pages, bounded=max_chars is not None or max_pages is not None)
+    elif file_ext == '.txt':
+        pieces = _iter_txt_text(file_path)
+    elif file_ext == '.docx':
+        pieces = _iter_docx_text(file_path)
+    else:
+        raise ValueError(f"不支持的文件格式: {file_ext}")
+
+    remaining = max_chars
+    try:
+        for piece in pieces:
+            if remaining is not None:
+                piece = piece[:remaining]
+                remaining -= len(piece)
+            if piece:
+                yield piece
+            if remaining is not None and remaining <= 0:
+                break
+    finally:
+        # 提前停止时关闭底层读取器（PDF会取消尚未开始的解析任务）
+        pieces.close()
+
+
+def read_document_text(file_path, max_chars=None, max_pages=None):
+    """
+    读取文档文本，参数同 iter_document_text
+
+    返回值: 文本字符串
+    """
+    return "".join(iter_document_text(file_path, max_chars=max_chars, max_pages=max_pages))
 
 
 def load_pdf_content(file_path: str) -> str:
     if not Path(file_path).exists():
         return f"文件 {file_path} 不存在"
-    loader = PyPDFLoader(file_path)
-    docs = loader.load()
-    return "\n".join([doc.page_content for doc in docs])
+    return read_document_text(file_path)
 
 
 if __name__ == '__main__':
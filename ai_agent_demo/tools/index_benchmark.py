@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+@File    : index_benchmark.py
+@Time    : 2025/10/17 19:40
+@Desc    : 索引基准测试，对比各类索引相对精确检索的 recall@k、单次查询 p50/p99 延迟、构建耗时和内存占用
+
+用法:
+    python tools/index_benchmark.py --num-vectors 200000 --dim 512
+    python tools/index_benchmark.py --from-kb --nprobe 8,16,32 --ef-search 32,64,128
+    python tools/index_benchmark.py --index-types flat,hnsw --precisions float32,int8
+"""
+import os
+import sys
+import time
+import argparse
+
+import faiss
+import numpy as np
+
+# 添加项目根目录到Python路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools.index_factory import (
+    INDEX_FLAT, INDEX_IVF, INDEX_HNSW, INDEX_IVFPQ, PRECISION_FLOAT32, PRECISION_FLOAT16, PRECISION_INT8,
+    PRECISION_PQ, build_index, index_memory_bytes, search_parameters,
+)
+
+
+def synthetic_vectors(num_vectors, dim, num_clusters=256, seed=0):
+    """
+    生成带聚类结构的随机向量，分布比均匀随机更接近真实文本嵌入
+
+    参数 num_vectors: 向量数量
+    参数 dim: 向量维度
+    参数 num_clusters: 聚类数量
+    参数 seed: 随机种子
+    返回值: 归一化后的float32向量矩阵
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((num_clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, num_clusters, num_vectors)
+    vectors = centers[labels] + 0.5 * rng.standard_normal((num_vectors, dim)).astype(np.float32)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def knowledge_base_vectors():
+    """
+    从知识库统一索引中取回全部分片向量
+
+    返回值: float32向量矩阵
+    """
+    from tools.kb_index import get_kb_index
+
+    kb_index = get_kb_index()
+    with kb_index._write_lock:
+        _, vectors = kb_index._collect_vectors()
+    return vectors
+
+
+def recall_at_k(ground_truth, result, k):
+    """
+    计算 recall@k：近似检索结果中命中精确检索前k个结果的比例
+
+    参数 ground_truth: 精确检索的编号矩阵 (nq, k)
+    参数 result: 待评估索引的编号矩阵 (nq, k)
+    参数 k: 结果数量
+    返回值: 0~1之间的召回率
+    """
+    hits = sum(len(set(truth[:k]) & set(found[:k])) for truth, found in zip(ground_truth, result))
+    return hits / (len(ground_truth) * k)
+
+
+def measure(index, queries, k, params=None):
+    """
+    逐条查询并记录延迟，与线上一次请求检索一次的方式一致
+
+    参数 index: FAISS索引
+    参数 queries: 查询向量矩阵
+    参数 k: 结果数量
+    参数 params: 检索参数
+    返回值: (编号矩阵, 延迟毫秒数组)
+    """
+    ids = np.zeros((len(queries), k), dtype=np.int64)
+    latencies = np.zeros(len(queries))
+    for i, query in enumerate(queries):
+        start_time = time.perf_counter()
+        _, found = index.search(query.reshape(1, -1), k, params=params)
+        latencies[i] = (time.perf_counter() - start_time) * 1000
+        ids[i] = found[0]
+    return ids, latencies
+
+
+def run_benchmark(vectors, queries, k=10, index_types=(INDEX_FLAT, INDEX_IVF, INDEX_HNSW, INDEX_IVFPQ),
+                  nprobes=(8, 16, 32, 64), ef_searches=(32, 64, 128),
+                  precisions=(PRECISION_FLOAT32, PRECISION_FLOAT16, PRECISION_INT8)):
+    """
+    构建各类索引并与精确检索对比
+
+    参数 vectors: 语料向量矩阵
+    参数 queries: 查询向量矩阵
+    参数 k: 结果数量
+    参数 index_types: 参与对比的索引类型
+    参数 nprobes: IVF类索引尝试的nprobe取值
+    参数 ef_searches: HNSW尝试的efSearch取值
+    参数 precisions: 向量存储精度取值，IVF-PQ使用乘积量化编码，只测试一次
+    返回值: 结果字典列表
+    """
+    ids = np.arange(len(vectors), dtype=np.int64)
+    # 基准结果始终使用float32精确检索，不受 KB_VECTOR_PRECISION 配置影响
+    exact = build_index(vectors, ids, INDEX_FLAT, precision=PRECISION_FLOAT32)
+    ground_truth, _ = measure(exact, queries, k)
+
+    combinations = [(index_type, PRECISION_PQ if index_type == INDEX_IVFPQ else precision)
+                    for index_type in index_types
+                    for precision in ((PRECISION_PQ,) if index_type == INDEX_IVFPQ else precisions)]
+    results = []
+    for index_type, precision in combinations:
+        start_time = time.time()
+        try:
+            index = build_index(vectors, ids, index_type, precision=precision)
+        except Exception as e:
+            print(f"构建 {index_type}/{precision} 索引失败: {str(e)}")
+            continue
+        build_seconds = time.time() - start_time
+        memory_mb = index_memory_bytes(index) / 1024 / 1024
+
+        if index_type in (INDEX_IVF, INDEX_IVFPQ):
+            settings = [("nprobe", value, search_parameters(index, nprobe=value)) for value in nprobes]
+        elif index_type == INDEX_HNSW:
+            settings = [("efSearch", value, search_parameters(index, ef_search=value)) for value in ef_searches]
+        else:
+            settings = [("-", "-", None)]
+
+        for name, value, params in settings:
+            found, latencies = measure(index, queries, k, params)
+            results.append({
+                "index_type": index_type,
+                "precision": precision,
+                "param": f"{name}={value}" if name != "-" else "-",
+                "recall": recall_at_k(ground_truth, found, k),
+                "p50_ms": float(np.percentile(latencies, 50)),
+                "p99_ms": float(np.percentile(latencies, 99)),
+                "build_seconds": build_seconds,
+                "memory_mb": memory_mb,
+            })
+    return results
+
+
+def print_results(results, k):
+    """以表格形式打印基准测试结果"""
+    print(f"{'索引类型':<10}{'精度':<8}{'参数':<16}{f'recall@{k}':>10}{'p50(ms)':>10}{'p99(ms)':>10}"
+          f"{'构建(秒)':>10}{'内存(MB)':>10}")
+    for row in results:
+        print(f"{row['index_type']:<12}{row['precision']:<10}{row['param']:<18}{row['recall']:>10.4f}{row['p50_ms']:>10.3f}"
+              f"{row['p99_ms']:>10.3f}{row['build_seconds']:>10.2f}{row['memory_mb']:>10.1f}")
+
+
+def _int_list(text):
+    """解析逗号分隔的整数列表"""
+    return [int(item) for item in text.split(",") if item.strip()]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="FAISS索引召回率与延迟基准测试")
+    parser.add_argument("--num-vectors", type=int, default=100000, help="合成语料的向量数量")
+    parser.add_argument("--dim", type=int, default=512, help="合成语料的向量维度")
+    parser.add_argument("--from-kb", action="store_true", help="使用知识库统一索引中的真实向量")
+    parser.add_argument("--num-queries", type=int, default=500, help="查询数量")
+    parser.add_argument("-k", type=int, default=10, help="recall@k 中的k")
+    parser.add_argument("--index-types", default="flat,ivf,hnsw,ivfpq", help="参与对比的索引类型")
+    parser.add_argument("--nprobe", default="8,16,32,64", help="IVF类索引的nprobe取值")
+    parser.add_argument("--ef-search", default="32,64,128", help="HNSW的efSearch取值")
+    parser.add_argument("--precisions", default="float32,float16,int8", help="参与对比的向量存储精度")
+    args = parser.parse_args()
+
+    if args.from_kb:
+        corpus = knowledge_base_vectors()
+        print(f"知识库向量: {corpus.shape[0]} 个，维度 {corpus.shape[1]}")
+    else:
+        corpus = synthetic_vectors(args.num_vectors, args.dim)
+        print(f"合成向量: {corpus.shape[0]} 个，维度 {corpus.shape[1]}")
+
+    # 查询取自语料并加入少量噪声，模拟与已有分片相近但不完全相同的问题
+    rng = np.random.default_rng(1)
+    sample = rng.choice(len(corpus), min(args.num_queries, len(corpus)), replace=False)
+    query_vectors = corpus[sample] + 0.05 * rng.standard_normal((len(sample), corpus.shape[1])).astype(np.float32)
+
+    benchmark_results = run_benchmark(
+        corpus, query_vectors, k=args.k,
+        index_types=[item.strip() for item in args.index_types.split(",") if item.strip()],
+        nprobes=_int_list(args.nprobe),
+        ef_searches=_int_list(args.ef_search),
+        precisions=[item.strip() for item in args.precisions.split(",") if item.strip()],
+    )
+    print_results(benchmark_results, args.k)
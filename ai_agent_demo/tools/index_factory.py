@@ -0,0 +1,485 @@
+# -*- coding: utf-8 -*-
+"""
+@File    : index_factory.py
+@Time    : 2025/10/17 19:00
+@Desc    : FAISS索引工厂，按向量规模选择精确检索(Flat)或近似检索(IVF / HNSW / IVF-PQ)，支持float16/int8标量量化存储，并提供检索参数
+"""
+import os
+import math
+
+import faiss
+import numpy as np
+
+# 索引类型
+INDEX_FLAT = "flat"
+INDEX_IVF = "ivf"
+INDEX_HNSW = "hnsw"
+INDEX_IVFPQ = "ivfpq"
+INDEX_AUTO = "auto"
+INDEX_TYPES = (INDEX_FLAT, INDEX_IVF, INDEX_HNSW, INDEX_IVFPQ)
+
+# 向量存储精度
+PRECISION_FLOAT32 = "float32"
+PRECISION_FLOAT16 = "float16"
+PRECISION_INT8 = "int8"
+# IVF-PQ使用乘积量化编码，不区分存储精度
+PRECISION_PQ = "pq"
+_SQ_TYPES = {
+    PRECISION_FLOAT16: faiss.ScalarQuantizer.QT_fp16,
+    PRECISION_INT8: faiss.ScalarQuantizer.QT_8bit,
+}
+
+# 知识库统一索引类型: auto 按向量数量自动选择，或固定为 flat / ivf / hnsw / ivfpq
+KB_INDEX_TYPE = os.getenv("KB_INDEX_TYPE", INDEX_AUTO).lower()
+# auto模式下向量数量低于该值时使用精确检索
+KB_INDEX_FLAT_MAX = int(os.getenv("KB_INDEX_FLAT_MAX", "50000"))
+# auto模式下向量数量达到该值时使用IVF-PQ压缩索引
+KB_INDEX_PQ_MIN = int(os.getenv("KB_INDEX_PQ_MIN", "1000000"))
+# IVF检索时访问的聚类数量，越大召回越高、速度越慢
+KB_INDEX_NPROBE = int(os.getenv("KB_INDEX_NPROBE", "16"))
+# HNSW检索时的候选队列长度，越大召回越高、速度越慢
+KB_INDEX_EF_SEARCH = int(os.getenv("KB_INDEX_EF_SEARCH", "64"))
+# HNSW每个节点的邻居数量
+KB_INDEX_HNSW_M = int(os.getenv("KB_INDEX_HNSW_M", "32"))
+# IVF-PQ子量化器数量，0表示按维度自动选择（每8维一个子量化器）
+KB_INDEX_PQ_M = int(os.getenv("KB_INDEX_PQ_M", "0"))
+# 向量存储精度: float32 / float16（内存减半）/ int8（标量量化，内存为1/4）
+KB_VECTOR_PRECISION = os.getenv("KB_VECTOR_PRECISION", PRECISION_FLOAT32).lower()
+if KB_VECTOR_PRECISION not in (PRECISION_FLOAT32, PRECISION_FLOAT16, PRECISION_INT8):
+    print(f"未知的向量存储精度 {KB_VECTOR_PRECISION}，使用float32")
+    KB_VECTOR_PRECISION = PRECISION_FLOAT32
+
+# int8标量量化按各维取值范围编码：向量数量少于该值时使用归一化向量的固定取值范围[-1, 1]，
+# 达到该值后用样本统计各维的实际取值范围（精度更高），规模继续增长后重新统计
+KB_SQ_MIN_TRAIN = int(os.getenv("KB_SQ_MIN_TRAIN", "1000"))
+# 统计int8取值范围最多使用的样本数量
+SQ_MAX_TRAIN = 100000
+# 嵌入向量已L2归一化，各维取值都在该范围内
+SQ_FIXED_RANGE = 1.0
+
+# 每个聚类中心至少需要的训练向量数量（低于该值FAISS会给出聚类质量警告）
+MIN_POINTS_PER_CENTROID = 39
+# 每个聚类中心最多使用的训练向量数量
+MAX_POINTS_PER_CENTROID = 256
+# PQ每个子量化器的编码位数
+PQ_NBITS = 8
+# IVF聚类数量范围
+MIN_NLIST = 16
+MAX_NLIST = 65536
+
+# 索引类型从精确到压缩的顺序，auto模式只向后升级，删除文件后不会降级
+_AUTO_ORDER = {INDEX_FLAT: 0, INDEX_IVF: 1, INDEX_IVFPQ: 2}
+
+
+def ivf_nlist(num_vectors):
+    """
+    按向量数量计算IVF聚类数量（约4*sqrt(N)）
+
+    参数 num_vectors: 向量数量
+    返回值: 聚类数量
+    """
+    return int(min(MAX_NLIST, max(MIN_NLIST, 4 * math.sqrt(max(num_vectors, 1)))))
+
+
+def pq_m(dim):
+    """
+    计算IVF-PQ子量化器数量，必须整除向量维度
+
+    参数 dim: 向量维度
+    返回值: 子量化器数量
+    """
+    if KB_INDEX_PQ_M > 0 and dim % KB_INDEX_PQ_M == 0:
+        return KB_INDEX_PQ_M
+    m = max(1, dim // 8)
+    while dim % m != 0:
+        m -= 1
+    return m
+
+
+def min_training_vectors(index_type, num_vectors):
+    """
+    某类索引训练所需的最少向量数量
+
+    参数 index_type: 索引类型
+    参数 num_vectors: 当前向量数量
+    返回值: 最少向量数量，不需要训练时为0
+    """
+    if index_type == INDEX_IVF:
+        return ivf_nlist(num_vectors) * MIN_POINTS_PER_CENTROID
+    if index_type == INDEX_IVFPQ:
+        # PQ码本有 2^nbits 个中心，同样需要足够的训练向量
+        return max(ivf_nlist(num_vectors), 2 ** PQ_NBITS) * MIN_POINTS_PER_CENTROID
+    return 0
+
+
+def choose_index_type(num_vectors, requested=KB_INDEX_TYPE):
+    """
+    选择索引类型
+
+    auto模式: 少于KB_INDEX_FLAT_MAX用Flat，少于KB_INDEX_PQ_MIN用IVF，否则用IVF-PQ；
+    HNSW需要显式指定。需要训练的索引在向量数量不足以训练时先使用Flat
+
+    参数 num_vectors: 向量数量
+    参数 requested: 配置的索引类型
+    返回值: 索引类型
+    """
+    if requested == INDEX_AUTO:
+        if num_vectors < KB_INDEX_FLAT_MAX:
+            index_type = INDEX_FLAT
+        elif num_vectors < KB_INDEX_PQ_MIN:
+            index_type = INDEX_IVF
+        else:
+            index_type = INDEX_IVFPQ
+    elif requested in INDEX_TYPES:
+        index_type = requested
+    else:
+        print(f"未知的索引类型 {requested}，使用Flat")
+        index_type = INDEX_FLAT
+    if num_vectors < min_training_vectors(index_type, num_vectors):
+        return INDEX_FLAT
+    return index_type
+
+
+def index_type_of(index):
+    """
+    识别索引类型
+
+    参数 index: FAISS索引
+    返回值: 索引类型
+    """
+    if index is None:
+        return None
+    base = _base_index(index)
+    if isinstance(base, faiss.IndexIVFPQ):
+        return INDEX_IVFPQ
+    if isinstance(base, faiss.IndexIVF):
+        return INDEX_IVF
+    if isinstance(base, faiss.IndexHNSW):
+        return INDEX_HNSW
+    return INDEX_FLAT
+
+
+def _base_index(index):
+    """去掉IDMap包装后的实际索引"""
+    return faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else faiss.downcast_index(index)
+
+
+def precision_of(index):
+    """
+    识别索引中向量的存储精度
+
+    参数 index: FAISS索引
+    返回值: float32 / float16 / int8 / pq
+    """
+    if index is None:
+        return None
+    base = _base_index(index)
+    if isinstance(base, faiss.IndexIVFPQ):
+        return PRECISION_PQ
+    if isinstance(base, faiss.IndexHNSW):
+        base = faiss.downcast_index(base.storage)
+    if isinstance(base, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+        for precision, qtype in _SQ_TYPES.items():
+            if base.sq.qtype == qtype:
+                return precision
+    return PRECISION_FLOAT32
+
+
+def is_exact(index):
+    """索引返回的距离是否为精确的float32 L2距离"""
+    return precision_of(index) == PRECISION_FLOAT32 and index_type_of(index) == INDEX_FLAT
+
+
+def supports_remove(index):
+    """HNSW图索引不支持删除向量，其他类型支持"""
+    return index_type_of(index) != INDEX_HNSW
+
+
+def is_lossless(index):
+    """索引中是否保存了原始向量（float16视为无损），可用于重建其他类型的索引"""
+    return precision_of(index) in (PRECISION_FLOAT32, PRECISION_FLOAT16)
+
+
+def sq_train_size(num_vectors):
+    """
+    int8标量量化统计取值范围使用的样本数量
+
+    参数 num_vectors: 向量数量
+    返回值: 样本数量，0表示使用固定取值范围
+    """
+    if num_vectors < KB_SQ_MIN_TRAIN:
+        return 0
+    return min(num_vectors, SQ_MAX_TRAIN)
+
+
+def sq_training_set(vectors, dim):
+    """
+    int8标量量化的训练样本
+
+    向量太少时（例如第一个加入的文件只有一张图片），各维最小值等于最大值，
+    之后的向量会被截断到同一个值，因此改用归一化向量的固定取值范围；
+    向量足够多时随机采样统计实际取值范围
+
+    参数 vectors: 全部float32向量，可以为None
+    参数 dim: 向量维度
+    返回值: 训练样本矩阵
+    """
+    num_vectors = 0 if vectors is None else len(vectors)
+    train_size = sq_train_size(num_vectors)
+    if train_size == 0:
+        return np.vstack([np.full(dim, -SQ_FIXED_RANGE), np.full(dim, SQ_FIXED_RANGE)]).astype(np.float32)
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if train_size < num_vectors:
+        vectors = vectors[np.random.default_rng(0).choice(num_vectors, train_size, replace=False)]
+    return vectors
+
+
+def needs_sq_retrain(sq_trained, num_vectors):
+    """
+    判断int8标量量化是否需要按当前规模重新统计取值范围
+
+    参数 sq_trained: 当前索引统计取值范围使用的样本数量，0表示固定取值范围，负数表示未知
+    参数 num_vectors: 当前向量数量
+    返回值: 需要重新训练时返回True
+    """
+    if sq_trained < 0:
+        return True
+    if sq_trained == 0:
+        return sq_train_size(num_vectors) > 0
+    return sq_trained < SQ_MAX_TRAIN and num_vectors >= 2 * sq_trained
+
+
+def create_sq_flat_index(dim, precision, train_vectors=None):
+    """
+    创建按位置编号的精确检索索引，float16/int8精度时使用标量量化存储
+
+    参数 dim: 向量维度
+    参数 precision: 存储精度
+    参数 train_vectors: int8量化用于统计各维取值范围的向量，数量不足 KB_SQ_MIN_TRAIN 时使用固定取值范围
+    返回值: faiss.IndexFlatL2 或 faiss.IndexScalarQuantizer
+    """
+    if precision not in _SQ_TYPES:
+        return faiss.IndexFlatL2(dim)
+    index = faiss.IndexScalarQuantizer(dim, _SQ_TYPES[precision], faiss.METRIC_L2)
+    if not index.is_trained:
+        index.train(sq_training_set(train_vectors, dim))
+    return index
+
+
+def create_flat_index(dim, precision=KB_VECTOR_PRECISION, train_vectors=None):
+    """
+    创建空的精确检索索引，支持按自定义ID增删
+
+    参数 dim: 向量维度
+    参数 precision: 存储精度
+    参数 train_vectors: int8量化需要的训练向量
+    返回值: faiss.IndexIDMap2
+    """
+    return faiss.IndexIDMap2(create_sq_flat_index(dim, precision, train_vectors))
+
+
+def quantize_flat_index(index, precision=KB_VECTOR_PRECISION):
+    """
+    将按位置编号的float32 Flat索引转换为指定精度，编号顺序不变
+
+    参数 index: faiss.IndexFlatL2
+    参数 precision: 存储精度
+    返回值: 转换后的索引，无需转换时返回原索引
+    """
+    if precision not in _SQ_TYPES or not isinstance(faiss.downcast_index(index), faiss.IndexFlatL2) \
+            or index.ntotal == 0:
+        return index
+    vectors = index.reconstruct_n(0, index.ntotal)
+    quantized = create_sq_flat_index(index.d, precision, vectors)
+    quantized.add(vectors)
+    return quantized
+
+
+def build_index(vectors, ids, index_type, precision=KB_VECTOR_PRECISION):
+    """
+    构建指定类型的索引，需要训练的类型使用传入的向量训练
+
+    参数 vectors: float32向量矩阵 (N, dim)
+    参数 ids: int64编号数组 (N,)
+    参数 index_type: 索引类型
+    参数 precision: 向量存储精度，IVF-PQ不使用
+    返回值: 已添加全部向量的FAISS索引
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    ids = np.asarray(ids, dtype=np.int64)
+    num_vectors, dim = vectors.shape
+    sq_type = _SQ_TYPES.get(precision)
+
+    if index_type == INDEX_HNSW:
+        if sq_type is not None:
+            hnsw = faiss.IndexHNSWSQ(dim, sq_type, KB_INDEX_HNSW_M)
+            hnsw.train(sq_training_set(vectors, dim))
+        else:
+            hnsw = faiss.IndexHNSWFlat(dim, KB_INDEX_HNSW_M)
+        hnsw.hnsw.efSearch = KB_INDEX_EF_SEARCH
+        index = faiss.IndexIDMap2(hnsw)
+    elif index_type in (INDEX_IVF, INDEX_IVFPQ):
+        nlist = ivf_nlist(num_vectors)
+        quantizer = faiss.IndexFlatL2(dim)
+        if index_type == INDEX_IVF and sq_type is not None:
+            index = faiss.IndexIVFScalarQuantizer(quantizer, dim, nlist, sq_type, faiss.METRIC_L2)
+        elif index_type == INDEX_IVF:
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist)
+        else:
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, pq_m(dim), PQ_NBITS)
+        # 哈希表直接映射，支持任意编号的删除和按编号取回向量
+        index.set_direct_map_type(faiss.DirectMap.Hashtable)
+        index.nprobe = KB_INDEX_NPROBE
+        # 训练样本过多时随机采样，训练耗时与语料规模无关
+        max_train = max(nlist, 2 ** PQ_NBITS) * MAX_POINTS_PER_CENTROID
+        if num_vectors > max_train:
+            sample = np.random.default_rng(0).choice(num_vectors, max_train, replace=False)
+            train_vectors = vectors[sample]
+        else:
+            train_vectors = vectors
+        index.train(train_vectors)
+    else:
+        index = create_flat_index(dim, precision, vectors)
+
+    if num_vectors:
+        index.add_with_ids(vectors, ids)
+    return index
+
+
+def rebuild_target(index, num_vectors, requested=KB_INDEX_TYPE, precision=KB_VECTOR_PRECISION, sq_trained=None):
+    """
+    判断索引是否需要按新的规模重建
+
+    - 应使用的类型与当前类型不同（auto模式只升级不降级）
+    - IVF类索引的向量数量增长到聚类数量明显偏小时重新训练
+    - 存储精度与配置不一致（修改了KB_VECTOR_PRECISION）
+    - int8精度的Flat/HNSW索引需要按当前规模重新统计取值范围（见 needs_sq_retrain）
+
+    参数 index: 当前索引
+    参数 num_vectors: 当前向量数量
+    参数 requested: 配置的索引类型
+    参数 precision: 配置的存储精度
+    参数 sq_trained: 当前索引int8取值范围使用的样本数量，None表示不检查
+    返回值: 需要重建时返回目标索引类型，否则返回None
+    """
+    current = index_type_of(index)
+    target = choose_index_type(num_vectors, requested)
+    if requested == INDEX_AUTO and current in _AUTO_ORDER and target in _AUTO_ORDER:
+        if _AUTO_ORDER[target] < _AUTO_ORDER[current]:
+            target = current
+    if target != current:
+        return target
+    if current != INDEX_IVFPQ and precision_of(index) != precision:
+        return current
+    if sq_trained is not None and current in (INDEX_FLAT, INDEX_HNSW) and precision_of(index) == PRECISION_INT8 \
+            and needs_sq_retrain(sq_trained, num_vectors):
+        return current
+    if current in (INDEX_IVF, INDEX_IVFPQ):
+        nlist = faiss.downcast_index(index).nlist
+        if ivf_nlist(num_vectors) >= 2 * nlist:
+            return current
+    return None
+
+
+def search_parameters(index, selector=None, nprobe=KB_INDEX_NPROBE, ef_search=KB_INDEX_EF_SEARCH):
+    """
+    生成与索引类型匹配的检索参数
+
+    参数 index: FAISS索引
+    参数 selector: faiss.IDSelector，只在选中的编号中检索，可选
+    参数 nprobe: IVF类索引访问的聚类数量
+    参数 ef_search: HNSW候选队列长度
+    返回值: faiss.SearchParameters，无需参数时返回None
+    """
+    index_type = index_type_of(index)
+    kwargs = {"sel": selector} if selector is not None else {}
+    if index_type in (INDEX_IVF, INDEX_IVFPQ):
+        return faiss.SearchParametersIVF(nprobe=nprobe, **kwargs)
+    if index_type == INDEX_HNSW:
+        return faiss.SearchParametersHNSW(efSearch=ef_search, **kwargs)
+    if kwargs:
+        return faiss.SearchParameters(**kwargs)
+    return None
+
+
+def reconstruct_vectors(index, ids):
+    """
+    按编号取回索引中的原始向量
+
+    参数 index: 保存了原始向量的FAISS索引（Flat / IVF / HNSW，float32或float16精度）
+    参数 ids: int64编号数组
+    返回值: float32向量矩阵，顺序与ids一致
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    # IDMap2通过编号反查表定位向量，只解码请求的编号，不需要遍历整个索引
+    vectors = []
+    for start in range(0, len(ids), 10000):
+        vectors.append(index.reconstruct_batch(ids[start:start + 10000]))
+    return np.vstack(vectors) if vectors else np.zeros((0, index.d), dtype=np.float32)
+
+
+def read_index_shared(path):
+    """
+    以只读内存映射方式打开索引文件，向量数据不复制到进程内存，
+    多个进程打开同一文件时共享操作系统页缓存；平台不支持内存映射时退回普通读取
+
+    IO_FLAG_MMAP 只映射IVF倒排表，Flat/SQ的编码和HNSW的邻接表仍会被复制到进程内存；
+    IO_FLAG_MMAP_IFC（faiss 1.10+）直接引用映射区域，这几类索引同样零拷贝打开，旧版本faiss退回 IO_FLAG_MMAP
+
+    参数 path: 索引文件路径
+    返回值: 只读FAISS索引，不能再增删向量
+    """
+    io_flags = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+    try:
+        return faiss.read_index(path, io_flags)
+    except Exception as e:
+        print(f"内存映射打开索引失败，改为完整读取 ({path}): {str(e)}")
+        return faiss.read_index(path)
+
+
+def describe_index(index):
+    """
+    索引摘要信息
+
+    参数 index: FAISS索引
+    返回值: 包含类型、向量数量和检索参数的字典
+    """
+    if index is None:
+        return {"type": None, "ntotal": 0}
+    index_type = index_type_of(index)
+    info = {"type": index_type, "precision": precision_of(index), "ntotal": int(index.ntotal), "dim": int(index.d)}
+    if index_type in (INDEX_IVF, INDEX_IVFPQ):
+        info.update({"nlist": int(faiss.downcast_index(index).nlist), "nprobe": KB_INDEX_NPROBE})
+    elif index_type == INDEX_HNSW:
+        info.update({"M": KB_INDEX_HNSW_M, "efSearch": KB_INDEX_EF_SEARCH})
+    return info
+
+
+def index_memory_bytes(index):
+    """
+    估算索引占用的内存，按向量数量、编码长度和图/倒排表结构计算，不序列化索引
+
+    参数 index: FAISS索引
+    返回值: 字节数
+    """
+    if index is None:
+        return 0
+    # 子索引由外层索引持有，逐层访问时保留外层索引的引用
+    base = faiss.downcast_index(index)
+    size = 0
+    if isinstance(base, faiss.IndexIDMap):
+        # 编号映射表，每个向量一个int64
+        size += 8 * base.ntotal
+        base = faiss.downcast_index(base.index)
+    if isinstance(base, faiss.IndexHNSW):
+        hnsw = base.hnsw
+        size += (hnsw.neighbors.size() + hnsw.levels.size()) * 4 + hnsw.offsets.size() * 8
+        base = faiss.downcast_index(base.storage)
+    if isinstance(base, faiss.IndexIVF):
+        # 倒排表中每个向量保存编码和int64编号，另加粗聚类中心
+        size += base.ntotal * (base.code_size + 8) + index_memory_bytes(base.quantizer)
+        if isinstance(base, faiss.IndexIVFPQ):
+            size += base.pq.centroids.size() * 4
+    elif isinstance(base, faiss.IndexFlatCodes):
+        size += base.ntotal * base.code_size
+    return int(size)
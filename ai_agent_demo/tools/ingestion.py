@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+@File    : ingestion.py
+@Time    : 2025/10/17 13:40
+@Desc    : 文档嵌入流水线，分片按批流式送去嵌入，可选使用多进程CPU工作池并输出吞吐量
+"""
+import os
+import time
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from langchain_core.embeddings import Embeddings
+
+# 每批送去嵌入的分片数量
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+# 嵌入工作进程数量，0或1表示在当前进程内嵌入
+EMBEDDING_NUM_WORKERS = int(os.getenv("EMBEDDING_NUM_WORKERS", "0"))
+# 每个嵌入进程使用的计算线程数，0表示使用PyTorch默认值
+EMBEDDING_NUM_THREADS = int(os.getenv("EMBEDDING_NUM_THREADS", "0"))
+
+# 工作进程内的嵌入模型
+_worker_embeddings = None
+
+
+def set_num_threads(num_threads):
+    """
+    设置当前进程的PyTorch计算线程数
+
+    参数 num_threads: 线程数，小于等于0时不做调整
+    """
+    if num_threads and num_threads > 0:
+        try:
+            import torch
+            torch.set_num_threads(num_threads)
+        except ImportError:
+            pass
+
+
+def _init_worker(model_name, num_threads):
+    """工作进程初始化：每个进程只加载一次嵌入模型"""
+    global _worker_embeddings
+    from tools.vectorstore import EMBEDDING_BACKEND, create_base_embeddings
+    if EMBEDDING_BACKEND != "onnx":
+        set_num_threads(num_threads)
+    _worker_embeddings = create_base_embeddings(model_name)
+
+
+def _worker_embed(texts):
+    """在工作进程中嵌入一批分片"""
+    return _worker_embeddings.embed_documents(texts)
+
+
+class ProcessPoolEmbeddings(Embeddings):
+    """
+    多进程嵌入模型
+
+    文档分片按批分发到CPU工作进程池，每个进程各自加载一份模型；
+    查询向量仍在当前进程中计算，避免跨进程往返
+    """
+
+    def __init__(self, embeddings, model_name, num_workers=EMBEDDING_NUM_WORKERS,
+                 batch_size=EMBEDDING_BATCH_SIZE, num_threads=EMBEDDING_NUM_THREADS):
+        """
+        参数 embeddings: 当前进程内的嵌入模型实例，用于查询嵌入
+        参数 model_name: 嵌入模型名称，工作进程据此加载模型
+        参数 num_workers: 工作进程数量
+        参数 batch_size: 每个任务包含的分片数量
+        参数 num_threads: 每个工作进程的计算线程数
+        """
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.num_workers = num_workers
+        self.batch_size = batch_size
+        self.num_threads = num_threads
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def _get_pool(self):
+        """首次使用时创建进程池，使用spawn方式避免fork后PyTorch线程池死锁"""
+        with self._pool_lock:
+            if self._pool is None:
+                print(f"启动嵌入工作进程池: {self.num_workers} 个进程")
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.num_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(self.model_name, self.num_threads),
+                )
+            return self._pool
+
+    def embed_documents(self, texts):
+        """
+        将分片按批分发到工作进程嵌入
+
+        参数 texts: 分片文本列表
+        返回值: 向量列表，与texts一一对应
+        """
+        if not texts:
+            return []
+        pool = self._get_pool()
+        futures = [pool.submit(_worker_embed, batch) for batch in iter_batches(texts, self.batch_size)]
+        vectors = []
+        for future in futures:
+            vectors.extend(future.result())
+        return vectors
+
+    def embed_query(self, text):
+        """查询嵌入在当前进程完成"""
+        return self.embeddings.embed_query(text)
+
+    def shutdown(self):
+        """关闭进程池"""
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+
+def iter_batches(items, batch_size=EMBEDDING_BATCH_SIZE):
+    """
+    将可迭代对象按固定大小分批，不要求预先知道总数
+
+    参数 items: 任意可迭代对象
+    参数 batch_size: 每批数量
+    返回值: 生成器，每次产出一个列表
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def embed_documents_in_batches(docs, embeddings, batch_size=EMBEDDING_BATCH_SIZE, max_inflight=None,
+                               progress_callback=None):
+    """
+    流式嵌入文档分片：一边从迭代器中取分片，一边把已凑满的批次交给后台线程嵌入，
+    解析和嵌入重叠进行，完成后输出吞吐量
+
+    参数 docs: Document分片的可迭代对象（可以是生成器）
+    参数 embeddings: 嵌入模型实例
+    参数 batch_size: 每批分片数量
+    参数 max_inflight: 同时在途的批次数量上限，默认取工作进程数与2中的较大值
+    参数 progress_callback: 每完成一批后以已嵌入的分片数调用，可选
+    返回值: (文本列表, 向量列表, 元数据列表)
+    """
+    max_inflight = max_inflight or max(EMBEDDING_NUM_WORKERS, 2)
+    texts, vectors, metadatas = [], [], []
+    start_time = time.time()
+
+    def _collect(pending):
+        batch, future = pending.popleft()
+        texts.extend(doc.page_content for doc in batch)
+        metadatas.extend(doc.metadata for doc in batch)
+        vectors.extend(future.result())
+        if progress_callback:
+            progress_callback(len(texts))
+
+    with ThreadPoolExecutor(max_workers=max_inflight) as executor:
+        pending = deque()
+        for batch in iter_batches(docs, batch_size):
+            future = executor.submit(embeddings.embed_documents, [doc.page_content for doc in batch])
+            pending.append((batch, future))
+            # 在途批次过多时先收取最早的结果，避免解析远快于嵌入时占用过多内存
+            while len(pending) >= max_inflight:
+                _collect(pending)
+        while pending:
+            _collect(pending)
+
+    elapsed = time.time() - start_time
+    if texts:
+        print(f"嵌入完成: {len(texts)} 个分片，耗时 {elapsed:.2f}秒，"
+              f"吞吐量 {len(texts) / max(elapsed, 1e-6):.1f} 分片/秒")
+    return texts, vectors, metadatas
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+"""
+@File    : kb_catalog.py
+@Time    : 2025/10/17 18:10
+@Desc    : 知识库文件目录，使用WAL模式的SQLite事务保存文件元数据，替代 metadata.json
+"""
+import os
+import json
+import sqlite3
+import threading
+
+# 项目根目录
+agent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 知识库目录
+KB_DIR = os.path.join(agent_dir, "knowledge_base")
+# 知识库目录数据库路径
+KB_CATALOG_DB = os.getenv("KB_CATALOG_DB") or os.path.join(KB_DIR, "catalog.sqlite")
+# 旧版元数据文件，首次创建目录数据库时导入
+LEGACY_METADATA_FILE = os.path.join(KB_DIR, "metadata.json")
+
+# 文件记录的字段，与旧版 metadata.json 中的条目一致
+FILE_FIELDS = ("id", "name", "path", "size", "content_hash", "upload_time", "type")
+
+# 分页参数上限
+MAX_PAGE_SIZE = 500
+
+# 列表排序方式，与前端排序选项一一对应
+SORT_ORDERS = {
+    "upload_time_desc": "upload_time DESC",
+    "upload_time_asc": "upload_time ASC",
+    "name_asc": "name ASC",
+    "name_desc": "name DESC",
+    "size_desc": "size DESC",
+    "size_asc": "size ASC",
+}
+
+
+class KnowledgeBaseCatalog:
+    """
+    知识库文件目录
+
+    所有写操作在一个事务中完成，有记录变化时递增版本号；
+    按ID和文件名查询直接走SQLite索引，其他进程的写入立即可见，不需要在版本变化时重新加载全部记录；
+    只有统计信息按版本号缓存
+    """
+
+    def __init__(self, db_path=KB_CATALOG_DB, legacy_metadata_file=LEGACY_METADATA_FILE):
+        """
+        参数 db_path: SQLite数据库文件路径
+        参数 legacy_metadata_file: 旧版元数据文件路径，数据库为空时从中导入
+        """
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._lock = threading.RLock()
+        self._stats = None
+        self._stats_version = None
+        self._create_tables()
+        self._import_legacy_metadata(legacy_metadata_file)
+
+    def _create_tables(self):
+        """创建数据表和索引"""
+        with self._lock:
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS files (
+                    id TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL DEFAULT 0,
+                    content_hash TEXT,
+                    upload_time TEXT NOT NULL,
+                    type TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_files_name ON files (name);
+                CREATE INDEX IF NOT EXISTS idx_files_type ON files (type);
+                CREATE INDEX IF NOT EXISTS idx_files_content_hash ON files (content_hash);
+                CREATE INDEX IF NOT EXISTS idx_files_upload_time ON files (upload_time);
+                CREATE INDEX IF NOT EXISTS idx_files_size ON files (size);
+                CREATE TABLE IF NOT EXISTS catalog_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+                INSERT OR IGNORE INTO catalog_meta (key, value) VALUES ('version', '0');
+            """)
+
+    def _import_legacy_metadata(self, legacy_metadata_file):
+        """首次使用时导入旧版 metadata.json 中的文件记录，只导入一次"""
+        if not legacy_metadata_file or not os.path.exists(legacy_metadata_file):
+            return
+        with self._lock:
+            imported = self._conn.execute(
+                "SELECT value FROM catalog_meta WHERE key = 'legacy_imported'"
+            ).fetchone()
+            if imported:
+                return
+            try:
+                with open(legacy_metadata_file, "r", encoding="utf-8") as f:
+                    files = json.load(f).get("files", [])
+            except Exception as e:
+                print(f"读取旧版知识库元数据失败: {str(e)}")
+                files = []
+            with self._transaction():
+                for file in files:
+                    self._insert(file, replace=False)
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO catalog_meta (key, value) VALUES ('legacy_imported', '1')"
+                )
+            if files:
+                print(f"已从 metadata.json 导入 {len(files)} 条知识库文件记录")
+
+    # ---------- 事务与缓存 ----------
+
+    def _transaction(self):
+        """返回写事务上下文，提交时递增版本号"""
+        return _CatalogTransaction(self)
+
+    def version(self):
+        """
+        读取目录版本号，每次写入后递增
+
+        返回值: 版本号整数
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM catalog_meta WHERE key = 'version'").fetchone()
+            return int(row["value"]) if row else 0
+
+    # ---------- 读取 ----------
+
+    def get(self, file_id):
+        """
+        按ID查询文件
+
+        参数 file_id: 文件ID
+        返回值: 文件记录字典，不存在时返回None
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM files WHERE id = ?", (file_id,)).fetchone()
+            return dict(row) if row else None
+
+    def find_by_name(self, name):
+        """
+        按原始文件名查询，同名文件有多个时返回最早上传的
+
+        参数 name: 原始文件名
+        返回值: 文件记录字典，不存在时返回None
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM files WHERE name = ? ORDER BY upload_time LIMIT 1", (name,)
+            ).fetchone()
+            return dict(row) if row else None
+
+    def find_by_content_hash(self, content_hash):
+        """
+        按内容哈希查询文件
+
+        参数 content_hash: 文件内容sha256
+        返回值: 文件记录字典列表
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT * FROM files WHERE content_hash = ?", (content_hash,)).fetchall()
+            return [dict(row) for row in rows]
+
+    def all_files(self):
+        """
+        返回全部文件记录
+
+        返回值: 文件记录字典列表（按上传时间排序）
+        """
+        with self._lock:
+            return [dict(row) for row in self._conn.execute("SELECT * FROM files ORDER BY upload_time")]
+
+    def list_files(self, page=1, page_size=50, sort="upload_time_desc", search=None, file_type=None):
+        """
+        分页查询文件列表，排序和过滤在SQLite中完成
+
+        参数 page: 页码，从1开始
+        参数 page_size: 每页数量，最大MAX_PAGE_SIZE
+        参数 sort: 排序方式，见SORT_ORDERS
+        参数 search: 文件名关键词，可选
+        参数 file_type: 文件扩展名，可选
+        返回值: (文件记录列表, 满足条件的总数)
+        """
+        page = max(1, int(page))
+        page_size = min(max(1, int(page_size)), MAX_PAGE_SIZE)
+        order_by = SORT_ORDERS.get(sort, SORT_ORDERS["upload_time_desc"])
+        conditions, params = [], []
+        if search:
+            conditions.append("name LIKE ? ESCAPE '\\'")
+            escaped = search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            params.append(f"%{escaped}%")
+        if file_type:
+            conditions.append("type = ?")
+            params.append(file_type)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._lock:
+            total = self._conn.execute(f"SELECT COUNT(*) FROM files {where}", params).fetchone()[0]
+            rows = self._conn.execute(
+                f"SELECT * FROM files {where} ORDER BY {order_by}, id LIMIT ? OFFSET ?",
+                params + [page_size, (page - 1) * page_size]
+            ).fetchall()
+        return [dict(row) for row in rows], total
+
+    def stats(self):
+        """
+        知识库统计信息，按版本号缓存
+
+        返回值: 包含文件总数、各类型数量和总大小的字典
+        """
+        with self._lock:
+            version = self.version()
+            if self._stats is None or self._stats_version != version:
+                by_type = {
+                    row["type"]: {"count": row["count"], "size": row["size"]}
+                    for row in self._conn.execute(
+                        "SELECT type, COUNT(*) AS count, COALESCE(SUM(size), 0) AS size FROM files GROUP BY type"
+                    )
+                }
+                self._stats = {
+                    "total_files": sum(item["count"] for item in by_type.values()),
+                    "total_size": sum(item["size"] for item in by_type.values()),
+                    "by_type": by_type,
+                    "version": version,
+                }
+                self._stats_version = version
+            return dict(self._stats)
+
+    # ---------- 写入 ----------
+
+    def _insert(self, record, replace=True):
+        """写入一条文件记录，调用方需在事务中"""
+        values = [record.get(field) for field in FILE_FIELDS]
+        values[FILE_FIELDS.index("size")] = values[FILE_FIELDS.index("size")] or 0
+        verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+        self._conn.execute(
+            f"{verb} INTO files ({', '.join(FILE_FIELDS)}) VALUES ({', '.join('?' * len(FILE_FIELDS))})", values
+        )
+
+    def add_file(self, record):
+        """
+        添加或更新一条文件记录
+
+        参数 record: 包含FILE_FIELDS字段的字典
+        """
+        with self._lock, self._transaction():
+            self._insert(record)
+
+    def delete_file(self, file_id):
+        """
+        删除一条文件记录
+
+        参数 file_id: 文件ID
+        返回值: 被删除的文件记录，不存在时返回None
+        """
+        with self._lock, self._transaction() as transaction:
+            row = self._conn.execute("SELECT * FROM files WHERE id = ?", (file_id,)).fetchone()
+            cursor = self._conn.execute("DELETE FROM files WHERE id = ?", (file_id,))
+            # 没有删除任何记录时不递增版本号，其他进程不必因此重新对齐
+            transaction.changed = cursor.rowcount > 0
+            return dict(row) if transaction.changed else None
+
+
+class _CatalogTransaction:
+    """目录写事务：BEGIN IMMEDIATE 获取写锁，成功时递增版本号并提交，异常时回滚；changed 为False时不递增版本号"""
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.changed = True
+
+    def __enter__(self):
+        self.catalog._lock.acquire()
+        try:
+            self.catalog._conn.execute("BEGIN IMMEDIATE")
+        except Exception:
+            # 未能开始事务（如等待写锁超时）时 __exit__ 不会执行，需要在这里释放锁
+            self.catalog._lock.release()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        conn = self.catalog._conn
+        try:
+            if exc_type is None:
+                if self.changed:
+                    conn.execute("UPDATE catalog_meta SET value = CAST(value AS INTEGER) + 1 WHERE key = 'version'")
+                conn.execute("COMMIT")
+            else:
+                conn.execute("ROLLBACK")
+        finally:
+            self.catalog._lock.release()
+        return False
+
+
+# 全局知识库目录实例
+_kb_catalog = None
+_kb_catalog_lock = threading.Lock()
+
+
+def get_kb_catalog():
+    """
+    获取全局知识库目录实例
+
+    返回值: KnowledgeBaseCatalog实例
+    """
+    global _kb_catalog
+    if _kb_catalog is None:
+        with _kb_catalog_lock:
+            if _kb_catalog is None:
+                _kb_catalog = KnowledgeBaseCatalog()
+    return _kb_catalog
@@ -0,0 +1,755 @@
+# -*- coding: utf-8 -*-
+"""
+@File    : kb_index.py
+@Time    : 2025/10/17 10:20
+@Desc    : 知识库统一向量索引，所有知识库文件的分片共用一个FAISS索引，一次查询嵌入完成检索
+"""
+import os
+import json
+import time
+import threading
+
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+
+from tools.vectorstore import (
+    DEFAULT_INDEX_DIR, DEFAULT_EMBEDDING_MODEL, IMAGE_FILE_TYPES, content_hash, create_text_splitter,
+    get_document_loader, get_embeddings, lookup_chunk_embeddings, persist_document_vectorstore, split_page,
+)
+from tools.ingestion import embed_documents_in_batches
+from tools.index_factory import (
+    KB_INDEX_TYPE, KB_VECTOR_PRECISION, build_index, create_flat_index, describe_index, index_memory_bytes,
+    is_exact, is_lossless, rebuild_target, reconstruct_vectors, search_parameters, sq_train_size, supports_remove,
+)
+from tools.lexical_index import (
+    KB_LEXICAL_SEARCH, LEXICAL_CANDIDATE_FACTOR, is_keyword_query, keyword_match_query, reciprocal_rank_fusion,
+    text_match_query,
+)
+from tools.kb_segments import CHUNKS_DB_FILE, WRITE_LOCK_FILE, ChunkStore, InterProcessLock, SegmentStore
+
+# 统一索引存放的子目录
+KB_INDEX_SUBDIR = "kb"
+# 不支持删除的索引（HNSW）中已删除分片占比超过该值时重建索引
+MAX_DELETED_RATIO = 0.2
+# 量化或近似索引先取 k*该倍数 个候选，再用分片向量缓存中的原始向量重新计算距离，1表示不重排序
+KB_RESCORE_FACTOR = int(os.getenv("KB_RESCORE_FACTOR", "4"))
+
+
+class KnowledgeBaseIndex:
+    """
+    知识库统一向量索引
+
+    每个分片使用一个int64编号写入FAISS索引，分片文本和元数据（file_id、file_name、
+    file_type 等）保存在SQLite分片库中，支持按文件增删和过滤检索。
+    索引类型由 index_factory 按分片数量选择，规模增长后自动重新训练。
+
+    索引以不可变段的形式发布到磁盘（见 kb_segments），各进程只读内存映射当前段，
+    多个worker共享操作系统页缓存中的同一份向量数据；修改时在跨进程写锁内
+    读入当前段的可写副本，修改后发布为新段，其他进程在下次检索时切换到新段
+    """
+
+    def __init__(self, index_dir=None, model_name=DEFAULT_EMBEDDING_MODEL, index_type=KB_INDEX_TYPE,
+                 precision=KB_VECTOR_PRECISION):
+        """
+        参数 index_dir: 持久化根目录，默认DEFAULT_INDEX_DIR
+        参数 model_name: 查询时使用的嵌入模型名称
+        参数 index_type: 索引类型，auto / flat / ivf / hnsw / ivfpq
+        参数 precision: 向量存储精度，float32 / float16 / int8
+        """
+        self.index_path = os.path.join(index_dir or DEFAULT_INDEX_DIR, KB_INDEX_SUBDIR)
+        self.model_name = model_name
+        self.index_type = index_type
+        self.precision = precision
+        self._lock = threading.RLock()
+        self._segments = SegmentStore(self.index_path)
+        self._chunks = ChunkStore(os.path.join(self.index_path, CHUNKS_DB_FILE))
+        self._write_lock = InterProcessLock(os.path.join(self.index_path, WRITE_LOCK_FILE))
+        # 当前打开的段：只读索引、段名和 CURRENT 指针状态
+        self._index = None
+        self._segment = None
+        self._current_stat = None
+        # 已提交后台索引任务、尚未完成的文件，sync时跳过，避免在请求中重复构建
+        self._pending = set()
+        # 上次同步时的知识库目录版本号，目录未变化时跳过同步
+        self._synced_version = None
+        # 不支持删除的索引中已删除的分片编号，检索时过滤，重建时清理，随段一起保存
+        self._deleted = set()
+        # 当前段int8标量量化统计取值范围使用的样本数量，0表示固定取值范围，-1表示未知（旧版段），随段一起保存
+        self._sq_trained = -1
+
+    # ---------- 持久化 ----------
+
+    def load(self):
+        """打开磁盘上的当前段，首次运行时导入旧版 index.faiss + chunks.json"""
+        self._import_legacy()
+        with self._lock:
+            self._refresh()
+            if self._index is not None:
+                chunks, files = self._chunks.count()
+                print(f"从磁盘加载知识库统一索引: {files} 个文件，{chunks} 个分片，"
+                      f"索引类型 {describe_index(self._index)['type']}，段 {self._segment}")
+
+    def _import_legacy(self):
+        """把旧版单文件持久化格式导入分片库并发布为第一个段，导入后删除旧文件"""
+        index_file = os.path.join(self.index_path, "index.faiss")
+        chunks_file = os.path.join(self.index_path, "chunks.json")
+        if not (os.path.exists(index_file) and os.path.exists(chunks_file)):
+            return
+        with self._write_lock:
+            if self._segments.current() is not None:
+                return
+            try:
+                index = faiss.read_index(index_file)
+                with open(chunks_file, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                chunks = {int(chunk_id): chunk for chunk_id, chunk in data["chunks"].items()}
+                next_id = data.get("next_id", max(chunks, default=-1) + 1)
+                with self._chunks.transaction() as store:
+                    store.reserve_ids(next_id)
+                    for chunk_id, chunk in chunks.items():
+                        store.insert(chunk_id, chunk["text"], chunk["metadata"])
+                    self._segments.publish(index, {"deleted": sorted(data.get("deleted", []))})
+                os.remove(index_file)
+                os.remove(chunks_file)
+                print(f"已将旧版知识库统一索引导入为索引段: {len(chunks)} 个分片")
+            except Exception as e:
+                print(f"导入旧版知识库统一索引失败: {str(e)}")
+
+    def _refresh(self):
+        """CURRENT 指针变化（本进程或其他进程发布了新段）时切换到新段，调用方需持有锁"""
+        current_stat = self._segments.current_stat()
+        if current_stat == self._current_stat:
+            return
+        name = self._segments.current()
+        if name is None or name == self._segment:
+            self._current_stat = current_stat
+            return
+        try:
+            index, info = self._segments.open(name)
+        except Exception as e:
+            print(f"打开知识库索引段失败 ({name}): {str(e)}")
+            return
+        self._index = index
+        self._segment = name
+        self._deleted = set(info.get("deleted", []))
+        self._sq_trained = info.get("sq_trained", -1)
+        self._current_stat = current_stat
+
+    def _snapshot(self):
+        """返回当前段的 (索引, 已删除编号)，段不可变，取出后可在锁外检索"""
+        with self._lock:
+            self._refresh()
+            return self._index, self._deleted
+
+    def _writable(self):
+        """
+        读入当前段的可写副本，调用方需持有写锁
+
+        返回值: (可写索引, 已删除编号集合)，还没有段时索引为None
+        """
+        with self._lock:
+            self._refresh()
+            if self._segment is None:
+                return None, set()
+            index, info = self._segments.open(self._segment, writable=True)
+            return index, set(info.get("deleted", []))
+
+    def _publish(self, index, deleted, sq_trained=None):
+        """
+        发布新段并切换到它的只读映射，调用方需持有写锁
+
+        参数 sq_trained: 新建或重新训练的索引统计int8取值范围使用的样本数量，None表示沿用当前段的值
+        """
+        with self._lock:
+            if sq_trained is None:
+                sq_trained = self._sq_trained
+        self._segments.publish(index, {"deleted": sorted(deleted), "sq_trained": sq_trained})
+        with self._lock:
+            self._refresh()
+
+    # ---------- 增删 ----------
+
+    def has_file(self, file_id):
+        """判断文件是否已加入统一索引"""
+        return self._chunks.has_file(file_id)
+
+    def file_ids(self):
+        """返回已加入统一索引的文件ID列表"""
+        return self._chunks.file_ids()
+
+    def file_versions(self):
+        """返回已加入统一索引的文件及其版本，文件重新索引后版本变化"""
+        return self._chunks.file_versions()
+
+    def revision(self):
+        """返回当前段名，每次增删或重建后变化"""
+        with self._lock:
+            self._refresh()
+            return self._segment
+
+    def add_file(self, file_id, vectorstore, file_name, file_type):
+        """
+        将单个文件的向量存储并入统一索引，直接复用其中已计算好的向量，不重新嵌入
+
+        参数 file_id: 知识库文件ID
+        参数 vectorstore: 该文件保存float32原始向量的FAISS向量存储对象（不能是进程内缓存中量化过的副本）
+        参数 file_name: 原始文件名
+        参数 file_type: 文件扩展名
+        返回值: 新增的分片数量
+        """
+        ntotal = vectorstore.index.ntotal
+        if ntotal == 0:
+            return 0
+        vectors = vectorstore.index.reconstruct_n(0, ntotal).astype(np.float32)
+        docs = [vectorstore.docstore.search(vectorstore.index_to_docstore_id[i]) for i in range(ntotal)]
+
+        with self._write_lock:
+            index, deleted = self._writable()
+            sq_trained = None
+            if index is None:
+                index = create_flat_index(vectors.shape[1], self.precision, vectors)
+                sq_trained = sq_train_size(ntotal)
+            # 分片库的修改与新段在同一个事务中提交，发布失败时一起回滚
+            with self._chunks.transaction() as store:
+                # 重复添加时先移除旧分片，保证一个文件只有一份
+                self._remove_chunks(index, deleted, store.delete_file(file_id))
+                start_id = store.reserve_ids(ntotal)
+                chunk_ids = np.arange(start_id, start_id + ntotal, dtype=np.int64)
+                index.add_with_ids(vectors, chunk_ids)
+                for chunk_id, doc in zip(chunk_ids, docs):
+                    metadata = dict(doc.metadata)
+                    metadata.update({"file_id": file_id, "file_name": file_name, "file_type": file_type})
+                    store.insert(int(chunk_id), doc.page_content, metadata)
+                self._publish(index, deleted, sq_trained)
+        print(f"文件 {file_name} 已加入知识库统一索引，共 {ntotal} 个分片")
+        # 分片数量变化后按需切换索引类型或重新训练
+        self.maybe_rebuild()
+        return ntotal
+
+    def index_file(self, file_id, file_path, file_type, file_name, progress_callback=None):
+        """
+        获取文件的向量存储（内存缓存 -> 磁盘持久化索引 -> 重新构建）并并入统一索引
+
+        参数 file_id: 知识库文件ID
+        参数 file_path: 文件路径
+        参数 file_type: 文件扩展名
+        参数 file_name: 原始文件名
+        参数 progress_callback: 嵌入进度回调，参数为已嵌入的分片数，可选
+        返回值: 新增的分片数量
+        """
+        # 延迟导入，避免与缓存模块循环依赖
+        from cache.vector_cache import get_vectorstore
+
+        vectorstore = get_vectorstore(file_id, file_path, file_type, file_name, progress_callback, raw=True)
+        return self.add_file(file_id, vectorstore, file_name, file_type)
+
+    @staticmethod
+    def _document_metadata(metadata):
+        """去掉统一索引附加的文件字段，还原为文件自己的向量存储中的分片元数据"""
+        return {key: value for key, value in metadata.items() if key not in ("file_id", "file_name", "file_type")}
+
+    def _match_chunks(self, file_id, file_path):
+        """
+        逐页解析更新后的文件，与统一索引中该文件的分片按内容哈希比对
+
+        页面内容哈希未变化的页面直接沿用原有分片，不再分片；变化的页面重新分片后，
+        分片内容哈希与原有分片相同的也沿用原分片，其余为需要嵌入的新分片
+
+        返回值: (沿用的分片 [(编号, 文本, 新元数据)], 新分片Document列表, 需要删除的分片编号列表, {编号: 原元数据})
+        """
+        old_chunks = self._chunks.file_chunks(file_id)
+        # 原有分片按 (页面内容哈希, 原页码) 分组：内容相同的多个页面各自成组，每次匹配只沿用其中一组
+        by_page, by_chunk = {}, {}
+        for chunk in old_chunks:
+            metadata = chunk[2]
+            if metadata.get("page_hash"):
+                by_page.setdefault(metadata["page_hash"], {}).setdefault(metadata.get("page"), []).append(chunk)
+            if metadata.get("chunk_hash"):
+                by_chunk.setdefault(metadata["chunk_hash"], []).append(chunk)
+
+        kept, new_docs, reused = [], [], set()
+        text_splitter = create_text_splitter()
+        for page_number, page in enumerate(get_document_loader(file_path).lazy_load()):
+            page_chunks = None
+            page_groups = by_page.get(content_hash(page.page_content))
+            while page_groups and page_chunks is None:
+                group = page_groups.pop(next(iter(page_groups)))
+                if not reused.intersection(chunk_id for chunk_id, _, _ in group):
+                    page_chunks = group
+            if page_chunks:
+                for chunk_id, text, metadata in page_chunks:
+                    kept.append((chunk_id, text, dict(metadata, page=page.metadata.get("page", page_number))))
+                    reused.add(chunk_id)
+                continue
+            for doc in split_page(page, text_splitter, page_number):
+                candidates = [chunk for chunk in by_chunk.get(doc.metadata["chunk_hash"], ())
+                              if chunk[0] not in reused]
+                if candidates:
+                    chunk_id, text, metadata = candidates[0]
+                    kept.append((chunk_id, text, dict(metadata, **doc.metadata)))
+                    reused.add(chunk_id)
+                else:
+                    new_docs.append(doc)
+        removed = [chunk_id for chunk_id, _, _ in old_chunks if chunk_id not in reused]
+        return kept, new_docs, removed, {chunk_id: metadata for chunk_id, _, metadata in old_chunks}
+
+    def update_file(self, file_id, file_path, file_type, file_name, progress_callback=None):
+        """
+        文件内容更新后增量重建其分片：只删除和重新嵌入内容变化的页面（或分片），
+        未变化的分片保留原编号和向量，耗时与修改量成正比而不是与文件大小成正比
+
+        图片、尚未索引的文件或旧版本写入的没有内容哈希的分片，效果等同于完整重新索引
+
+        参数 file_id: 知识库文件ID
+        参数 file_path: 更新后的文件路径
+        参数 file_type: 文件扩展名
+        参数 file_name: 原始文件名
+        参数 progress_callback: 嵌入进度回调，参数为已嵌入的分片数，可选
+        返回值: (沿用的分片数量, 新嵌入的分片数量, 删除的分片数量)
+        """
+        from cache.vector_cache import vectorstore_cache
+
+        vectorstore_cache.pop(file_id)
+        if file_type in IMAGE_FILE_TYPES or not self.has_file(file_id):
+            old_count = len(self._chunks.file_chunk_ids(file_id))
+            return 0, self.index_file(file_id, file_path, file_type, file_name, progress_callback), old_count
+
+        start_time = time.time()
+        kept, new_docs, removed, old_metadata = self._match_chunks(file_id, file_path)
+        expected_ids = sorted([chunk_id for chunk_id, _, _ in kept] + removed)
+
+        # 沿用分片的原始向量：优先取分片向量缓存，其次从保存了原始向量的索引中取回，都取不到时重新嵌入
+        kept_vectors = lookup_chunk_embeddings([text for _, text, _ in kept], self.model_name)
+        index, _ = self._snapshot()
+        missing = [i for i, vector in enumerate(kept_vectors) if vector is None]
+        if missing and index is not None and is_lossless(index):
+            restored = reconstruct_vectors(index, [kept[i][0] for i in missing])
+            for i, vector in zip(missing, restored):
+                kept_vectors[i] = vector
+        for i in reversed([i for i, vector in enumerate(kept_vectors) if vector is None]):
+            chunk_id, text, metadata = kept.pop(i)
+            kept_vectors.pop(i)
+            removed.append(chunk_id)
+            new_docs.append(Document(page_content=text, metadata=self._document_metadata(metadata)))
+
+        texts, vectors, metadatas = embed_documents_in_batches(iter(new_docs), get_embeddings(self.model_name),
+                                                               progress_callback=progress_callback)
+        if not kept and not texts:
+            raise ValueError(f"文档中没有可索引的文本内容: {file_path}")
+        vectors = np.asarray(vectors, dtype=np.float32)
+
+        kept = [(chunk_id, text, dict(metadata, file_name=file_name)) for chunk_id, text, metadata in kept]
+        updated = [(chunk_id, metadata) for chunk_id, _, metadata in kept if metadata != old_metadata[chunk_id]]
+        new_ids = np.empty(0, dtype=np.int64)
+        need_compact = False
+        # 内容没有变化（如只修改了文件属性）时不发布新段
+        if texts or removed or updated:
+            with self._write_lock:
+                index, deleted = self._writable()
+                if index is None:
+                    raise ValueError("知识库统一索引为空，无法增量更新")
+                with self._chunks.transaction() as store:
+                    if store.file_chunk_ids(file_id) != expected_ids:
+                        raise RuntimeError(f"文件 {file_name} 的分片在更新期间被修改，请重试")
+                    store.delete_chunks(removed)
+                    self._remove_chunks(index, deleted, removed)
+                    for chunk_id, metadata in updated:
+                        store.update_metadata(chunk_id, metadata)
+                    start_id = store.reserve_ids(len(texts))
+                    new_ids = np.arange(start_id, start_id + len(texts), dtype=np.int64)
+                    if texts:
+                        index.add_with_ids(vectors, new_ids)
+                    for chunk_id, text, metadata in zip(new_ids, texts, metadatas):
+                        metadata = dict(metadata)
+                        metadata.update({"file_id": file_id, "file_name": file_name, "file_type": file_type})
+                        store.insert(int(chunk_id), text, metadata)
+                    self._publish(index, deleted)
+                need_compact = len(deleted) > MAX_DELETED_RATIO * max(index.ntotal, 1)
+
+        # 文件自己的向量存储按分片编号顺序重新保存，与统一索引中的分片一一对应（重建压缩索引时使用）
+        rows = sorted(
+            [(chunk_id, text, vector, metadata) for (chunk_id, text, metadata), vector in zip(kept, kept_vectors)] +
+            [(int(chunk_id), text, vector, metadata)
+             for chunk_id, text, vector, metadata in zip(new_ids, texts, vectors, metadatas)],
+            key=lambda row: row[0]
+        )
+        persist_document_vectorstore(file_path, [row[1] for row in rows], [list(row[2]) for row in rows],
+                                     [self._document_metadata(row[3]) for row in rows])
+        print(f"文件 {file_name} 已增量更新: 沿用 {len(kept)} 个分片，新嵌入 {len(texts)} 个，删除 {len(removed)} 个，"
+              f"耗时 {time.time() - start_time:.2f}秒")
+        if need_compact:
+            self.rebuild()
+        else:
+            self.maybe_rebuild()
+        return len(kept), len(texts), len(removed)
+
+    def mark_pending(self, file_id, pending=True):
+        """
+        标记文件正在由后台任务索引
+
+        参数 file_id: 知识库文件ID
+        参数 pending: True表示开始索引，False表示索引结束
+        """
+        with self._lock:
+            if pending:
+                self._pending.add(file_id)
+            else:
+                self._pending.discard(file_id)
+
+    @staticmethod
+    def _remove_chunks(index, deleted, chunk_ids):
+        """从可写索引中移除分片，不支持删除的索引改为标记删除"""
+        if not chunk_ids:
+            return
+        if supports_remove(index):
+            index.remove_ids(np.array(chunk_ids, dtype=np.int64))
+        else:
+            # HNSW不支持删除，先标记为已删除，检索时过滤
+            deleted.update(chunk_ids)
+
+    def delete_file(self, file_id):
+        """
+        从统一索引中删除指定文件的所有分片
+
+        参数 file_id: 知识库文件ID
+        返回值: 删除的分片数量
+        """
+        if not self.has_file(file_id):
+            return 0
+        with self._write_lock:
+            index, deleted = self._writable()
+            if index is None:
+                return 0
+            with self._chunks.transaction() as store:
+                chunk_ids = store.delete_file(file_id)
+                if not chunk_ids:
+                    return 0
+                self._remove_chunks(index, deleted, chunk_ids)
+                self._publish(index, deleted)
+            need_compact = len(deleted) > MAX_DELETED_RATIO * max(index.ntotal, 1)
+        if need_compact:
+            self.rebuild()
+        return len(chunk_ids)
+
+    # ---------- 索引类型与重建 ----------
+
+    def _load_file_vectors(self, file_id, expected):
+        """从文件自己的持久化向量存储（float32）中取回原始向量，顺序与add_file写入时一致"""
+        from cache.vector_cache import get_vectorstore
+        from tools.kb_catalog import get_kb_catalog
+
+        record = get_kb_catalog().get(file_id)
+        if record is None:
+            raise ValueError(f"知识库目录中不存在文件 {file_id}")
+        vectorstore = get_vectorstore(file_id, record["path"], record["type"], record["name"], raw=True)
+        if vectorstore.index.ntotal != expected:
+            raise ValueError(f"文件 {record['name']} 的向量数量与统一索引不一致")
+        return vectorstore.index.reconstruct_n(0, expected)
+
+    def _collect_vectors(self):
+        """取回所有有效分片的编号和原始向量，调用方需持有写锁"""
+        index, _ = self._snapshot()
+        if is_lossless(index):
+            chunk_ids = np.array(self._chunks.select_ids(), dtype=np.int64)
+            return chunk_ids, reconstruct_vectors(index, chunk_ids)
+        # 压缩索引中只有近似向量，从各文件的向量存储中取回原始向量
+        chunk_ids, vectors = [], []
+        for file_id, file_chunk_ids in self._chunks.chunk_ids_by_file().items():
+            vectors.append(self._load_file_vectors(file_id, len(file_chunk_ids)))
+            chunk_ids.extend(file_chunk_ids)
+        return np.array(chunk_ids, dtype=np.int64), np.vstack(vectors).astype(np.float32)
+
+    def rebuild(self, index_type=None):
+        """
+        用当前全部分片重建索引（切换索引类型、重新训练或清理已删除分片）
+
+        在写锁外训练和添加向量，期间检索和其他写入不受影响；若重建过程中发布了新段，则放弃本次结果
+
+        参数 index_type: 目标索引类型，默认按分片数量和配置选择
+        返回值: 是否完成重建
+        """
+        with self._write_lock:
+            index, _ = self._snapshot()
+            num_chunks, _ = self._chunks.count()
+            if index is None or not num_chunks:
+                return False
+            segment = self._segment
+            index_type = index_type or rebuild_target(index, num_chunks, self.index_type, self.precision,
+                                                      self._sq_trained) or describe_index(index)["type"]
+            chunk_ids, vectors = self._collect_vectors()
+
+        start_time = time.time()
+        new_index = build_index(vectors, chunk_ids, index_type, self.precision)
+        elapsed = time.time() - start_time
+
+        with self._write_lock:
+            self._snapshot()
+            if segment != self._segment:
+                print("重建期间知识库统一索引已被修改，放弃本次重建")
+                return False
+            self._publish(new_index, set(), sq_train_size(len(chunk_ids)))
+        print(f"知识库统一索引已重建为 {index_type}: {len(chunk_ids)} 个分片，耗时 {elapsed:.2f}秒")
+        return True
+
+    def maybe_rebuild(self):
+        """分片数量变化导致应使用的索引类型变化，或IVF聚类数量明显偏小时重建"""
+        index, _ = self._snapshot()
+        if index is None:
+            return False
+        target = rebuild_target(index, self._chunks.count()[0], self.index_type, self.precision, self._sq_trained)
+        if target is None:
+            return False
+        return self.rebuild(target)
+
+    def stats(self):
+        """
+        统一索引统计信息
+
+        返回值: 包含索引类型、参数、分片数量、内存占用和当前段的字典；
+            memory_bytes 为当前段索引数据的大小，faiss支持 IO_FLAG_MMAP_IFC 时这部分映射自页缓存，由各进程共享；
+            旧版本faiss只共享IVF倒排表，Flat/SQ编码和HNSW邻接表在每个进程中各有一份
+        """
+        index, deleted = self._snapshot()
+        chunks, files = self._chunks.count()
+        info = describe_index(index)
+        info.update({
+            "files": files,
+            "chunks": chunks,
+            "deleted": len(deleted),
+            "memory_bytes": index_memory_bytes(index),
+            "segment": self._segment,
+        })
+        return info
+
+    @staticmethod
+    def _prefetch_captions(image_paths):
+        """
+        批量生成待索引图片的描述并写入描述缓存，逐个索引图片时直接命中缓存
+
+        参数 image_paths: 图片文件路径列表
+        """
+        if len(image_paths) < 2:
+            return
+        try:
+            from multimodal.image_captioning import caption_images
+            caption_images(image_paths)
+        except Exception as e:
+            print(f"批量生成图片描述失败，改为逐个生成: {str(e)}")
+
+    def sync(self, files, supported_file_types=None, version=None):
+        """
+        使统一索引与知识库目录保持一致：补充缺失的文件，移除已删除的文件
+
+        参数 files: 知识库目录中的文件列表，可以是返回列表的无参函数，版本号未变化时不会调用
+        参数 supported_file_types: 需要索引的文件类型，None表示不过滤
+        参数 version: 知识库目录版本号，与上次同步相同时直接返回，可选
+        """
+        if version is not None and version == self._synced_version:
+            return
+        if callable(files):
+            files = files()
+        wanted = {
+            file["id"]: file for file in files
+            if supported_file_types is None or file["type"] in supported_file_types
+        }
+        indexed = set(self.file_ids())
+        for file_id in indexed - set(wanted):
+            self.delete_file(file_id)
+        self._prefetch_captions([
+            file["path"] for file_id, file in wanted.items()
+            if file["type"] in IMAGE_FILE_TYPES and file_id not in indexed and file_id not in self._pending
+        ])
+        # 有文件仍在后台索引或索引失败时不记录版本号，下次同步时再次对齐
+        complete = True
+        for file_id, file in wanted.items():
+            if file_id in self._pending:
+                complete = False
+                continue
+            # 其他worker可能已经索引了该文件，逐个确认，避免重复构建
+            if self.has_file(file_id):
+                continue
+            try:
+                self.index_file(file_id, file["path"], file["type"], file["name"])
+            except Exception as e:
+                complete = False
+                print(f"构建向量存储失败 ({file['name']}): {str(e)}")
+        if complete:
+            self._synced_version = version
+
+    # ---------- 检索 ----------
+
+    def _vector_hits(self, embedding, k, file_ids=None, file_types=None):
+        """
+        向量检索，返回 (分片编号, 分片, L2距离) 列表，按距离升序排列
+        """
+        # 段不可变，取得当前段后无需持锁，多个线程可以并发检索
+        index, deleted = self._snapshot()
+        if index is None or index.ntotal == 0:
+            return []
+        selector = None
+        if file_ids is not None or file_types is not None:
+            candidates = self._chunks.select_ids(file_ids, file_types)
+            if not candidates:
+                return []
+            selector = faiss.IDSelectorBatch(np.array(candidates, dtype=np.int64))
+        elif deleted:
+            # 过滤不支持删除的索引中已标记删除的分片
+            deleted_selector = faiss.IDSelectorBatch(np.array(sorted(deleted), dtype=np.int64))
+            selector = faiss.IDSelectorNot(deleted_selector)
+        params = search_parameters(index, selector)
+        query = np.array([embedding], dtype=np.float32)
+        # 量化或近似索引的距离有误差，多取候选后用原始向量重排序
+        rescore = KB_RESCORE_FACTOR > 1 and not is_exact(index)
+        scores, ids = index.search(query, k * KB_RESCORE_FACTOR if rescore else k, params=params)
+
+        hits = [(int(chunk_id), float(score)) for score, chunk_id in zip(scores[0], ids[0]) if chunk_id != -1]
+        chunks = self._chunks.get_many([chunk_id for chunk_id, _ in hits])
+        # 分片库中已不存在的编号属于刚删除的文件（其他进程尚未切换到新段），直接跳过
+        candidates = [(chunk_id, chunks[chunk_id], score) for chunk_id, score in hits if chunk_id in chunks]
+
+        if rescore and candidates:
+            candidates = self._rescore(query[0], candidates)[:k]
+        return candidates
+
+    def search_by_vector(self, embedding, k=3, file_ids=None, file_types=None):
+        """
+        使用查询向量检索统一索引
+
+        参数 embedding: 查询向量
+        参数 k: 返回的文档数量
+        参数 file_ids: 只在这些文件中检索，可选
+        参数 file_types: 只在这些类型的文件中检索，可选
+        返回值: (Document, L2距离) 列表，距离越小越相似
+        """
+        return [(self._to_document(chunk), score)
+                for _, chunk, score in self._vector_hits(embedding, k, file_ids, file_types)]
+
+    @staticmethod
+    def _to_document(chunk):
+        return Document(page_content=chunk["text"], metadata=chunk["metadata"])
+
+    def _rescore(self, query, candidates):
+        """
+        用分片向量缓存中的原始float32向量重新计算L2距离并排序，
+        距离与精确索引一致，SIMILARITY_THRESHOLD 不需要随存储精度调整；缓存中没有的分片保留近似距离
+
+        参数 query: 查询向量
+        参数 candidates: (分片编号, 分片, 近似距离) 列表
+        返回值: 按距离升序排列的 (分片编号, 分片, 距离) 列表
+        """
+        vectors = lookup_chunk_embeddings([chunk["text"] for _, chunk, _ in candidates], self.model_name)
+        rescored = []
+        for (chunk_id, chunk, score), vector in zip(candidates, vectors):
+            if vector is not None:
+                diff = vector - query
+                score = float(np.dot(diff, diff))
+            rescored.append((chunk_id, chunk, score))
+        rescored.sort(key=lambda item: item[2])
+        return rescored
+
+    def search_lexical(self, match_query, k=3, file_ids=None, file_types=None):
+        """
+        只用关键词倒排索引检索，不计算查询向量
+
+        参数 match_query: FTS5的MATCH表达式，见 lexical_index
+        参数 k: 返回的文档数量
+        参数 file_ids: 只在这些文件中检索，可选
+        参数 file_types: 只在这些类型的文件中检索，可选
+        返回值: (Document, None) 列表，按BM25得分降序排列；没有向量距离，BM25得分记录在元数据 bm25 中
+        """
+        _, deleted = self._snapshot()
+        hits = [(chunk_id, score) for chunk_id, score
+                in self._chunks.lexical_search(match_query, k + len(deleted), file_ids, file_types)
+                if chunk_id not in deleted][:k]
+        chunks = self._chunks.get_many([chunk_id for chunk_id, _ in hits])
+        results = []
+        for chunk_id, score in hits:
+            if chunk_id in chunks:
+                document = self._to_document(chunks[chunk_id])
+                document.metadata["bm25"] = score
+                results.append((document, None))
+        return results
+
+    def _hybrid_search(self, query, embedding, k, file_ids=None, file_types=None):
+        """
+        向量检索与关键词检索各取候选，按倒数排名融合排序；
+        只被关键词命中的分片用分片向量缓存补算L2距离，保证返回的距离都可以与 SIMILARITY_THRESHOLD 比较
+        """
+        num_candidates = k * LEXICAL_CANDIDATE_FACTOR
+        dense = self._vector_hits(embedding, num_candidates, file_ids, file_types)
+        _, deleted = self._snapshot()
+        lexical = [chunk_id for chunk_id, _ in
+                   self._chunks.lexical_search(text_match_query(query), num_candidates, file_ids, file_types)
+                   if chunk_id not in deleted]
+        if not lexical:
+            return [(self._to_document(chunk), score) for _, chunk, score in dense[:k]]
+
+        found = {chunk_id: (chunk, score) for chunk_id, chunk, score in dense}
+        ranked = reciprocal_rank_fusion([[chunk_id for chunk_id, _, _ in dense], lexical])
+        missing = [chunk_id for chunk_id in ranked if chunk_id not in found]
+        if missing:
+            chunks = self._chunks.get_many(missing)
+            missing = [(chunk_id, chunks[chunk_id]) for chunk_id in missing if chunk_id in chunks]
+            vectors = lookup_chunk_embeddings([chunk["text"] for _, chunk in missing], self.model_name)
+            query_vector = np.asarray(embedding, dtype=np.float32)
+            for (chunk_id, chunk), vector in zip(missing, vectors):
+                if vector is not None:
+                    diff = vector - query_vector
+                    found[chunk_id] = (chunk, float(np.dot(diff, diff)))
+
+        results = []
+        for chunk_id in ranked:
+            if chunk_id in found:
+                chunk, score = found[chunk_id]
+                results.append((self._to_document(chunk), score))
+                if len(results) == k:
+                    break
+        return results
+
+    def search(self, query, k=3, file_ids=None, file_types=None):
+        """
+        检索统一索引，无论有多少文件，查询只嵌入一次、检索一次
+
+        条款号、标准号等标识符为主的查询先走关键词倒排索引，命中时直接返回，不计算查询向量；
+        其他查询（或关键词未命中）同时做向量检索和BM25检索，融合排序
+
+        参数 query: 查询文本
+        参数 k: 返回的文档数量
+        参数 file_ids: 只在这些文件中检索，可选
+        参数 file_types: 只在这些类型的文件中检索，可选
+        返回值: (Document, L2距离) 列表，距离越小越相似；关键词直接命中的结果距离为None
+        """
+        index, _ = self._snapshot()
+        if index is None or index.ntotal == 0:
+            return []
+        lexical = KB_LEXICAL_SEARCH and self._chunks.lexical_enabled
+        if lexical and is_keyword_query(query):
+            results = self.search_lexical(keyword_match_query(query), k, file_ids, file_types)
+            if results:
+                return results
+        embedding = get_embeddings(self.model_name).embed_query(query)
+        if lexical:
+            return self._hybrid_search(query, embedding, k, file_ids, file_types)
+        return self.search_by_vector(embedding, k, file_ids, file_types)
+
+
+# 全局统一索引实例，首次使用时从磁盘加载
+_kb_index = None
+_kb_index_lock = threading.Lock()
+
+
+def get_kb_index():
+    """
+    获取全局知识库统一索引实例
+
+    返回值: KnowledgeBaseIndex实例
+    """
+    global _kb_index
+    if _kb_index is None:
+        with _kb_index_lock:
+            if _kb_index is None:
+                kb_index = KnowledgeBaseIndex()
+                kb_index.load()
+                _kb_index = kb_index
+    return _kb_index
@@ -0,0 +1,498 @@
+# -*- coding: utf-8 -*-
+"""
+@File    : kb_segments.py
+@Time    : 2025/10/18 10:30
+@Desc    : 知识库统一索引的磁盘存储：不可变索引段 + CURRENT指针 + SQLite分片文本库，多个worker进程共享同一份数据
+"""
+import os
+import json
+import time
+import shutil
+import sqlite3
+import threading
+
+import faiss
+
+from tools.index_factory import read_index_shared
+from tools.lexical_index import (
+    TOKENIZER_NAME, add_lexical_document, create_lexical_table, remove_lexical_document,
+)
+
+# 指向当前索引段的指针文件，内容为段目录名
+CURRENT_FILE = "CURRENT"
+# 索引段目录
+SEGMENTS_SUBDIR = "segments"
+# 分片文本和元数据数据库
+CHUNKS_DB_FILE = "chunks.sqlite"
+# 分片关键词倒排索引表（FTS5），与分片表在同一个数据库中
+CHUNKS_FTS_TABLE = "chunks_fts"
+# 跨进程写锁文件
+WRITE_LOCK_FILE = "write.lock"
+# 除当前段外保留的旧段数量，供仍在读取旧段的进程继续使用
+KB_SEGMENT_KEEP = int(os.getenv("KB_SEGMENT_KEEP", "2"))
+
+
+class InterProcessLock:
+    """
+    跨进程可重入写锁：进程内用线程锁互斥，进程间用文件锁互斥
+
+    Linux/macOS 使用 fcntl.flock，Windows 使用 msvcrt.locking
+    """
+
+    def __init__(self, path):
+        """
+        参数 path: 锁文件路径
+        """
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        if self._depth == 0:
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self._file = open(self.path, "a+b")
+                self._lock_file(self._file)
+            except Exception:
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                self._thread_lock.release()
+                raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._depth -= 1
+        try:
+            if self._depth == 0:
+                self._unlock_file(self._file)
+                self._file.close()
+                self._file = None
+        finally:
+            self._thread_lock.release()
+        return False
+
+    @staticmethod
+    def _lock_file(f):
+        try:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        except ImportError:
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    return
+                except OSError:
+                    # LK_LOCK 约10秒后超时，继续等待
+                    continue
+
+    @staticmethod
+    def _unlock_file(f):
+        try:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        except ImportError:
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class ChunkStore:
+    """
+    分片文本库
+
+    按分片编号保存分片文本和元数据，所有进程共用一个WAL模式的SQLite文件，
+    检索时只读取命中的分片，不需要在每个进程里保存完整的分片字典。
+    分片编号单调递增、从不复用，仍在读取旧段的进程不会把编号对应到其他分片上。
+    分片的关键词倒排索引（FTS5）与分片在同一个事务中增删，所有进程共用
+    """
+
+    def __init__(self, db_path):
+        """
+        参数 db_path: SQLite数据库文件路径
+        """
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        # 写连接用于事务，读连接用于检索；WAL模式下写事务进行中读取不被阻塞，读到的是已提交的数据
+        self._conn = self._connect(db_path)
+        self._reader = self._connect(db_path)
+        self._lock = threading.RLock()
+        self._read_lock = threading.Lock()
+        with self._lock:
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS chunks (
+                    id INTEGER PRIMARY KEY,
+                    file_id TEXT NOT NULL,
+                    file_type TEXT,
+                    text TEXT NOT NULL,
+                    metadata TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_chunks_file_id ON chunks (file_id);
+                CREATE TABLE IF NOT EXISTS chunk_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+                INSERT OR IGNORE INTO chunk_meta (key, value) VALUES ('next_id', '0');
+            """)
+            self.lexical_enabled = self._init_lexical()
+
+    def _init_lexical(self):
+        """创建关键词倒排索引；首次创建或分词方式变化（如安装了jieba）时用已有分片重建"""
+        if self._lexical_tokenizer() == TOKENIZER_NAME:
+            return create_lexical_table(self._conn, CHUNKS_FTS_TABLE)
+        with self.transaction():
+            # 多个worker同时启动时只由第一个重建
+            if self._lexical_tokenizer() == TOKENIZER_NAME:
+                return create_lexical_table(self._conn, CHUNKS_FTS_TABLE)
+            self._conn.execute(f"DROP TABLE IF EXISTS {CHUNKS_FTS_TABLE}")
+            if not create_lexical_table(self._conn, CHUNKS_FTS_TABLE):
+                return False
+            count = 0
+            for chunk_id, text in self._conn.execute("SELECT id, text FROM chunks").fetchall():
+                add_lexical_document(self._conn, CHUNKS_FTS_TABLE, chunk_id, text)
+                count += 1
+            self._conn.execute("INSERT OR REPLACE INTO chunk_meta (key, value) VALUES ('lexical_tokenizer', ?)",
+                               (TOKENIZER_NAME,))
+        if count:
+            print(f"已重建分片关键词索引: {count} 个分片，分词方式 {TOKENIZER_NAME}")
+        return True
+
+    def _lexical_tokenizer(self):
+        """读取构建倒排索引时使用的分词方式"""
+        row = self._conn.execute("SELECT value FROM chunk_meta WHERE key = 'lexical_tokenizer'").fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def _connect(db_path):
+        conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    def transaction(self):
+        """返回写事务上下文，异常时回滚"""
+        return _ChunkTransaction(self)
+
+    # ---------- 写入（调用方需在事务中） ----------
+
+    def reserve_ids(self, count):
+        """
+        分配一段连续的分片编号
+
+        参数 count: 编号数量
+        返回值: 起始编号
+        """
+        start = int(self._conn.execute("SELECT value FROM chunk_meta WHERE key = 'next_id'").fetchone()[0])
+        self._conn.execute("UPDATE chunk_meta SET value = ? WHERE key = 'next_id'", (str(start + count),))
+        return start
+
+    def insert(self, chunk_id, text, metadata):
+        """写入一个分片"""
+        self._conn.execute(
+            "INSERT OR REPLACE INTO chunks (id, file_id, file_type, text, metadata) VALUES (?, ?, ?, ?, ?)",
+            (chunk_id, metadata["file_id"], metadata.get("file_type"), text, json.dumps(metadata, ensure_ascii=False))
+        )
+        if self.lexical_enabled:
+            add_lexical_document(self._conn, CHUNKS_FTS_TABLE, chunk_id, text)
+
+    def delete_file(self, file_id):
+        """
+        删除文件的全部分片
+
+        参数 file_id: 知识库文件ID
+        返回值: 被删除的分片编号列表
+        """
+        rows = self._conn.execute("SELECT id, text FROM chunks WHERE file_id = ? ORDER BY id", (file_id,)).fetchall()
+        if self.lexical_enabled:
+            for chunk_id, text in rows:
+                remove_lexical_document(self._conn, CHUNKS_FTS_TABLE, chunk_id, text)
+        self._conn.execute("DELETE FROM chunks WHERE file_id = ?", (file_id,))
+        return [row[0] for row in rows]
+
+    def delete_chunks(self, chunk_ids):
+        """
+        删除指定的分片
+
+        参数 chunk_ids: 分片编号列表
+        """
+        for chunk_id in chunk_ids:
+            row = self._conn.execute("SELECT text FROM chunks WHERE id = ?", (chunk_id,)).fetchone()
+            if row is None:
+                continue
+            if self.lexical_enabled:
+                remove_lexical_document(self._conn, CHUNKS_FTS_TABLE, chunk_id, row[0])
+            self._conn.execute("DELETE FROM chunks WHERE id = ?", (chunk_id,))
+
+    def update_metadata(self, chunk_id, metadata):
+        """更新分片的元数据，分片文本和向量不变"""
+        self._conn.execute("UPDATE chunks SET metadata = ? WHERE id = ?",
+                           (json.dumps(metadata, ensure_ascii=False), chunk_id))
+
+    # ---------- 读取 ----------
+
+    def get_many(self, chunk_ids):
+        """
+        按编号批量读取分片
+
+        参数 chunk_ids: 分片编号列表
+        返回值: {编号: {"text": 文本, "metadata": 元数据}}，不存在的编号不出现在结果中
+        """
+        chunk_ids = [int(chunk_id) for chunk_id in chunk_ids]
+        if not chunk_ids:
+            return {}
+        placeholders = ", ".join("?" * len(chunk_ids))
+        with self._read_lock:
+            rows = self._reader.execute(
+                f"SELECT id, text, metadata FROM chunks WHERE id IN ({placeholders})", chunk_ids
+            ).fetchall()
+        return {row[0]: {"text": row[1], "metadata": json.loads(row[2])} for row in rows}
+
+    def has_file(self, file_id):
+        """判断文件是否有分片"""
+        with self._read_lock:
+            row = self._reader.execute("SELECT 1 FROM chunks WHERE file_id = ? LIMIT 1", (file_id,)).fetchone()
+        return row is not None
+
+    def file_ids(self):
+        """返回有分片的文件ID列表"""
+        with self._read_lock:
+            return [row[0] for row in self._reader.execute("SELECT DISTINCT file_id FROM chunks")]
+
+    def file_chunk_ids(self, file_id):
+        """返回文件的分片编号列表，按写入顺序排列"""
+        with self._read_lock:
+            return [row[0] for row in self._reader.execute(
+                "SELECT id FROM chunks WHERE file_id = ? ORDER BY id", (file_id,)
+            )]
+
+    def file_chunks(self, file_id):
+        """
+        返回文件的全部分片
+
+        参数 file_id: 知识库文件ID
+        返回值: [(分片编号, 文本, 元数据), ...]，按写入顺序排列
+        """
+        with self._read_lock:
+            rows = self._reader.execute(
+                "SELECT id, text, metadata FROM chunks WHERE file_id = ? ORDER BY id", (file_id,)
+            ).fetchall()
+        return [(chunk_id, text, json.loads(metadata)) for chunk_id, text, metadata in rows]
+
+    def file_versions(self):
+        """
+        返回每个文件的版本：文件最大的分片编号和分片数量。新增分片的编号总是更大，
+        文件重新索引或增量更新（新增或删除分片）后版本随之变化
+
+        返回值: {file_id: (最大分片编号, 分片数量)}
+        """
+        with self._read_lock:
+            rows = self._reader.execute("SELECT file_id, MAX(id), COUNT(*) FROM chunks GROUP BY file_id").fetchall()
+        return {file_id: (max_id, count) for file_id, max_id, count in rows}
+
+    def chunk_ids_by_file(self):
+        """
+        返回全部分片编号，按文件分组
+
+        返回值: {file_id: [分片编号, ...]}，每个文件内按写入顺序排列
+        """
+        grouped = {}
+        with self._read_lock:
+            for file_id, chunk_id in self._reader.execute("SELECT file_id, id FROM chunks ORDER BY id"):
+                grouped.setdefault(file_id, []).append(chunk_id)
+        return grouped
+
+    def select_ids(self, file_ids=None, file_types=None):
+        """
+        按文件ID和文件类型筛选分片编号
+
+        参数 file_ids: 文件ID集合，可选
+        参数 file_types: 文件类型集合，可选
+        返回值: 分片编号列表
+        """
+        if (file_ids is not None and not file_ids) or (file_types is not None and not file_types):
+            return []
+        conditions, params = self._filter_conditions(file_ids, file_types)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._read_lock:
+            return [row[0] for row in self._reader.execute(f"SELECT id FROM chunks {where} ORDER BY id", params)]
+
+    @staticmethod
+    def _filter_conditions(file_ids=None, file_types=None):
+        """生成按文件ID和文件类型过滤的SQL条件和参数"""
+        conditions, params = [], []
+        if file_ids is not None:
+            file_ids = list(file_ids)
+            conditions.append(f"chunks.file_id IN ({', '.join('?' * len(file_ids))})")
+            params.extend(file_ids)
+        if file_types is not None:
+            file_types = list(file_types)
+            conditions.append(f"chunks.file_type IN ({', '.join('?' * len(file_types))})")
+            params.extend(file_types)
+        return conditions, params
+
+    def lexical_search(self, match_query, limit, file_ids=None, file_types=None):
+        """
+        关键词检索分片，按BM25排序
+
+        参数 match_query: FTS5的MATCH表达式，见 lexical_index
+        参数 limit: 最多返回的分片数量
+        参数 file_ids: 只在这些文件中检索，可选
+        参数 file_types: 只在这些类型的文件中检索，可选
+        返回值: (分片编号, BM25得分) 列表，得分越大越相关
+        """
+        if not self.lexical_enabled or not match_query:
+            return []
+        if (file_ids is not None and not file_ids) or (file_types is not None and not file_types):
+            return []
+        conditions, params = self._filter_conditions(file_ids, file_types)
+        where = "".join(f" AND {condition}" for condition in conditions)
+        with self._read_lock:
+            rows = self._reader.execute(
+                f"SELECT {CHUNKS_FTS_TABLE}.rowid, bm25({CHUNKS_FTS_TABLE}) AS score FROM {CHUNKS_FTS_TABLE} "
+                f"JOIN chunks ON chunks.id = {CHUNKS_FTS_TABLE}.rowid "
+                f"WHERE {CHUNKS_FTS_TABLE} MATCH ?{where} ORDER BY score LIMIT ?",
+                [match_query] + params + [limit]
+            ).fetchall()
+        return [(chunk_id, -score) for chunk_id, score in rows]
+
+    def count(self):
+        """
+        统计分片和文件数量
+
+        返回值: (分片数量, 文件数量)
+        """
+        with self._read_lock:
+            return tuple(self._reader.execute("SELECT COUNT(*), COUNT(DISTINCT file_id) FROM chunks").fetchone())
+
+
+class _ChunkTransaction:
+    """分片库写事务：BEGIN IMMEDIATE 获取写锁，正常退出时提交，异常时回滚"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def __enter__(self):
+        self.store._lock.acquire()
+        try:
+            self.store._conn.execute("BEGIN IMMEDIATE")
+        except Exception:
+            # 未能开始事务（如等待写锁超时）时 __exit__ 不会执行，需要在这里释放锁
+            self.store._lock.release()
+            raise
+        return self.store
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.store._conn.execute("COMMIT" if exc_type is None else "ROLLBACK")
+        finally:
+            self.store._lock.release()
+        return False
+
+
+class SegmentStore:
+    """
+    不可变索引段
+
+    每次修改统一索引都写出一个新的段目录（index.faiss + segment.json），
+    写完后原子替换 CURRENT 指针；已发布的段不再修改，各进程以只读内存映射方式打开，
+    向量数据由操作系统页缓存共享，worker数量增加不会成倍增加索引内存
+
+    取舍：段是完整的索引文件而不是增量段，每次上传或删除都要把整个索引写出一遍，
+    写入开销与索引大小成正比；换来的是读取端只需映射一个文件、无需合并多个段的结果。
+    知识库的写入频率远低于检索频率，写入又在后台任务中完成，因此保留这种方式
+    """
+
+    def __init__(self, root):
+        """
+        参数 root: 统一索引根目录
+        """
+        self.root = root
+        self.segments_dir = os.path.join(root, SEGMENTS_SUBDIR)
+        self.current_file = os.path.join(root, CURRENT_FILE)
+
+    def current_stat(self):
+        """
+        返回 CURRENT 指针文件的状态，用于低开销地判断是否发布了新段
+
+        返回值: (inode, 修改时间纳秒)，指针不存在时返回None
+        """
+        try:
+            stat = os.stat(self.current_file)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def current(self):
+        """
+        读取当前段名
+
+        返回值: 段目录名，尚未发布过段时返回None
+        """
+        try:
+            with open(self.current_file, "r", encoding="utf-8") as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _segment_path(self, name):
+        return os.path.join(self.segments_dir, name)
+
+    def open(self, name, writable=False):
+        """
+        打开一个已发布的段
+
+        参数 name: 段目录名
+        参数 writable: True时完整读入内存得到可修改的副本，否则只读内存映射
+        返回值: (FAISS索引, 段信息字典)
+        """
+        path = self._segment_path(name)
+        index_file = os.path.join(path, "index.faiss")
+        index = faiss.read_index(index_file) if writable else read_index_shared(index_file)
+        with open(os.path.join(path, "segment.json"), "r", encoding="utf-8") as f:
+            info = json.load(f)
+        return index, info
+
+    def publish(self, index, info):
+        """
+        写出新段并切换 CURRENT 指针，调用方需持有跨进程写锁
+
+        参数 index: FAISS索引
+        参数 info: 段信息字典（已删除分片编号等）
+        返回值: 新段目录名
+        """
+        current = self.current()
+        sequence = int(current) + 1 if current and current.isdigit() else 1
+        name = f"{sequence:010d}"
+        target_path = self._segment_path(name)
+        tmp_path = f"{target_path}.tmp-{os.getpid()}"
+        os.makedirs(tmp_path, exist_ok=True)
+        try:
+            faiss.write_index(index, os.path.join(tmp_path, "index.faiss"))
+            info = dict(info, sequence=sequence, created_at=time.time())
+            with open(os.path.join(tmp_path, "segment.json"), "w", encoding="utf-8") as f:
+                json.dump(info, f)
+            os.replace(tmp_path, target_path)
+            with open(self.current_file + ".tmp", "w", encoding="utf-8") as f:
+                f.write(name)
+            os.replace(self.current_file + ".tmp", self.current_file)
+        except Exception:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        self.cleanup()
+        return name
+
+    def cleanup(self, keep=KB_SEGMENT_KEEP):
+        """
+        删除较旧的段，保留当前段和最近的 keep 个旧段
+
+        仍被其他进程映射的段文件在Linux上删除后映射依然有效；Windows上删除会失败，留待下次清理
+        """
+        current = self.current()
+        if not current or not os.path.isdir(self.segments_dir):
+            return
+        names = sorted(name for name in os.listdir(self.segments_dir) if name.isdigit() and name < current)
+        for name in names[:max(len(names) - keep, 0)]:
+            shutil.rmtree(self._segment_path(name), ignore_errors=True)
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+@File    : lexical_index.py
+@Time    : 2025/10/18 14:20
+@Desc    : 关键词倒排索引，基于SQLite FTS5的BM25评分，支持中文分词，用于条款号、标准号等精确标识符的检索和混合检索
+"""
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+
+# 是否启用关键词检索，关闭后知识库只使用向量检索
+KB_LEXICAL_SEARCH = os.getenv("KB_LEXICAL_SEARCH", "1").lower() not in ("0", "false", "no", "off")
+# 混合检索时向量检索和关键词检索各取 k*该倍数 个候选参与融合
+LEXICAL_CANDIDATE_FACTOR = 4
+# 倒数排名融合(RRF)的平滑常数
+RRF_K = 60
+# 关键词查询中除标识符外允许的最多汉字数，超过时按普通问题走混合检索
+KEYWORD_QUERY_MAX_CHARS = 12
+
+# 英文单词、数字和带分隔符的标识符，如 38031-2025、5.2.1、gb/t
+_CODE_PATTERN = re.compile(r"[a-z0-9]+(?:[.\-_/][a-z0-9]+)*")
+_CODE_SEPARATORS = re.compile(r"[.\-_/]")
+# 连续的汉字
+_CJK_PATTERN = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+")
+# 标识符中的分隔符需要作为词的一部分，FTS5才不会把 5.2.1 拆开
+_FTS_TOKENIZE = "unicode61 remove_diacritics 0 tokenchars '.-_/'"
+
+try:
+    import jieba
+    jieba.setLogLevel(60)
+    TOKENIZER_NAME = "jieba"
+except ImportError:
+    # 未安装jieba时中文按相邻两字切分（二元组），不需要词典也能匹配任意中文片段
+    jieba = None
+    TOKENIZER_NAME = "bigram"
+
+
+def _normalize(text):
+    """全角转半角并转为小写"""
+    return unicodedata.normalize("NFKC", text).lower()
+
+
+def _cjk_tokens(run):
+    """切分一段连续汉字"""
+    if jieba is not None:
+        return [token for token in jieba.lcut_for_search(run) if token.strip()]
+    if len(run) == 1:
+        return [run]
+    return [run[i:i + 2] for i in range(len(run) - 1)]
+
+
+def _code_tokens(code):
+    """标识符本身及按分隔符拆开的各部分，查询 38031 也能命中 38031-2025"""
+    tokens = [code]
+    if _CODE_SEPARATORS.search(code):
+        tokens.extend(part for part in _CODE_SEPARATORS.split(code) if part)
+    return tokens
+
+
+def tokenize(text):
+    """
+    把文本切分为检索词
+
+    英文和数字按单词切分并保留完整标识符，中文使用jieba搜索模式分词，未安装jieba时使用二元组
+
+    参数 text: 文本
+    返回值: 检索词列表（保留重复，词频参与BM25评分）
+    """
+    text = _normalize(text)
+    tokens = []
+    for match in re.finditer(f"{_CODE_PATTERN.pattern}|{_CJK_PATTERN.pattern}", text):
+        piece = match.group()
+        if _CJK_PATTERN.fullmatch(piece):
+            tokens.extend(_cjk_tokens(piece))
+        else:
+            tokens.extend(_code_tokens(piece))
+    return tokens
+
+
+def identifier_tokens(text):
+    """
+    提取文本中带数字的标识符（条款号、标准号、型号等）
+
+    参数 text: 文本
+    返回值: 标识符列表
+    """
+    return [code for code in _CODE_PATTERN.findall(_normalize(text)) if any(char.isdigit() for char in code)]
+
+
+def is_keyword_query(query):
+    """
+    判断是否为以标识符为主的关键词查询，如 "GB 38031-2025 5.2.1" 或 "8.2.3条"
+
+    参数 query: 查询文本
+    返回值: 包含标识符且其余汉字不超过 KEYWORD_QUERY_MAX_CHARS 个时返回True
+    """
+    if not identifier_tokens(query):
+        return False
+    return sum(len(run) for run in _CJK_PATTERN.findall(_normalize(query))) <= KEYWORD_QUERY_MAX_CHARS
+
+
+def build_match_query(tokens, require_all=False):
+    """
+    生成FTS5的MATCH表达式
+
+    参数 tokens: 检索词列表
+    参数 require_all: True时要求全部检索词出现（AND），否则任一出现即可（OR）
+    返回值: MATCH表达式，没有检索词时返回None
+    """
+    unique = list(dict.fromkeys(token.replace('"', "") for token in tokens if token))
+    if not unique:
+        return None
+    return (" AND " if require_all else " OR ").join(f'"{token}"' for token in unique)
+
+
+def keyword_match_query(query):
+    """关键词查询的MATCH表达式：要求查询中的全部标识符出现"""
+    return build_match_query(identifier_tokens(query), require_all=True)
+
+
+def text_match_query(query):
+    """普通查询的MATCH表达式：任一检索词出现即可，由BM25排序"""
+    return build_match_query(tokenize(query))
+
+
+def create_lexical_table(conn, table):
+    """
+    创建FTS5倒排索引表（contentless，只保存倒排表不保存原文）
+
+    参数 conn: SQLite连接
+    参数 table: 表名
+    返回值: 是否创建成功，SQLite未编译FTS5时返回False
+    """
+    try:
+        conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {table} USING fts5(tokens, content='', "
+                     f"tokenize=\"{_FTS_TOKENIZE}\")")
+        return True
+    except sqlite3.OperationalError as e:
+        print(f"SQLite不支持FTS5，关键词检索不可用: {str(e)}")
+        return False
+
+
+def add_lexical_document(conn, table, rowid, text):
+    """写入一条文档的检索词"""
+    conn.execute(f"INSERT INTO {table} (rowid, tokens) VALUES (?, ?)", (rowid, " ".join(tokenize(text))))
+
+
+def remove_lexical_document(conn, table, rowid, text):
+    """删除一条文档；contentless表需要提供写入时相同的检索词"""
+    conn.execute(f"INSERT INTO {table} ({table}, rowid, tokens) VALUES ('delete', ?, ?)",
+                 (rowid, " ".join(tokenize(text))))
+
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    """
+    倒数排名融合：多个排序结果按 1/(k+名次) 累加得分，不需要统一不同检索方式的分数尺度
+
+    参数 rankings: 排序结果列表，每个元素是按相关性降序排列的键列表
+    参数 k: 平滑常数
+    返回值: 融合后按得分降序排列的键列表
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+class DocumentLexicalIndex:
+    """
+    一组文档的内存倒排索引，用于预设PDF等不在知识库中的向量存储
+    """
+
+    def __init__(self, documents):
+        """
+        参数 documents: LangChain Document列表
+        """
+        self.documents = list(documents)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(":memory:", check_same_thread=False)
+        self.enabled = create_lexical_table(self._conn, "docs_fts")
+        if self.enabled:
+            with self._conn:
+                for i, doc in enumerate(self.documents):
+                    add_lexical_document(self._conn, "docs_fts", i, doc.page_content)
+
+    def search(self, match_query, k=4):
+        """
+        检索文档
+
+        参数 match_query: MATCH表达式，见 keyword_match_query / text_match_query
+        参数 k: 返回的文档数量
+        返回值: (Document, BM25得分) 列表，得分越大越相关
+        """
+        if not self.enabled or not match_query:
+            return []
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT rowid, bm25(docs_fts) FROM docs_fts WHERE docs_fts MATCH ? ORDER BY bm25(docs_fts) LIMIT ?",
+                (match_query, k)
+            ).fetchall()
+        return [(self.documents[rowid], -score) for rowid, score in rows]
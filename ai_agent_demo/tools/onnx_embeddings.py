@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+@File    : onnx_embeddings.py
+@Time    : 2025/10/19 18:30
+@Desc    : 基于ONNX Runtime的文本嵌入后端（bge系列），可选int8动态量化，推理不需要导入PyTorch和sentence-transformers
+
+用法:
+    python tools/onnx_embeddings.py --export
+    python tools/onnx_embeddings.py --parity --threads 4
+    python tools/onnx_embeddings.py --parity --quantize
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+# 添加项目根目录到Python路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools.onnx_utils import (
+    ONNX_INTRA_OP_THREADS, ONNX_OPSET, artifact_dir, create_session, export_onnx, publish_dir, quantize_int8,
+    staging_dir,
+)
+
+# 是否使用int8动态量化的嵌入模型
+EMBEDDING_ONNX_QUANTIZE = os.getenv("EMBEDDING_ONNX_QUANTIZE", "0").lower() not in ("0", "false", "no", "off")
+# 输入的最大token数，超出部分截断（与bge模型的最大长度一致）
+EMBEDDING_MAX_LENGTH = 512
+# 一致性检查要求的最低余弦相似度
+PARITY_MIN_COSINE = 0.99
+
+ENCODER_FILE = "encoder.onnx"
+TOKENIZER_FILE = "tokenizer.json"
+CONFIG_FILE = "embedding_onnx.json"
+
+
+def export_encoder(model_name, output_dir, quantize=EMBEDDING_ONNX_QUANTIZE):
+    """
+    把句向量模型导出为ONNX，输出CLS位置的隐状态（bge系列使用CLS池化）
+
+    先导出到临时目录，完成后重命名为目标目录，其他进程不会读到导出一半的模型
+
+    参数 model_name: HuggingFace模型名称
+    参数 output_dir: 导出目录
+    参数 quantize: 是否对权重做int8动态量化
+    """
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    class ClsEncoder(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask, token_type_ids):
+            output = self.model(input_ids=input_ids, attention_mask=attention_mask,
+                                token_type_ids=token_type_ids, return_dict=False)
+            return output[0][:, 0]
+
+    start_time = time.time()
+    print(f"导出ONNX嵌入模型: {model_name} -> {output_dir}")
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name).eval()
+
+    tmp_dir = staging_dir(output_dir)
+    fp32_dir = os.path.join(tmp_dir, "fp32") if quantize else tmp_dir
+    os.makedirs(fp32_dir, exist_ok=True)
+
+    sample = tokenizer(["示例文本"], return_tensors="pt")
+    export_onnx(
+        ClsEncoder(model), (sample["input_ids"], sample["attention_mask"], sample["token_type_ids"]),
+        os.path.join(fp32_dir, ENCODER_FILE),
+        input_names=["input_ids", "attention_mask", "token_type_ids"], output_names=["embedding"],
+        dynamic_axes={
+            "input_ids": {0: "batch", 1: "sequence"},
+            "attention_mask": {0: "batch", 1: "sequence"},
+            "token_type_ids": {0: "batch", 1: "sequence"},
+            "embedding": {0: "batch"},
+        },
+        opset_version=ONNX_OPSET,
+    )
+    if quantize:
+        quantize_int8(os.path.join(fp32_dir, ENCODER_FILE), os.path.join(tmp_dir, ENCODER_FILE))
+        shutil.rmtree(fp32_dir)
+
+    # 快速分词器保存为 tokenizer.json，推理时只需要 tokenizers 库
+    tokenizer.save_pretrained(tmp_dir)
+    with open(os.path.join(tmp_dir, CONFIG_FILE), "w", encoding="utf-8") as f:
+        json.dump({"model_name": model_name, "quantize": quantize, "dim": model.config.hidden_size,
+                   "max_length": min(EMBEDDING_MAX_LENGTH, model.config.max_position_embeddings)},
+                  f, ensure_ascii=False, indent=2)
+
+    publish_dir(tmp_dir, output_dir)
+    print(f"ONNX嵌入模型导出完成，耗时: {time.time() - start_time:.2f}秒")
+
+
+class OnnxEmbeddings(Embeddings):
+    """
+    基于ONNX Runtime的句向量模型，输出L2归一化的CLS向量，与 HuggingFaceEmbeddings(normalize_embeddings=True) 一致
+
+    批量嵌入时按文本长度排序后分批，减少填充带来的无效计算
+    """
+
+    def __init__(self, model_name, quantize=EMBEDDING_ONNX_QUANTIZE, model_dir=None,
+                 num_threads=ONNX_INTRA_OP_THREADS, batch_size=32):
+        """
+        参数 model_name: HuggingFace模型名称
+        参数 quantize: 是否使用int8量化模型
+        参数 model_dir: 导出目录，默认 artifact_dir(model_name, quantize)
+        参数 num_threads: 算子内并行线程数，0表示由ONNX Runtime决定
+        参数 batch_size: 每批嵌入的文本数量
+        """
+        from tokenizers import Tokenizer
+
+        self.model_name = model_name
+        self.quantize = quantize
+        self.batch_size = batch_size
+        self.model_dir = model_dir or artifact_dir(model_name, quantize)
+        if not os.path.exists(os.path.join(self.model_dir, CONFIG_FILE)):
+            export_encoder(model_name, self.model_dir, quantize)
+        with open(os.path.join(self.model_dir, CONFIG_FILE), "r", encoding="utf-8") as f:
+            config = json.load(f)
+        self.tokenizer = Tokenizer.from_file(os.path.join(self.model_dir, TOKENIZER_FILE))
+        self.tokenizer.enable_truncation(max_length=config["max_length"])
+        self.tokenizer.enable_padding()
+        self.session = create_session(os.path.join(self.model_dir, ENCODER_FILE), num_threads)
+
+    def _embed_batch(self, texts):
+        encodings = self.tokenizer.encode_batch(texts)
+        inputs = {
+            "input_ids": np.array([encoding.ids for encoding in encodings], dtype=np.int64),
+            "attention_mask": np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64),
+            "token_type_ids": np.array([encoding.type_ids for encoding in encodings], dtype=np.int64),
+        }
+        vectors = self.session.run(None, inputs)[0].astype(np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def embed_array(self, texts):
+        """
+        嵌入一组文本
+
+        参数 texts: 文本列表
+        返回值: float32向量矩阵，行顺序与texts一致
+        """
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        result = None
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            vectors = self._embed_batch([texts[i] for i in batch])
+            if result is None:
+                result = np.empty((len(texts), vectors.shape[1]), dtype=np.float32)
+            result[batch] = vectors
+        return result
+
+    def embed_documents(self, texts):
+        return self.embed_array(list(texts)).tolist()
+
+    def embed_query(self, text):
+        return self._embed_batch([text])[0].tolist()
+
+
+def parity_texts(max_chunks=200):
+    """一致性检查使用的文本：内置样例加上知识库中已有的分片（最多 max_chunks 个）"""
+    texts = [
+        "电动汽车用动力蓄电池安全要求",
+        "GB 38031-2025 5.2.1 热扩散试验",
+        "蓄电池单体在过充电试验中不应起火、不应爆炸。",
+        "What is the thermal propagation test procedure?",
+        "试验对象应在规定的环境温度下静置，直至达到热平衡。" * 20,
+    ]
+    try:
+        from tools.kb_index import get_kb_index
+        chunks = get_kb_index()._chunks
+        chunk_ids = [chunk_id for ids in chunks.chunk_ids_by_file().values() for chunk_id in ids][:max_chunks]
+        texts.extend(chunk["text"] for chunk in chunks.get_many(chunk_ids).values())
+    except Exception as e:
+        print(f"读取知识库分片失败，只使用内置样例: {str(e)}")
+    return texts
+
+
+def check_parity(model_name, texts, quantize=EMBEDDING_ONNX_QUANTIZE, num_threads=ONNX_INTRA_OP_THREADS,
+                 min_cosine=PARITY_MIN_COSINE):
+    """
+    对比ONNX后端与sentence-transformers后端的向量，并记录两者的嵌入耗时
+
+    参数 model_name: 嵌入模型名称
+    参数 texts: 测试文本
+    参数 quantize: ONNX后端是否使用int8量化模型
+    参数 num_threads: ONNX Runtime算子内并行线程数
+    参数 min_cosine: 要求的最低余弦相似度
+    返回值: 全部文本的余弦相似度都不低于 min_cosine 时返回True
+    """
+    from tools.vectorstore import create_base_embeddings
+
+    reference_model = create_base_embeddings(model_name, backend="torch")
+    onnx_model = OnnxEmbeddings(model_name, quantize=quantize, num_threads=num_threads)
+
+    timings = {}
+    vectors = {}
+    for name, model in (("torch", reference_model), ("onnx-int8" if quantize else "onnx", onnx_model)):
+        model.embed_documents(texts[:1])
+        start = time.perf_counter()
+        vectors[name] = np.asarray(model.embed_documents(texts), dtype=np.float32)
+        timings[name] = time.perf_counter() - start
+        start = time.perf_counter()
+        for text in texts:
+            model.embed_query(text)
+        timings[f"{name}-query"] = (time.perf_counter() - start) / len(texts) * 1000
+
+    reference, candidate = vectors.values()
+    cosines = np.sum(reference * candidate, axis=1) / (
+        np.linalg.norm(reference, axis=1) * np.linalg.norm(candidate, axis=1))
+    print(f"文本数: {len(texts)}")
+    print(f"余弦相似度: 最小 {cosines.min():.5f}，平均 {cosines.mean():.5f}（要求 >= {min_cosine}）")
+    for name in vectors:
+        print(f"{name:<10} 批量嵌入 {timings[name]:.2f}秒，单条查询 {timings[f'{name}-query']:.1f}ms")
+    return bool(cosines.min() >= min_cosine)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="ONNX嵌入模型导出与一致性检查")
+    parser.add_argument("--model", default="BAAI/bge-small-zh-v1.5", help="嵌入模型名称")
+    parser.add_argument("--export", action="store_true", help="只导出ONNX模型")
+    parser.add_argument("--parity", action="store_true", help="与sentence-transformers后端对比向量一致性和耗时")
+    parser.add_argument("--quantize", action=argparse.BooleanOptionalAction, default=EMBEDDING_ONNX_QUANTIZE,
+                        help="使用int8量化模型，--no-quantize 可覆盖环境变量 EMBEDDING_ONNX_QUANTIZE")
+    parser.add_argument("--threads", type=int, default=ONNX_INTRA_OP_THREADS, help="ONNX Runtime算子内并行线程数")
+    args = parser.parse_args()
+
+    if args.export:
+        output_dir = artifact_dir(args.model, args.quantize)
+        if os.path.exists(output_dir):
+            print(f"ONNX模型已存在: {output_dir}")
+        else:
+            export_encoder(args.model, output_dir, args.quantize)
+    if args.parity:
+        passed = check_parity(args.model, parity_texts(), quantize=args.quantize, num_threads=args.threads)
+        print("一致性检查通过" if passed else "一致性检查未通过")
+        sys.exit(0 if passed else 1)
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+@File    : onnx_utils.py
+@Time    : 2025/10/19 18:10
+@Desc    : ONNX Runtime推理后端的公共工具：导出目录、int8动态量化、推理会话创建
+"""
+import os
+import shutil
+
+# ONNX模型导出目录，按模型名称和是否量化分子目录保存
+ONNX_MODEL_DIR = os.getenv(
+    "ONNX_MODEL_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "onnx_models")
+)
+# ONNX Runtime算子内并行线程数，0表示由ONNX Runtime按CPU核数决定
+ONNX_INTRA_OP_THREADS = int(os.getenv("ONNX_INTRA_OP_THREADS", "0"))
+ONNX_OPSET = 17
+
+
+def artifact_dir(model_name, quantize, root=ONNX_MODEL_DIR):
+    """
+    模型导出目录
+
+    参数 model_name: HuggingFace模型名称
+    参数 quantize: 是否量化
+    参数 root: 导出根目录
+    返回值: 目录路径
+    """
+    return os.path.join(root, model_name.replace("/", "--") + ("-int8" if quantize else ""))
+
+
+def staging_dir(output_dir):
+    """
+    创建导出用的临时目录，导出完成后由 publish_dir 重命名为目标目录，其他进程不会读到导出一半的模型
+
+    参数 output_dir: 目标目录
+    返回值: 临时目录路径
+    """
+    tmp_dir = f"{output_dir}.tmp{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    return tmp_dir
+
+
+def publish_dir(tmp_dir, output_dir):
+    """
+    把导出完成的临时目录重命名为目标目录
+
+    参数 tmp_dir: 临时目录
+    参数 output_dir: 目标目录
+    """
+    try:
+        os.rename(tmp_dir, output_dir)
+    except OSError:
+        # 其他进程已经完成导出
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def export_onnx(model, args, output_path, **kwargs):
+    """
+    导出ONNX模型，固定使用TorchScript导出器
+
+    PyTorch 2.9起 torch.onnx.export 默认改用dynamo导出器，需要额外安装onnxscript，
+    且不按 dynamic_axes 处理动态维度，导出的图中输出名还可能与内部节点重名而无法加载
+
+    参数 model: torch.nn.Module
+    参数 args: 示例输入元组
+    参数 output_path: 输出路径
+    参数 kwargs: 其余 torch.onnx.export 参数（input_names、dynamic_axes 等）
+    """
+    import inspect
+    import torch
+
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        kwargs["dynamo"] = False
+    torch.onnx.export(model, args, output_path, **kwargs)
+
+
+def quantize_int8(input_path, output_path):
+    """
+    对ONNX模型的权重做int8动态量化，激活值在推理时动态量化
+
+    参数 input_path: float32模型路径
+    参数 output_path: 量化后的模型路径
+    """
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    quantize_dynamic(input_path, output_path, weight_type=QuantType.QInt8)
+
+
+def create_session(model_path, num_threads=ONNX_INTRA_OP_THREADS):
+    """
+    创建CPU推理会话，启用全部图优化
+
+    参数 model_path: ONNX模型路径
+    参数 num_threads: 算子内并行线程数，0表示由ONNX Runtime决定
+    返回值: onnxruntime.InferenceSession
+    """
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if num_threads:
+        options.intra_op_num_threads = num_threads
+    return ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
@@ -2,10 +2,17 @@
 """
 @File    : search_tool.py
 @Time    : 2025/9/25 15:13
-@Desc    : 基于Tavily搜索的网络搜索工具
+@Desc    : 基于Tavily搜索的网络搜索工具，复用连接池，设置请求超时，按查询缓存搜索结果
 """
 import os
+import json
+import time
+import asyncio
+import hashlib
+import threading
+import unicodedata
 import warnings
+from collections import OrderedDict
 
 # 禁用LangSmith警告
 warnings.filterwarnings("ignore", category=Warning, module="langsmith")
@@ -13,60 +20,311 @@ warnings.filterwarnings("ignore", category=Warning, module="langsmith")
 # 设置环境变量禁用LangSmith跟踪
 os.environ['LANGCHAIN_TRACING_V2'] = 'false'
 
-from dotenv import load_dotenv
+# 搜索后端: tavily 调用Tavily搜索API / fake 本地假数据，用于离线测试
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "tavily").lower()
+# 单次搜索请求的超时时间（秒）
+SEARCH_TIMEOUT = float(os.getenv("SEARCH_TIMEOUT", "10"))
+# 搜索结果缓存的有效期（秒），0表示不缓存
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "600"))
+# 搜索结果缓存容量
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "256"))
+# 连接池大小，与对话线程池的并发数相当即可
+SEARCH_POOL_SIZE = int(os.getenv("SEARCH_POOL_SIZE", "8"))
 
-# 加载.env文件中的环境变量
-dotenv_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env')
-load_dotenv(dotenv_path)
+TAVILY_SEARCH_URL = "https://api.tavily.com/search"
+# 默认搜索参数：返回5个结果，基础搜索，不包含原始网页内容
+DEFAULT_SEARCH_PARAMS = {"max_results": 5, "search_depth": "basic", "include_raw_content": False}
 
-# 使用新的Tavily搜索方法
-from langchain_tavily import TavilySearch
 
-def search_web(query: str) -> str:
-    try:
-        # 初始化Tavily搜索
-        search = TavilySearch(
-            api_key=os.getenv('TAVILY_API_KEY'),
-            k=5,  # 返回5个搜索结果
-            search_depth="basic",  # 基础搜索
-            include_raw_content=False  # 不包含原始内容
+def normalize_search_query(query):
+    """
+    规范化搜索词：统一全角/半角字符、合并多余空白并转为小写，作为结果缓存的键
+
+    参数 query: 搜索词
+    返回值: 规范化后的搜索词
+    """
+    return " ".join(unicodedata.normalize("NFKC", query).split()).lower()
+
+
+class TavilySearchBackend:
+    """
+    Tavily搜索API客户端
+
+    使用一个 requests.Session 复用HTTPS连接，避免每次搜索重新建立TCP和TLS连接。
+    langchain_tavily 的 TavilySearch 每次调用 requests.post 新建连接且不支持超时，
+    因此这里直接调用同一个REST接口（/search），请求参数和返回的 results 字段与其一致
+    """
+
+    def __init__(self, api_key=None, timeout=SEARCH_TIMEOUT, pool_size=SEARCH_POOL_SIZE):
+        """
+        参数 api_key: Tavily API密钥，默认读取环境变量TAVILY_API_KEY
+        参数 timeout: 请求超时时间（秒）
+        参数 pool_size: 连接池大小
+        """
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.api_key = api_key
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def search(self, query, timeout=None, **params):
+        """
+        执行搜索
+
+        参数 query: 搜索词
+        参数 timeout: 本次请求的超时时间（秒），默认使用构造时的设置
+        参数 params: Tavily搜索参数（max_results、search_depth 等）
+        返回值: 结果字典列表，每项包含 title / url / content / score
+        """
+        api_key = self.api_key or os.getenv("TAVILY_API_KEY")
+        if not api_key:
+            raise ValueError("未配置TAVILY_API_KEY")
+        response = self.session.post(
+            TAVILY_SEARCH_URL,
+            json=dict(params, query=query),
+            headers={"Authorization": f"Bearer {api_key}"},
+            timeout=timeout or self.timeout,
         )
-        
-        # 执行搜索
-        results = search.invoke(query)
-        
-        # 检查结果类型并适当处理
-        if isinstance(results, str):
-            # 如果结果是字符串，直接返回
-            return results
-        elif hasattr(results, 'get'):
-            # 如果结果是一个字典，提取content字段
-            return results.get('content', str(results))
-        elif isinstance(results, list):
-            # 如果结果是一个列表，格式化每个元素
-            formatted_results = []
-            for i, result in enumerate(results):
-                if isinstance(result, dict):
-                    formatted_result = {
-                        "title": result.get("title", f"结果 {i+1}"),
-                        "url": result.get("url", ""),
-                        "content": result.get("content", ""),
-                        "score": result.get("score", 0)
-                    }
-                    formatted_results.append(formatted_result)
-                else:
-                    # 对于非字典元素，转为字符串
-                    formatted_results.append(str(result))
-            
-            return str(formatted_results)
+        response.raise_for_status()
+        return response.json().get("results", [])
+
+    def close(self):
+        self.session.close()
+
+
+class FakeSearchBackend:
+    """
+    本地假搜索后端，不访问网络，返回由搜索词生成的固定结果
+
+    可通过环境变量 SEARCH_FAKE_DELAY 模拟网络延迟（秒），用于测试超时和缓存
+    """
+
+    def __init__(self, delay=None, timeout=SEARCH_TIMEOUT):
+        """
+        参数 delay: 每次搜索的模拟延迟（秒）
+        参数 timeout: 请求超时时间（秒），与 TavilySearchBackend 一致
+        """
+        self.delay = float(os.getenv("SEARCH_FAKE_DELAY", "0")) if delay is None else delay
+        self.timeout = timeout
+        # 搜索在多个线程中并发执行，调用计数需要加锁
+        self.calls = 0
+        self._calls_lock = threading.Lock()
+
+    def search(self, query, timeout=None, **params):
+        with self._calls_lock:
+            self.calls += 1
+        timeout = timeout or self.timeout
+        if self.delay:
+            if timeout and self.delay > timeout:
+                time.sleep(timeout)
+                raise TimeoutError(f"搜索超时（{timeout}秒）")
+            time.sleep(self.delay)
+        return [
+            {
+                "title": f"{query} - 示例结果 {i + 1}",
+                "url": f"https://example.com/search/{hashlib.md5(query.encode('utf-8')).hexdigest()[:8]}/{i + 1}",
+                "content": f"关于“{query}”的示例内容 {i + 1}。",
+                "score": round(1.0 - i * 0.1, 2),
+            }
+            for i in range(params.get("max_results", DEFAULT_SEARCH_PARAMS["max_results"]))
+        ]
+
+    def close(self):
+        pass
+
+
+def create_search_backend(name=SEARCH_BACKEND):
+    """
+    按名称创建搜索后端
+
+    参数 name: tavily / fake
+    返回值: 搜索后端实例
+    """
+    if name == "fake":
+        return FakeSearchBackend()
+    return TavilySearchBackend()
+
+
+class SearchClient:
+    """
+    带结果缓存的网络搜索客户端
+
+    结果按规范化的搜索词和搜索参数缓存 SEARCH_CACHE_TTL 秒，agent重复搜索相同内容时不再访问网络；
+    出错的结果不缓存
+    """
+
+    def __init__(self, backend, cache_ttl=SEARCH_CACHE_TTL, cache_size=SEARCH_CACHE_SIZE):
+        """
+        参数 backend: 搜索后端
+        参数 cache_ttl: 缓存有效期（秒），0表示不缓存
+        参数 cache_size: 缓存容量
+        """
+        self.backend = backend
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def cache_key(query, params):
+        """搜索结果缓存键：规范化的搜索词 + 排序后的搜索参数"""
+        return json.dumps([normalize_search_query(query), sorted(params.items())], ensure_ascii=False)
+
+    def get_cached(self, query, **params):
+        """
+        查询缓存
+
+        参数 query: 搜索词
+        参数 params: 搜索参数
+        返回值: 缓存的结果列表，未命中或已过期时返回None
+        """
+        if self.cache_ttl <= 0:
+            return None
+        key = self.cache_key(query, dict(DEFAULT_SEARCH_PARAMS, **params))
+        with self._lock:
+            item = self._cache.get(key)
+            if item is None or item[0] < time.time():
+                if item is not None:
+                    del self._cache[key]
+                self.misses += 1
+                return None
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def search(self, query, timeout=None, **params):
+        """
+        执行搜索，优先使用缓存
+
+        参数 query: 搜索词
+        参数 timeout: 本次请求的超时时间（秒），可选
+        参数 params: 搜索参数，未指定的使用 DEFAULT_SEARCH_PARAMS
+        返回值: 结果字典列表
+        """
+        cached = self.get_cached(query, **params)
+        if cached is not None:
+            return cached
+        return self.fetch(query, timeout=timeout, **params)
+
+    def fetch(self, query, timeout=None, **params):
+        """
+        跳过缓存查询，直接请求搜索后端并写入缓存
+
+        参数 query: 搜索词
+        参数 timeout: 本次请求的超时时间（秒），可选
+        参数 params: 搜索参数
+        返回值: 结果字典列表
+        """
+        params = dict(DEFAULT_SEARCH_PARAMS, **params)
+        results = self.backend.search(query, timeout=timeout, **params)
+        if self.cache_ttl > 0:
+            with self._lock:
+                self._cache[self.cache_key(query, params)] = (time.time() + self.cache_ttl, results)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return results
+
+    def stats(self):
+        """
+        返回缓存统计
+
+        返回值: 包含后端、条目数和命中率的字典
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "backend": type(self.backend).__name__,
+                "entries": len(self._cache),
+                "ttl": self.cache_ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+# 全局搜索客户端，首次搜索时创建
+_search_client = None
+_search_client_lock = threading.Lock()
+
+
+def get_search_client():
+    """
+    获取全局搜索客户端
+
+    返回值: SearchClient实例
+    """
+    global _search_client
+    if _search_client is None:
+        with _search_client_lock:
+            if _search_client is None:
+                _search_client = SearchClient(create_search_backend())
+    return _search_client
+
+
+def format_results(results):
+    """把搜索结果整理为agent可读的文本"""
+    formatted_results = []
+    for i, result in enumerate(results):
+        if isinstance(result, dict):
+            formatted_results.append({
+                "title": result.get("title", f"结果 {i+1}"),
+                "url": result.get("url", ""),
+                "content": result.get("content", ""),
+                "score": result.get("score", 0)
+            })
         else:
-            # 对于其他类型，转为字符串
-            return str(results)
+            # 对于非字典元素，转为字符串
+            formatted_results.append(str(result))
+    return str(formatted_results)
+
+
+def _run_search(search, query, timeout):
+    """执行搜索并格式化结果，出错时返回错误信息"""
+    try:
+        return format_results(search(query, timeout=timeout))
     except Exception as e:
         print(f"搜索出错: {str(e)}")
         return f"搜索失败: {str(e)}"
 
+
+def search_web(query: str, timeout: float = None) -> str:
+    """
+    网络搜索，agent的 Web Search 工具
+
+    参数 query: 搜索词
+    参数 timeout: 超时时间（秒），默认SEARCH_TIMEOUT
+    返回值: 格式化后的搜索结果，失败时返回错误信息
+    """
+    return _run_search(get_search_client().search, query, timeout)
+
+
+async def asearch_web(query: str, timeout: float = None) -> str:
+    """
+    网络搜索的异步版本：缓存命中时直接返回，否则在线程池中执行请求，不阻塞事件循环
+
+    参数 query: 搜索词
+    参数 timeout: 超时时间（秒），默认SEARCH_TIMEOUT
+    返回值: 格式化后的搜索结果，失败时返回错误信息
+    """
+    client = get_search_client()
+    cached = client.get_cached(query)
+    if cached is not None:
+        return format_results(cached)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, _run_search, client.fetch, query, timeout)
+
+
 if __name__ == '__main__':
+    from dotenv import load_dotenv
+
+    # 单独运行时加载.env文件中的环境变量，作为模块导入时由调用方加载
+    load_dotenv(os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env'))
     # 测试搜索功能
     print("正在测试搜索功能...")
     rsp = search_web("今天是哪天？")
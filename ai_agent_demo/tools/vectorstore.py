@@ -5,48 +5,444 @@
 @Desc    : 文档向量存储构建与相似度检索模块，支持PDF/TXT/DOCX格式
 """
 import os
+import json
 import time
-from langchain_community.document_loaders import PyPDFLoader, TextLoader, Docx2txtLoader
+import pickle
+import shutil
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_community.document_loaders import TextLoader, Docx2txtLoader
 from langchain_community.vectorstores import FAISS
-from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from pathlib import Path
 
+from tools.index_factory import read_index_shared
+from tools.ingestion import (EMBEDDING_BATCH_SIZE, EMBEDDING_NUM_WORKERS, EMBEDDING_NUM_THREADS,
+                             ProcessPoolEmbeddings, embed_documents_in_batches, set_num_threads)
+from tools.pdf_extract import ParallelPDFLoader
+
 # 全局缓存，用于存储预加载的嵌入模型
 _embeddings_cache = {}
+_embeddings_lock = threading.Lock()
 
 # 默认配置参数
 DEFAULT_EMBEDDING_MODEL = "BAAI/bge-small-zh-v1.5"
 DEFAULT_CHUNK_SIZE = 1000
 DEFAULT_CHUNK_OVERLAP = 200
 
+# 图片文件类型，通过图像描述生成文本后再向量化
+IMAGE_FILE_TYPES = [".jpg", ".jpeg", ".png", ".gif"]
+
+# 持久化索引存储目录，可通过环境变量FAISS_INDEX_DIR覆盖
+DEFAULT_INDEX_DIR = os.getenv(
+    "FAISS_INDEX_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "faiss_index")
+)
+# 单文件索引存放的子目录
+FILE_INDEX_SUBDIR = "files"
+
+# 分片向量持久化缓存（SQLite）路径，设置为空字符串可关闭
+EMBEDDING_CACHE_DB = os.getenv("EMBEDDING_CACHE_DB", os.path.join(DEFAULT_INDEX_DIR, "embeddings.sqlite"))
+
+# 查询向量LRU缓存容量，可通过环境变量QUERY_EMBEDDING_CACHE_SIZE调整
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "1024"))
+
+# 嵌入推理后端: torch 使用sentence-transformers / onnx 使用ONNX Runtime（首次使用时导出模型，见 tools/onnx_embeddings.py）
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch").lower()
+
+
+def normalize_query(text):
+    """
+    规范化查询文本：统一全角/半角字符并合并多余空白，作为查询向量缓存的键
+    
+    参数 text: 查询文本
+    返回值: 规范化后的文本
+    """
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    带查询向量LRU缓存的嵌入模型包装类
+    
+    所有检索路径（知识库检索、预设PDF检索、Agent工具调用）都通过get_embeddings获取同一个实例，
+    同一查询在请求内只嵌入一次，热门查询跨请求也无需再跑模型前向计算。
+    文档分片则先查磁盘上的分片向量缓存，只有从未见过的分片才会交给模型
+    """
+    
+    def __init__(self, embeddings, model_name, max_size=QUERY_EMBEDDING_CACHE_SIZE, chunk_store=None):
+        """
+        参数 embeddings: 实际执行嵌入的模型实例
+        参数 model_name: 嵌入模型名称，作为缓存键的一部分
+        参数 max_size: 缓存的最大查询条数
+        参数 chunk_store: 分片向量持久化缓存（EmbeddingStore），为None时不缓存分片向量
+        """
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.max_size = max_size
+        self.chunk_store = chunk_store
+        self._query_cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def embed_documents(self, texts):
+        """
+        嵌入文档分片，已缓存的分片直接读取，只嵌入未命中的分片并写回缓存
+        
+        参数 texts: 分片文本列表
+        返回值: 向量列表，与texts一一对应
+        """
+        if self.chunk_store is None or not texts:
+            return self.embeddings.embed_documents(texts)
+        
+        from cache.embedding_cache import chunk_key
+        keys = [chunk_key(text, self.model_name) for text in texts]
+        found = self.chunk_store.get_many(keys)
+        
+        # 同一批次内重复的分片也只嵌入一次
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            new_items = list(zip(missing.keys(), vectors))
+            self.chunk_store.put_many(new_items, self.model_name)
+            found.update(new_items)
+            print(f"分片向量缓存: 复用 {len(texts) - len(missing)} 个，新嵌入 {len(missing)} 个")
+        return [np.asarray(found[key], dtype=np.float32).tolist() for key in keys]
+    
+    def embed_query(self, text):
+        """
+        嵌入查询文本，优先从LRU缓存中获取
+        
+        参数 text: 查询文本
+        返回值: 查询向量
+        """
+        normalized = normalize_query(text)
+        key = (self.model_name, normalized)
+        with self._lock:
+            vector = self._query_cache.get(key)
+            if vector is not None:
+                self._query_cache.move_to_end(key)
+                self.hits += 1
+                return list(vector)
+            self.misses += 1
+        
+        # 模型计算放在锁外，避免阻塞其他查询
+        vector = tuple(self.embeddings.embed_query(normalized))
+        with self._lock:
+            self._query_cache[key] = vector
+            self._query_cache.move_to_end(key)
+            while len(self._query_cache) > self.max_size:
+                self._query_cache.popitem(last=False)
+        return list(vector)
+    
+    def stats(self):
+        """返回查询向量缓存的命中统计"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "model_name": self.model_name,
+                "size": len(self._query_cache),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+def embedding_model_id(model_name=DEFAULT_EMBEDDING_MODEL, backend=None):
+    """
+    分片向量缓存使用的模型标识：int8量化模型的向量与原模型略有差异，单独缓存
+    
+    参数 model_name: 嵌入模型名称
+    参数 backend: 推理后端，默认EMBEDDING_BACKEND
+    返回值: 模型标识
+    """
+    if (backend or EMBEDDING_BACKEND) == "onnx":
+        from tools.onnx_embeddings import EMBEDDING_ONNX_QUANTIZE
+        if EMBEDDING_ONNX_QUANTIZE:
+            return f"{model_name}|onnx-int8"
+    return model_name
+
+
+def create_base_embeddings(model_name=DEFAULT_EMBEDDING_MODEL, backend=None):
+    """
+    创建实际执行嵌入的模型实例（不带缓存），嵌入工作进程中也使用此函数加载模型
+    
+    参数 model_name: 嵌入模型名称
+    参数 backend: 推理后端 torch / onnx，默认EMBEDDING_BACKEND
+    返回值: HuggingFaceEmbeddings或OnnxEmbeddings实例
+    """
+    if (backend or EMBEDDING_BACKEND) == "onnx":
+        from tools.onnx_embeddings import OnnxEmbeddings
+        from tools.onnx_utils import ONNX_INTRA_OP_THREADS
+        return OnnxEmbeddings(model_name, num_threads=ONNX_INTRA_OP_THREADS or EMBEDDING_NUM_THREADS,
+                              batch_size=EMBEDDING_BATCH_SIZE)
+    # sentence-transformers/PyTorch导入开销较大，首次加载模型时才导入
+    from langchain_huggingface import HuggingFaceEmbeddings
+    return HuggingFaceEmbeddings(
+        model_name=model_name,
+        model_kwargs={"device": "cpu"},
+        encode_kwargs={"normalize_embeddings": True, "batch_size": EMBEDDING_BATCH_SIZE}
+    )
+
 
 def get_embeddings(model_name=DEFAULT_EMBEDDING_MODEL):
     """
     获取嵌入模型，优先从缓存中获取，不存在则创建新实例
     
+    返回的实例带有查询向量LRU缓存；配置了多个嵌入工作进程时，文档分片会分发到进程池嵌入
+    
     参数 model_name: 嵌入模型名称
-    返回值: HuggingFaceEmbeddings实例
+    返回值: CachedEmbeddings实例
     """
-    if model_name not in _embeddings_cache:
+    if model_name in _embeddings_cache:
+        return _embeddings_cache[model_name]
+    with _embeddings_lock:
+        if model_name in _embeddings_cache:
+            return _embeddings_cache[model_name]
         start_time = time.time()
         print(f"加载嵌入模型: {model_name}")
-        embeddings = HuggingFaceEmbeddings(
-            model_name=model_name,
-            model_kwargs={"device": "cpu"},
-            encode_kwargs={"normalize_embeddings": True}
-        )
-        _embeddings_cache[model_name] = embeddings
+        if EMBEDDING_BACKEND != "onnx":
+            # ONNX后端通过会话参数设置线程数，不需要导入PyTorch
+            set_num_threads(EMBEDDING_NUM_THREADS)
+        embeddings = create_base_embeddings(model_name)
+        if EMBEDDING_NUM_WORKERS > 1:
+            embeddings = ProcessPoolEmbeddings(embeddings, model_name)
+        chunk_store = None
+        if EMBEDDING_CACHE_DB:
+            from cache.embedding_cache import get_embedding_store
+            chunk_store = get_embedding_store(EMBEDDING_CACHE_DB)
+        _embeddings_cache[model_name] = CachedEmbeddings(embeddings, embedding_model_id(model_name),
+                                                         chunk_store=chunk_store)
         print(f"嵌入模型加载完成，耗时: {time.time() - start_time:.2f}秒")
     return _embeddings_cache[model_name]
 
-def build_vectorstore_from_document(file_path=None, chunk_size=DEFAULT_CHUNK_SIZE, chunk_overlap=DEFAULT_CHUNK_OVERLAP):
+
+def get_chunk_cache_stats():
+    """
+    获取分片向量持久化缓存的统计
+    
+    返回值: 统计字典，未启用时返回None
+    """
+    if not EMBEDDING_CACHE_DB:
+        return None
+    from cache.embedding_cache import get_embedding_store
+    return get_embedding_store(EMBEDDING_CACHE_DB).stats()
+
+
+def lookup_chunk_embeddings(texts, model_name=DEFAULT_EMBEDDING_MODEL):
+    """
+    从分片向量持久化缓存中取回分片的原始float32向量，不调用嵌入模型
+
+    参数 texts: 分片文本列表
+    参数 model_name: 嵌入模型名称
+    返回值: 与texts一一对应的向量列表，未命中或缓存未启用时对应位置为None
+    """
+    if not EMBEDDING_CACHE_DB or not texts:
+        return [None] * len(texts)
+    from cache.embedding_cache import get_embedding_store, chunk_key
+    keys = [chunk_key(text, embedding_model_id(model_name)) for text in texts]
+    found = get_embedding_store(EMBEDDING_CACHE_DB).get_many(keys, record_stats=False)
+    return [found.get(key) for key in keys]
+
+
+def get_query_cache_stats():
+    """
+    获取所有已加载嵌入模型的查询向量缓存统计
+    
+    返回值: 以模型名称为键的统计字典
+    """
+    return {model_name: embeddings.stats() for model_name, embeddings in _embeddings_cache.items()}
+
+
+def compute_file_hash(file_path, block_size=1024 * 1024):
+    """
+    分块读取文件并计算内容哈希，避免一次性读入大文件
+    
+    参数 file_path: 文件路径
+    参数 block_size: 每次读取的字节数
+    返回值: 文件内容的sha256十六进制字符串
+    """
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def get_index_key(file_hash, model_name=DEFAULT_EMBEDDING_MODEL, chunk_size=DEFAULT_CHUNK_SIZE,
+                  chunk_overlap=DEFAULT_CHUNK_OVERLAP, extra=None):
+    """
+    生成持久化索引的键：文件内容哈希 + 嵌入模型 + 分块参数，任一项变化都会得到新键
+    
+    参数 file_hash: 文件内容哈希
+    参数 model_name: 嵌入模型标识，由embedding_model_id生成，不同推理后端的向量分别持久化
+    参数 chunk_size: 文本分块大小
+    参数 chunk_overlap: 分块重叠大小
+    参数 extra: 其他会影响索引内容的参数（如图片路径），可选
+    返回值: 索引键字符串
+    """
+    key_parts = [file_hash, model_name, str(chunk_size), str(chunk_overlap)]
+    if extra:
+        key_parts.append(str(extra))
+    return hashlib.sha256("|".join(key_parts).encode("utf-8")).hexdigest()
+
+
+def _get_index_path(key, index_dir=None):
+    """返回指定索引键对应的磁盘目录"""
+    return os.path.join(index_dir or DEFAULT_INDEX_DIR, FILE_INDEX_SUBDIR, key)
+
+
+def save_vectorstore(vectorstore, key, index_dir=None, meta=None):
+    """
+    将向量存储（FAISS索引及docstore）写入磁盘，先写临时目录再整体替换，避免写入一半被读取
+    
+    参数 vectorstore: FAISS向量存储对象
+    参数 key: 索引键，由get_index_key生成
+    参数 index_dir: 持久化根目录，默认DEFAULT_INDEX_DIR
+    参数 meta: 需要一并记录的描述信息（文件名、模型等），可选
+    """
+    target_path = _get_index_path(key, index_dir)
+    tmp_path = f"{target_path}.tmp-{os.getpid()}"
+    try:
+        vectorstore.save_local(tmp_path)
+        with open(os.path.join(tmp_path, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta or {}, f, ensure_ascii=False, indent=2)
+        if os.path.exists(target_path):
+            shutil.rmtree(target_path, ignore_errors=True)
+        os.replace(tmp_path, target_path)
+        print(f"向量索引已持久化: {target_path}")
+    except Exception as e:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        print(f"持久化向量索引失败: {str(e)}")
+
+
+def load_vectorstore(key, model_name=DEFAULT_EMBEDDING_MODEL, index_dir=None):
+    """
+    从磁盘加载持久化的向量存储
+    
+    参数 key: 索引键，由get_index_key生成
+    参数 model_name: 查询时使用的嵌入模型名称
+    参数 index_dir: 持久化根目录，默认DEFAULT_INDEX_DIR
+    返回值: FAISS向量存储对象，不存在或加载失败时返回None
+    """
+    index_path = _get_index_path(key, index_dir)
+    if not os.path.exists(os.path.join(index_path, "index.faiss")):
+        return None
+    try:
+        # 索引以只读内存映射方式打开，多个worker加载同一文件时共享页缓存；
+        # docstore由本服务写入，可以直接反序列化
+        index = read_index_shared(os.path.join(index_path, "index.faiss"))
+        with open(os.path.join(index_path, "index.pkl"), "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+        vectorstore = FAISS(get_embeddings(model_name), index, docstore, index_to_docstore_id)
+        print(f"从磁盘加载向量索引: {index_path}")
+        return vectorstore
+    except Exception as e:
+        print(f"加载持久化向量索引失败 ({index_path}): {str(e)}")
+        return None
+
+
+def content_hash(text):
+    """
+    计算文本内容哈希，用于判断页面或分片在文件更新前后是否变化
+
+    参数 text: 文本
+    返回值: sha256十六进制字符串
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def get_document_loader(file_path):
+    """
+    按文件扩展名选择文档加载器，PDF每页一个Document（多进程并行解析，按页序产出），TXT/DOCX整个文件一个Document
+
+    参数 file_path: 文档文件路径
+    返回值: LangChain文档加载器
+    """
+    file_ext = Path(file_path).suffix.lower()
+    if file_ext == '.pdf':
+        return ParallelPDFLoader(file_path)
+    elif file_ext == '.txt':
+        return TextLoader(str(file_path), encoding='utf-8')
+    elif file_ext == '.docx':
+        return Docx2txtLoader(str(file_path))
+    raise ValueError(f"不支持的文件格式: {file_ext}")
+
+
+def create_text_splitter(chunk_size=DEFAULT_CHUNK_SIZE, chunk_overlap=DEFAULT_CHUNK_OVERLAP):
+    """创建文本分片器"""
+    return RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,  # 每个分片的字符数
+        chunk_overlap=chunk_overlap,  # 分片间重叠的字符数
+        separators=["\n\n", "\n", ". ", ", ", " "]
+    )
+
+
+def split_page(page, text_splitter, page_number):
+    """
+    对一页文档分片，在分片元数据中记录页码、页面内容哈希和分片内容哈希，
+    文件更新时据此找出未变化的页面和分片，只重新嵌入变化的部分
+
+    参数 page: 一页文档（Document）
+    参数 text_splitter: 文本分片器
+    参数 page_number: 页码（从0开始），加载器未提供页码时使用
+    返回值: 分片Document列表
+    """
+    page_hash = content_hash(page.page_content)
+    chunks = text_splitter.split_documents([page])
+    for chunk in chunks:
+        chunk.metadata.setdefault("page", page_number)
+        chunk.metadata["page_hash"] = page_hash
+        chunk.metadata["chunk_hash"] = content_hash(chunk.page_content)
+    return chunks
+
+
+def persist_document_vectorstore(file_path, texts, vectors, metadatas, chunk_size=DEFAULT_CHUNK_SIZE,
+                                 chunk_overlap=DEFAULT_CHUNK_OVERLAP):
+    """
+    用已计算好的分片向量构建文档的向量存储，并按文件内容哈希写回磁盘
+
+    参数 file_path: 文档文件路径
+    参数 texts: 分片文本列表
+    参数 vectors: 分片向量列表
+    参数 metadatas: 分片元数据列表
+    参数 chunk_size: 文本分块大小（索引键的一部分）
+    参数 chunk_overlap: 分块重叠大小（索引键的一部分）
+    返回值: FAISS向量存储对象
+    """
+    vectorstore = FAISS.from_embeddings(list(zip(texts, vectors)), get_embeddings(), metadatas=metadatas)
+    index_key = get_index_key(compute_file_hash(file_path), embedding_model_id(), chunk_size, chunk_overlap)
+    save_vectorstore(vectorstore, index_key, meta={
+        "source": str(file_path),
+        "embedding_model": embedding_model_id(),
+        "chunk_size": chunk_size,
+        "chunk_overlap": chunk_overlap,
+    })
+    return vectorstore
+
+
+def build_vectorstore_from_document(file_path=None, chunk_size=DEFAULT_CHUNK_SIZE, chunk_overlap=DEFAULT_CHUNK_OVERLAP,
+                                    persist=True, progress_callback=None):
     """
     从文档文件构建向量存储，支持PDF/TXT/DOCX格式
     
+    启用持久化时，先按文件内容哈希查找磁盘上已有的索引，命中则直接加载，
+    未命中才解析并嵌入文档，构建完成后写回磁盘
+    
     参数 file_path: 文档文件路径
     参数 chunk_size: 文本分块大小
     参数 chunk_overlap: 分块重叠大小
+    参数 persist: 是否使用磁盘持久化索引
+    参数 progress_callback: 嵌入进度回调，参数为已嵌入的分片数，可选
     返回值: FAISS向量存储对象
     """
     # 获取当前脚本所在目录的父目录（即ai_agent_demo目录）
@@ -57,38 +453,45 @@ def build_vectorstore_from_document(file_path=None, chunk_size=DEFAULT_CHUNK_SIZ
         file_path = os.path.join(agent_dir, "temp_全球AI生态全景概览.pdf")
     
     file_path = Path(file_path)
-    file_ext = file_path.suffix.lower()
+    
+    # 优先从磁盘加载已持久化的索引
+    index_key = None
+    if persist:
+        index_key = get_index_key(compute_file_hash(file_path), embedding_model_id(), chunk_size, chunk_overlap)
+        vectorstore = load_vectorstore(index_key)
+        if vectorstore is not None:
+            return vectorstore
     
     print(f"加载文档文件: {file_path}")
     
     # 根据文件扩展名选择合适的加载器
-    if file_ext == '.pdf':
-        loader = PyPDFLoader(str(file_path))
-    elif file_ext == '.txt':
-        loader = TextLoader(str(file_path), encoding='utf-8')
-    elif file_ext == '.docx':
-        loader = Docx2txtLoader(str(file_path))
-    else:
-        raise ValueError(f"不支持的文件格式: {file_ext}")
-    
-    # 加载文档
-    docs = loader.load()
-    
-    # 文本分片处理
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=chunk_size,  # 每个分片的字符数
-        chunk_overlap=chunk_overlap,  # 分片间重叠的字符数
-        separators=["\n\n", "\n", ". ", ", ", " "]
-    )
-    split_docs = text_splitter.split_documents(docs)
-    
-    print(f"文档加载完成，共 {len(split_docs)} 个分片")
+    loader = get_document_loader(file_path)
+    text_splitter = create_text_splitter(chunk_size, chunk_overlap)
     
     # 获取嵌入模型（使用缓存）
     embeddings = get_embeddings()
     
+    # 逐页加载并分片，分片凑满一批即送去嵌入，无需等待整个文档解析完成
+    split_docs = (chunk for page_number, doc in enumerate(loader.lazy_load())
+                  for chunk in split_page(doc, text_splitter, page_number))
+    texts, vectors, metadatas = embed_documents_in_batches(split_docs, embeddings,
+                                                           progress_callback=progress_callback)
+    if not texts:
+        raise ValueError(f"文档中没有可索引的文本内容: {file_path}")
+    
+    print(f"文档加载完成，共 {len(texts)} 个分片")
+    
     # 构建向量存储
-    vectorstore = FAISS.from_documents(split_docs, embedding=embeddings)
+    vectorstore = FAISS.from_embeddings(list(zip(texts, vectors)), embeddings, metadatas=metadatas)
+    
+    # 写回磁盘，重启或其他副本可直接加载
+    if index_key:
+        save_vectorstore(vectorstore, index_key, meta={
+            "source": str(file_path),
+            "embedding_model": embedding_model_id(),
+            "chunk_size": chunk_size,
+            "chunk_overlap": chunk_overlap,
+        })
     return vectorstore
 
 # 保留原函数名以保持兼容性
@@ -102,6 +505,69 @@ def build_vectorstore_from_pdf(pdf_path=None):
     return build_vectorstore_from_document(pdf_path)
 
 
+def build_vectorstore_from_image(file_path, file_name=None, persist=True):
+    """
+    为图片文件生成描述并构建向量存储
+    
+    图片描述中包含保存路径，因此索引键额外加入文件路径
+    
+    参数 file_path: 图片文件路径
+    参数 file_name: 图片原始文件名，写入文档元数据
+    参数 persist: 是否使用磁盘持久化索引
+    返回值: FAISS向量存储对象
+    """
+    from langchain_core.documents import Document
+    from multimodal.image_captioning import caption_image, MODEL_NAME as CAPTION_MODEL_NAME
+    
+    file_type = Path(file_path).suffix.lower()
+    index_key = None
+    if persist:
+        index_key = get_index_key(compute_file_hash(file_path), embedding_model_id(),
+                                  extra=f"{CAPTION_MODEL_NAME}|{file_path}")
+        vectorstore = load_vectorstore(index_key)
+        if vectorstore is not None:
+            return vectorstore
+    
+    # 生成图片描述
+    image_description = caption_image(file_path)
+    
+    # 创建文档对象
+    doc = Document(
+        page_content=f"这是一张图片。图片内容描述：{image_description}\n\n图片保存路径：{file_path}",
+        metadata={
+            "source": file_path,
+            "file_name": file_name or os.path.basename(file_path),
+            "file_type": file_type
+        }
+    )
+    
+    # 构建向量存储
+    vectorstore = FAISS.from_documents([doc], get_embeddings())
+    if index_key:
+        save_vectorstore(vectorstore, index_key, meta={
+            "source": str(file_path),
+            "embedding_model": embedding_model_id(),
+            "caption_model": CAPTION_MODEL_NAME,
+        })
+    return vectorstore
+
+
+def build_vectorstore_for_file(file_path, file_type=None, file_name=None, progress_callback=None):
+    """
+    按文件类型选择合适的向量存储构建方法（均会优先加载磁盘上的持久化索引）
+    
+    参数 file_path: 文件路径
+    参数 file_type: 文件扩展名，如 .pdf，为None时从路径推断
+    参数 file_name: 原始文件名
+    参数 progress_callback: 嵌入进度回调，参数为已嵌入的分片数，可选
+    返回值: FAISS向量存储对象
+    """
+    file_type = (file_type or Path(file_path).suffix).lower()
+    if file_type in IMAGE_FILE_TYPES:
+        return build_vectorstore_from_image(file_path, file_name)
+    return build_vectorstore_from_document(file_path, progress_callback=progress_callback)
+
+
 def test_similarity_search(query_text, k=3):
     """
     测试相似度检索功能，输入查询文本，返回top k相似的内容